@@ -0,0 +1,417 @@
+"""Offline benchmark for the chat/tool loop.
+
+Runs main.py's chat loop against a local stand-in for the Anthropic Messages API (plain JSON and
+SSE streaming) and the Tavily search endpoint, replaying a recorded session: the file tree the
+session worked on, the scripted model responses (text and tool_use blocks) and their latencies.
+
+For every turn it reports wall time, time spent waiting on the (fake) API, tool execution time,
+render time, the remaining dispatch overhead, the number of API round-trips and the tokens sent.
+
+    python bench.py                              # built-in sample session
+    python bench.py --replay session.json        # a recording (see SAMPLE_RECORDING for the format)
+    python bench.py --journal .sessions/NAME     # replay the tool calls of a journaled session
+    python bench.py --engine async --repeat 3 --output bench_output.txt
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from anthropic import Anthropic, AsyncAnthropic
+from rich.console import Console
+from rich.table import Table
+from tavily import TavilyClient
+
+import main
+
+# Recording format: the files the session starts from, a default latency for every response, and one
+# entry per user turn listing the responses the API returns in order (the first response to the turn,
+# then one per tool-checker follow-up). Missing tool_use ids are generated; extra requests get "Done."
+SAMPLE_RECORDING = {
+    "name": "sample",
+    "latency": 0.05,
+    "files": {
+        "app/__init__.py": "",
+        "app/server.py": "import json\n\n\ndef handle(request):\n    payload = json.loads(request)\n    return {\"status\": \"ok\", \"echo\": payload}\n" * 20,
+        "app/util.py": "def slugify(text):\n    return \"-\".join(text.lower().split())\n",
+        "tests/__init__.py": "",
+        "README.md": "# Sample app\n\nA tiny service used by the benchmark.\n",
+    },
+    "turns": [
+        {
+            "user": "Give me an overview of this project.",
+            "responses": [
+                {"content": [
+                    {"type": "text", "text": "Let me look at the project layout and the server module."},
+                    {"type": "tool_use", "name": "list_files", "input": {"path": ".", "recursive": True}},
+                    {"type": "tool_use", "name": "read_file", "input": {"path": "app/server.py"}},
+                ]},
+                {"latency": 0.08, "content": [{"type": "text", "text": "This is a small JSON echo service with a helper module."}]},
+            ],
+        },
+        {
+            "user": "Where is slugify used, and what does the latest Python style guide say about helpers?",
+            "responses": [
+                {"content": [
+                    {"type": "tool_use", "name": "search_file", "input": {"path": ".", "search_pattern": "slugify"}},
+                    {"type": "tool_use", "name": "tavily_search", "input": {"query": "python style guide helper functions"}},
+                ]},
+                {"content": [{"type": "text", "text": "slugify is only defined in app/util.py and never called."}]},
+            ],
+        },
+        {
+            "user": "Make slugify strip punctuation and add a test file.",
+            "responses": [
+                {"content": [
+                    {"type": "tool_use", "name": "patch_file", "input": {"path": "app/util.py", "edits": [
+                        {"search": "    return \"-\".join(text.lower().split())", "replace": "    text = \"\".join(c for c in text if c.isalnum() or c.isspace())\n    return \"-\".join(text.lower().split())"}
+                    ]}},
+                    {"type": "tool_use", "name": "create_file", "input": {"path": "tests/test_util.py", "content": "from app.util import slugify\n\n\ndef test_slugify():\n    assert slugify(\"Hello, World!\") == \"hello-world\"\n"}},
+                ]},
+                {"content": [{"type": "text", "text": "Done: slugify now strips punctuation and has a test."}]},
+            ],
+        },
+        {
+            "user": "Read the server module again and summarize it.",
+            "responses": [
+                {"content": [{"type": "tool_use", "name": "read_file", "input": {"path": "app/server.py"}}]},
+                {"content": [{"type": "text", "text": "The module is unchanged: handle() parses JSON and echoes it."}]},
+            ],
+        },
+    ],
+}
+
+class FakeAPI:
+    # Serves scripted responses for POST /v1/messages (JSON or SSE) and POST /search (Tavily)
+    def __init__(self, default_latency=0.05):
+        self.default_latency = default_latency
+        self.responses = deque()
+        self.lock = threading.Lock()
+        self.reset_counters()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                started = time.perf_counter()
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.rstrip("/").endswith("/search"):
+                    api.serve_search(self, body)
+                else:
+                    api.serve_messages(self, body)
+                with api.lock:
+                    api.counters["server_seconds"] += time.perf_counter() - started
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset_counters(self):
+        with self.lock:
+            self.counters = {"requests": 0, "searches": 0, "tokens_sent": 0, "bytes_sent": 0, "server_seconds": 0.0}
+
+    def script(self, responses):
+        with self.lock:
+            self.responses = deque(responses)
+
+    def next_response(self):
+        with self.lock:
+            if self.responses:
+                return self.responses.popleft()
+        return {"content": [{"type": "text", "text": "Done."}]}
+
+    def serve_search(self, handler, body):
+        with self.lock:
+            self.counters["searches"] += 1
+        time.sleep(self.default_latency)
+        payload = json.dumps({
+            "query": body.get("query", ""),
+            "answer": f"Stub answer for: {body.get('query', '')}",
+            "results": [{"title": "Stub result", "url": "https://example.com", "content": "Stub content.", "score": 1.0}],
+            "response_time": self.default_latency,
+        }).encode("utf-8")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def serve_messages(self, handler, body):
+        input_tokens = main.estimate_tokens(body.get("messages", [])) + main.estimate_tokens(body.get("system", "")) + main.estimate_tokens(body.get("tools", []))
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["tokens_sent"] += input_tokens
+            self.counters["bytes_sent"] += int(handler.headers.get("Content-Length", 0))
+
+        scripted = self.next_response()
+        content = []
+        for block in scripted["content"]:
+            if block["type"] == "tool_use":
+                block = dict(block, id=block.get("id") or f"toolu_{uuid.uuid4().hex[:24]}")
+            content.append(block)
+        stop_reason = "tool_use" if any(block["type"] == "tool_use" for block in content) else "end_turn"
+        output_tokens = max(1, main.estimate_tokens(content))
+        usage = {"input_tokens": input_tokens, "output_tokens": output_tokens, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        message = {"id": f"msg_{uuid.uuid4().hex[:24]}", "type": "message", "role": "assistant", "model": body.get("model", ""),
+                   "content": content, "stop_reason": stop_reason, "stop_sequence": None, "usage": usage}
+
+        time.sleep(scripted.get("latency", self.default_latency))
+        if not body.get("stream"):
+            payload = json.dumps(message).encode("utf-8")
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(payload)))
+            handler.end_headers()
+            handler.wfile.write(payload)
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Cache-Control", "no-cache")
+        handler.end_headers()
+
+        def send(event, data):
+            handler.wfile.write(f"event: {event}\ndata: {json.dumps(dict(data, type=event))}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+
+        send("message_start", {"message": dict(message, content=[], stop_reason=None, usage=dict(usage, output_tokens=1))})
+        for index, block in enumerate(content):
+            if block["type"] == "text":
+                send("content_block_start", {"index": index, "content_block": {"type": "text", "text": ""}})
+                words = block["text"].split(" ")
+                for i in range(0, len(words), 4):
+                    chunk = " ".join(words[i:i + 4]) + (" " if i + 4 < len(words) else "")
+                    send("content_block_delta", {"index": index, "delta": {"type": "text_delta", "text": chunk}})
+            else:
+                send("content_block_start", {"index": index, "content_block": {"type": "tool_use", "id": block["id"], "name": block["name"], "input": {}}})
+                partial = json.dumps(block.get("input", {}))
+                for i in range(0, len(partial), 64):
+                    send("content_block_delta", {"index": index, "delta": {"type": "input_json_delta", "partial_json": partial[i:i + 64]}})
+            send("content_block_stop", {"index": index})
+        send("message_delta", {"delta": {"stop_reason": stop_reason, "stop_sequence": None}, "usage": {"output_tokens": output_tokens}})
+        send("message_stop", {})
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def load_recording(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def recording_from_journal(path, latency=0.05):
+    # Rebuild a replayable recording from a session journal: each user turn becomes a turn, each
+    # assistant tool_use message a scripted response and the final assistant text the last response.
+    # The journal does not hold the file tree, so pass --tree to replay against a copy of it.
+    history, _, _ = main.SessionJournal(os.path.basename(os.path.normpath(path)), root=os.path.dirname(os.path.normpath(path)) or ".").load()
+    turns = []
+    for message in history:
+        content = message["content"]
+        if message["role"] == "user" and not main.is_tool_result_message(message):
+            text = content if isinstance(content, str) else " ".join(block.get("text", "") for block in content if block.get("type") == "text")
+            turns.append({"user": text, "responses": []})
+        elif message["role"] == "assistant" and turns:
+            if isinstance(content, str):
+                turns[-1]["responses"].append({"content": [{"type": "text", "text": content or "Done."}]})
+            else:
+                blocks = [{"type": "tool_use", "name": block["name"], "input": block["input"]} for block in content if block.get("type") == "tool_use"]
+                turns[-1]["responses"].append({"content": blocks or [{"type": "text", "text": "Done."}]})
+    return {"name": os.path.basename(os.path.normpath(path)), "latency": latency, "files": {}, "turns": turns}
+
+def prepare_workdir(recording, tree=None):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    if tree:
+        shutil.copytree(tree, workdir, dirs_exist_ok=True)
+    for path, content in recording.get("files", {}).items():
+        full_path = os.path.join(workdir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w", encoding="utf-8") as f:
+            f.write(content)
+    return workdir
+
+def reset_main_state():
+    main.conversation_history = []
+    main.conversation_digest = ""
+    main.automode = False
+    main.forget_file_reads()
+    main.read_cache.clear()
+    main.image_cache.clear()
+
+def run_turns(recording, api, engine):
+    results = []
+    session = main.Session(render=True) if engine == "async" else None
+    loop = asyncio.new_event_loop() if engine == "async" else None
+    try:
+        for number, turn in enumerate(recording["turns"], 1):
+            api.script(turn["responses"])
+            api.reset_counters()
+            started = time.perf_counter()
+            if engine == "async":
+                loop.run_until_complete(main.chat_with_claude_async(session, turn["user"]))
+            else:
+                main.chat_with_claude(turn["user"])
+            wall = time.perf_counter() - started
+            history = session.history if engine == "async" else main.conversation_history
+            # Tool and render time come from the turn record of main's own instrumentation
+            spans, counts = main.metrics.turns[-1]["spans"], main.metrics.turns[-1]["counts"]
+            tool_seconds, render_seconds = spans.get("tool", 0.0), spans.get("render", 0.0)
+            results.append({
+                "turn": number,
+                "wall_seconds": wall,
+                "api_seconds": api.counters["server_seconds"],
+                "tool_seconds": tool_seconds,
+                "render_seconds": render_seconds,
+                # Everything else on the turn: request building, scheduling, stream parsing and tool dispatch
+                "dispatch_seconds": max(0.0, wall - api.counters["server_seconds"] - tool_seconds - render_seconds),
+                "round_trips": api.counters["requests"],
+                "searches": api.counters["searches"],
+                "tool_calls": counts.get("tool", 0),
+                "tokens_sent": api.counters["tokens_sent"],
+                "bytes_sent": api.counters["bytes_sent"],
+                "history_tokens": main.estimate_tokens(history),
+            })
+    finally:
+        if loop is not None:
+            loop.run_until_complete(main.async_client.close())
+            loop.close()
+    return results
+
+def run_benchmark(recording, engine="sync", streaming=True, parallel=True, repeat=1, tree=None):
+    api = FakeAPI(recording.get("latency", 0.05))
+    original_cwd = os.getcwd()
+    cache_dir = tempfile.mkdtemp(prefix="bench-cache-")
+
+    main.STREAMING = streaming
+    main.PARALLEL_TOOL_CALLS = parallel
+    main.TAVILY_CACHE_PATH = os.path.join(cache_dir, "tavily_cache.sqlite3")
+    main.OUTLINE_CACHE_PATH = os.path.join(cache_dir, "outline_cache.sqlite3")
+    main.client = Anthropic(api_key="bench", base_url=api.url, max_retries=0)
+    main.tavily = TavilyClient(api_key="tvly-bench", api_base_url=api.url)
+    # The real rate limits would only measure the pacing, not the code under test
+    main.scheduler = main.RequestScheduler(1_000_000, 1_000_000_000, main.MAX_CONCURRENT_REQUESTS)
+    # Render into a terminal-sized sink so Live and Markdown do their full work without flooding stdout
+    main.console = main.InstrumentedConsole(file=open(os.devnull, "w"), force_terminal=True, width=120)
+
+    runs = []
+    try:
+        for _ in range(repeat):
+            workdir = prepare_workdir(recording, tree)
+            os.chdir(workdir)
+            reset_main_state()
+            main.async_client = AsyncAnthropic(api_key="bench", base_url=api.url, max_retries=0)
+            try:
+                runs.append(run_turns(recording, api, engine))
+            finally:
+                os.chdir(original_cwd)
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        api.close()
+        if main.tavily_cache_db is not None:
+            main.tavily_cache_db.close()
+            main.tavily_cache_db = None
+        if main.outline_pool is not None:
+            main.outline_pool.shutdown(wait=True)
+            main.outline_pool = None
+        if main.outline_cache_db is not None:
+            main.outline_cache_db.close()
+            main.outline_cache_db = None
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return runs
+
+def summarize(runs):
+    # Median of each metric per turn across repeats
+    summary = []
+    for turn_results in zip(*runs):
+        row = {"turn": turn_results[0]["turn"]}
+        for key in turn_results[0]:
+            if key != "turn":
+                values = sorted(result[key] for result in turn_results)
+                row[key] = values[len(values) // 2]
+        summary.append(row)
+    return summary
+
+def render_report(name, summary, engine, streaming, parallel, repeat):
+    table = Table(title=f"{name}: engine={engine} streaming={streaming} parallel={parallel} repeat={repeat} (medians, times in ms)")
+    for column in ("turn", "wall", "api", "tools", "render", "dispatch", "trips", "calls", "tokens sent", "history"):
+        table.add_column(column, justify="right")
+    for row in summary:
+        table.add_row(
+            str(row["turn"]),
+            f"{row['wall_seconds'] * 1000:.1f}",
+            f"{row['api_seconds'] * 1000:.1f}",
+            f"{row['tool_seconds'] * 1000:.1f}",
+            f"{row['render_seconds'] * 1000:.1f}",
+            f"{row['dispatch_seconds'] * 1000:.1f}",
+            str(row["round_trips"]),
+            str(row["tool_calls"]),
+            str(row["tokens_sent"]),
+            str(row["history_tokens"]),
+        )
+    table.add_row(
+        "total",
+        f"{sum(row['wall_seconds'] for row in summary) * 1000:.1f}",
+        f"{sum(row['api_seconds'] for row in summary) * 1000:.1f}",
+        f"{sum(row['tool_seconds'] for row in summary) * 1000:.1f}",
+        f"{sum(row['render_seconds'] for row in summary) * 1000:.1f}",
+        f"{sum(row['dispatch_seconds'] for row in summary) * 1000:.1f}",
+        str(sum(row["round_trips"] for row in summary)),
+        str(sum(row["tool_calls"] for row in summary)),
+        str(sum(row["tokens_sent"] for row in summary)),
+        "",
+    )
+    return table
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chat/tool loop against a local fake API.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--replay", help="recording JSON file to replay")
+    source.add_argument("--journal", help="session journal directory (.sessions/NAME) to replay")
+    parser.add_argument("--tree", help="directory copied into the sandbox before replaying")
+    parser.add_argument("--latency", type=float, help="override the per-response latency in seconds")
+    parser.add_argument("--engine", choices=("sync", "async"), default="sync")
+    parser.add_argument("--no-stream", action="store_true", help="use non-streaming requests")
+    parser.add_argument("--serial", action="store_true", help="disable parallel tool calls")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", help="write per-turn results as JSON to this file")
+    parser.add_argument("--output", help="also write the report as text to this file")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        recording = load_recording(os.path.abspath(args.replay))
+    elif args.journal:
+        recording = recording_from_journal(args.journal)
+    else:
+        recording = SAMPLE_RECORDING
+    if args.latency is not None:
+        recording = dict(recording, latency=args.latency)
+        recording["turns"] = [dict(turn, responses=[dict(response, latency=args.latency) for response in turn["responses"]]) for turn in recording["turns"]]
+    tree = os.path.abspath(args.tree) if args.tree else None
+    json_path = os.path.abspath(args.json) if args.json else None
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    runs = run_benchmark(recording, args.engine, not args.no_stream, not args.serial, max(1, args.repeat), tree)
+    summary = summarize(runs)
+    table = render_report(recording.get("name", "session"), summary, args.engine, not args.no_stream, not args.serial, max(1, args.repeat))
+
+    Console().print(table)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            Console(file=f, width=160).print(table)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"recording": recording.get("name"), "engine": args.engine, "runs": runs, "summary": summary}, f, indent=2)
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -1,40 +1,453 @@
 import os
+import sys
 import json
-from tavily import TavilyClient
+import random
+import asyncio
+import contextvars
+import signal
+import weakref
+import itertools
+import importlib
+from contextlib import contextmanager, nullcontext, ExitStack
 import base64
-from PIL import Image
 import io
 import re
-from anthropic import Anthropic, APIStatusError, APIError
+import shlex
+import shutil
+import tempfile
+import threading
+import queue
+import mmap
+import hashlib
+import sqlite3
+import ast
+import unicodedata
+from array import array
+from collections import OrderedDict, Counter, deque
 import difflib
+import bisect
 import time
+from functools import lru_cache
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait
 from rich.console import Console
 from rich.panel import Panel
-from rich.syntax import Syntax
-from rich.markdown import Markdown
-
-console = Console()
+from rich.table import Table
+from rich.text import Text
+from rich.console import Group
 
 # Add these constants at the top of the file
 CONTINUATION_EXIT_PHRASE = "AUTOMODE_COMPLETE"
 MAX_CONTINUATION_ITERATIONS = 25
+AUTOMODE_CONTINUE_PROMPT = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."
 
 # Models to use
 MAINMODEL = "claude-3-5-sonnet-20240620"
 TOOLCHECKERMODEL = "claude-3-5-sonnet-20240620"
+SMALLMODEL = "claude-3-haiku-20240307"
+
+# Routing of the follow-up request after tool results: errors and results worth reasoning about go to
+# TOOLCHECKERMODEL; plain acknowledgements are folded into the turn without a request outside automode and
+# sent to SMALLMODEL in automode (where the follow-up decides whether to continue), as are short listings
+TOOL_ROUTING = True
+TOOL_ROUTING_MAX_TOKENS = 4000
+TOOL_ROUTING_SMALL_MAX_TOKENS = 1024
+TOOL_ROUTING_SHORT_RESULT_CHARS = 1500
+ACKNOWLEDGEMENT_TOOLS = {"create_folder", "create_file", "edit_and_apply", "patch_file", "batch_edit", "rollback_transaction"}
+SHORT_RESULT_TOOLS = {"list_files"}
+
+# Run the tool calls of one response concurrently and send all results back in a single follow-up
+PARALLEL_TOOL_CALLS = True
+MAX_TOOL_WORKERS = 8
+
+# Compact conversation_history once its estimated size exceeds this many tokens
+CONTEXT_TOKEN_BUDGET = 100000
+# The most recent user turns are never elided or summarized
+CONTEXT_KEEP_RECENT_TURNS = 3
+CONTEXT_DIGEST_MAX_CHARS = 8000
+
+# Project-wide search index used by search_file
+SEARCH_INDEX_MAX_FILE_BYTES = 1_000_000
+SEARCH_MAX_RESULTS = 100
+IGNORED_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", "env", ".tox", ".nox",
+                ".mypy_cache", ".pytest_cache", ".ruff_cache", ".idea", ".vscode", "build", "dist", "target", ".sessions", ".transactions"}
+
+# batch_edit stages its changes and a write-ahead journal here; the last TRANSACTION_KEEP finished
+# transactions are kept so they can be rolled back
+TRANSACTION_DIR = ".transactions"
+TRANSACTION_KEEP = 20
+# Each transaction directory holds this file with the PID of the process working on it, locked while it
+# does; recovery and pruning only touch directories whose lock is free (the owner finished or died)
+TRANSACTION_OWNER_FILE = "owner"
+
+# read_file keeps recently read files (and line offsets) in memory; big files are read through mmap
+READ_CACHE_MAX_FILES = 256
+READ_MMAP_THRESHOLD = 1_000_000
+READ_UNCHANGED_MARKER = "[File unchanged since it was last read"
+
+# Recursive list_files defaults and cached directory tree snapshots
+LIST_FILES_DEFAULT_DEPTH = 4
+LIST_FILES_MAX_ENTRIES = 500
+TREE_SNAPSHOT_CACHE_SIZE = 32
+
+# code_outline: symbol outlines kept in a persistent index keyed by path, mtime/size and content hash;
+# files written by our tools are re-outlined by OUTLINE_WORKERS background threads
+OUTLINE_CACHE_PATH = os.path.expanduser("~/.cache/claude-engineer/outline_cache.sqlite3")
+OUTLINE_CACHE_MAX_ENTRIES = 50000
+OUTLINE_MAX_FILE_BYTES = 2_000_000
+OUTLINE_MAX_FILES = 200
+OUTLINE_SIGNATURE_MAX_CHARS = 160
+OUTLINE_WORKERS = 2
+
+# Diff engine: patience anchors (lines unique on both sides) with Myers between them. Changed regions
+# whose edit distance exceeds DIFF_MYERS_MAX_COST count as replaced, and above DIFF_MAX_BYTES only a
+# summary of the change is produced
+DIFF_CONTEXT_LINES = 3
+DIFF_MAX_BYTES = 5_000_000
+DIFF_MYERS_MAX_COST = 1000
+
+# Persistent cache for tavily_search results
+TAVILY_CACHE_PATH = os.path.expanduser("~/.cache/claude-engineer/tavily_cache.sqlite3")
+TAVILY_CACHE_TTL = 24 * 60 * 60
+TAVILY_CACHE_MAX_ENTRIES = 1000
+
+# Images are downscaled to fit IMAGE_MAX_SIZE and encoded once per distinct file content
+IMAGE_MAX_SIZE = (1024, 1024)
+IMAGE_JPEG_QUALITY = 85
+IMAGE_CACHE_MAX_ENTRIES = 64
+IMAGE_ENCODE_WORKERS = 4
+
+# Images stay in full for IMAGE_HISTORY_KEEP_TURNS user turns, then are resent according to
+# IMAGE_HISTORY_POLICY: "thumbnail" (downscaled to IMAGE_THUMBNAIL_SIZE), "placeholder" (text only) or "keep"
+IMAGE_HISTORY_POLICY = "thumbnail"
+IMAGE_HISTORY_KEEP_TURNS = 2
+IMAGE_THUMBNAIL_SIZE = (256, 256)
+
+# Minimum similarity for patch_file to anchor an edit whose search text does not match exactly
+FUZZY_MATCH_THRESHOLD = 0.85
+
+# Mark the system prompt, tool definitions and history prefix as cacheable
+PROMPT_CACHING = True
+
+# Stream responses and render them as they arrive; tool calls start as soon as their block is complete
+STREAMING = True
 
-# Initialize the Anthropic client
-client = Anthropic(api_key="YOUR KEY")
+# Sessions are journaled to SESSION_DIR/<name>/ so they can be resumed with --session <name>;
+# strings of SESSION_BLOB_MIN_CHARS or more are stored once under SESSION_DIR/blobs/ by hash
+SESSION_JOURNAL = True
+SESSION_DIR = ".sessions"
+SESSION_BLOB_MIN_CHARS = 2048
+SESSION_SNAPSHOT_INTERVAL = 50
 
-# Initialize the Tavily client
-tavily = TavilyClient(api_key="YOUR KEY")
+# Tool results and diffs are shown as previews of at most RENDER_PREVIEW_LINES lines and RENDER_PREVIEW_CHARS
+# characters; the last RENDER_EXPAND_HISTORY truncated outputs can be opened in a pager with "expand <id>"
+RENDER_PREVIEW_LINES = 30
+RENDER_PREVIEW_CHARS = 3000
+RENDER_EXPAND_HISTORY = 100
+# Print tool output from a background thread so the next API call does not wait on the terminal
+RENDER_OFF_THREAD = True
+
+# Instrumentation: spans and token usage can be appended to a JSON lines file and/or written as a
+# Prometheus textfile (rewritten after every turn); None disables the export
+METRICS_JSONL_PATH = None
+METRICS_PROMETHEUS_PATH = None
+METRICS_RECENT_SPANS = 1000
+METRICS_RECENT_TURNS = 200
+
+# Planning automode ("automode plan"): independent goals run concurrently as worker sessions
+PLAN_MAX_PARALLEL_GOALS = 4
+PLAN_RESULT_MAX_CHARS = 4000
+
+# Batch mode (--batch prompts.jsonl): prompts run unattended as concurrent sessions, each in its own working directory
+BATCH_CONCURRENCY = 4
+BATCH_WORKDIR_ROOT = "batch"
+BATCH_RESPONSE_MAX_CHARS = 4000
+
+# Rate limits shared by every API call in the process (set these to your organization's limits)
+RATE_LIMIT_REQUESTS_PER_MINUTE = 50
+RATE_LIMIT_TOKENS_PER_MINUTE = 80000
+MAX_CONCURRENT_REQUESTS = 8
+RETRY_MAX_ATTEMPTS = 6
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# API keys for the Anthropic and Tavily clients
+ANTHROPIC_API_KEY = "YOUR KEY"
+TAVILY_API_KEY = "YOUR KEY"
+
+# Async engine: one shared client whose keep-alive connection pool is used by every session in the process
+ASYNC_MAX_CONNECTIONS = 20
+
+# The clients (and the anthropic and tavily packages, which take a long time to import) are created on
+# first use by get_client, get_async_client and get_tavily, so short sessions that never need them start fast
+client = None
+async_client = None
+tavily = None
+clients_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def anthropic_sdk():
+    import anthropic
+    return anthropic
+
+def get_client():
+    # Retries are handled by the request scheduler
+    global client
+    with clients_lock:
+        if client is None:
+            client = anthropic_sdk().Anthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+        return client
+
+def get_async_client():
+    global async_client
+    with clients_lock:
+        if async_client is None:
+            import httpx
+            sdk = anthropic_sdk()
+            async_client = sdk.AsyncAnthropic(
+                api_key=ANTHROPIC_API_KEY,
+                max_retries=0,
+                http_client=sdk.DefaultAsyncHttpxClient(limits=httpx.Limits(
+                    max_connections=ASYNC_MAX_CONNECTIONS,
+                    max_keepalive_connections=ASYNC_MAX_CONNECTIONS,
+                    keepalive_expiry=60
+                ))
+            )
+        return async_client
+
+def get_tavily():
+    global tavily
+    with clients_lock:
+        if tavily is None:
+            from tavily import TavilyClient
+            tavily = TavilyClient(api_key=TAVILY_API_KEY)
+        return tavily
 
 # Set up the conversation memory
 conversation_history = []
 
+# Rolling summary of turns that were compacted out of conversation_history
+conversation_digest = ""
+
 # automode flag
 automode = False
 
+# Journal of the sync REPL's conversation (see SessionJournal)
+session_journal = None
+
+class Session:
+    # Conversation state for one session of the async engine; the sync REPL keeps using the globals above
+    def __init__(self, history=None, automode=False, render=True, name=None, workdir=None):
+        self.name = name or f"session-{next(session_ids)}"
+        self.history = list(history or [])
+        self.digest = ""
+        self.automode = automode
+        self.render = render
+        self.workdir = workdir
+        self.read_history = {}
+        self.pending_reads = {}
+        self.usage = {}
+        self.journal = None
+        self.files_written = set()
+        live_sessions.add(self)
+
+live_sessions = weakref.WeakSet()
+session_ids = itertools.count(1)
+current_session = contextvars.ContextVar("current_session", default=None)
+
+class SessionJournal:
+    # Append-only JSONL log of one session, one entry per message. A snapshot of the whole state is
+    # written every SESSION_SNAPSHOT_INTERVAL entries together with the journal offset it covers, so
+    # resuming reads the snapshot plus the short tail of the journal after it.
+    def __init__(self, name, root=None):
+        self.name = name
+        self.root = root or SESSION_DIR
+        self.dir = os.path.join(self.root, name)
+        self.blob_dir = os.path.join(self.root, "blobs")
+        self.journal_path = os.path.join(self.dir, "journal.jsonl")
+        self.snapshot_path = os.path.join(self.dir, "snapshot.json")
+        self.messages = []
+        self.digest = ""
+        self.automode_state = None
+        self.entries_since_snapshot = 0
+        self.file = None
+
+    @staticmethod
+    def latest(root=None):
+        root = root or SESSION_DIR
+        try:
+            names = [name for name in os.listdir(root) if os.path.isfile(os.path.join(root, name, "journal.jsonl"))]
+        except FileNotFoundError:
+            return None
+        return max(names, key=lambda name: os.path.getmtime(os.path.join(root, name, "journal.jsonl")), default=None)
+
+    def blob_path(self, blob_hash):
+        return os.path.join(self.blob_dir, blob_hash[:2], blob_hash)
+
+    def put_blob(self, text):
+        blob_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        path = self.blob_path(blob_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(temp_path, path)
+        return blob_hash
+
+    def get_blob(self, blob_hash):
+        with open(self.blob_path(blob_hash), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def encode(self, value):
+        if isinstance(value, str):
+            return {"$blob": self.put_blob(value)} if len(value) >= SESSION_BLOB_MIN_CHARS else value
+        if isinstance(value, list):
+            return [self.encode(item) for item in value]
+        if isinstance(value, dict):
+            if value.get("type") == "image" and value.get("source", {}).get("type") == "stored":
+                # Image data is already content-addressed by the same hash, so the blob name matches the reference
+                entry = image_store.get(value["source"]["hash"])
+                if entry is not None:
+                    self.put_blob(entry["data"])
+                return value
+            return {key: self.encode(item) for key, item in value.items()}
+        if hasattr(value, "model_dump"):
+            return self.encode(value.model_dump())
+        return value
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+        if isinstance(value, dict):
+            if len(value) == 1 and "$blob" in value:
+                return self.get_blob(value["$blob"])
+            if value.get("type") == "image" and value.get("source", {}).get("type") == "stored":
+                source = value["source"]
+                if source["hash"] not in image_store and os.path.exists(self.blob_path(source["hash"])):
+                    with image_store_lock:
+                        image_store[source["hash"]] = {"media_type": source["media_type"], "data": self.get_blob(source["hash"]), "thumbnail": None}
+                return value
+            return {key: self.decode(item) for key, item in value.items()}
+        return value
+
+    def open(self):
+        if self.file is None:
+            os.makedirs(self.dir, exist_ok=True)
+            # Drop a partial last line left by a crash mid-write before appending after it
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb+') as f:
+                    data = f.read()
+                    if data and not data.endswith(b"\n"):
+                        f.truncate(data.rfind(b"\n") + 1)
+            self.file = open(self.journal_path, 'a', encoding='utf-8')
+        return self.file
+
+    def append(self, entries):
+        f = self.open()
+        for entry in entries:
+            f.write(json.dumps(entry, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        self.entries_since_snapshot += len(entries)
+        if self.entries_since_snapshot >= SESSION_SNAPSHOT_INTERVAL:
+            self.snapshot()
+
+    def record(self, history, digest):
+        # Messages are appended as they are added; if history was rewritten (compaction), log a reset instead
+        if digest == self.digest and len(history) >= len(self.messages) and all(
+            new is old for new, old in zip(history, self.messages)
+        ):
+            entries = [{"op": "message", "message": self.encode(message)} for message in history[len(self.messages):]]
+        else:
+            entries = [{"op": "reset", "history": self.encode(history), "digest": digest}]
+        self.messages = list(history)
+        self.digest = digest
+        if entries:
+            self.append(entries)
+
+    def record_automode(self, state):
+        # state is None outside automode, otherwise {"iteration": ..., "max_iterations": ...}
+        if state != self.automode_state:
+            self.automode_state = state
+            self.append([{"op": "automode", "state": state}])
+
+    def snapshot(self):
+        f = self.open()
+        state = {
+            "journal_offset": f.tell(),
+            "history": self.encode(self.messages),
+            "digest": self.digest,
+            "automode": self.automode_state,
+        }
+        fd, temp_path = tempfile.mkstemp(dir=self.dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as out:
+            json.dump(state, out, default=str)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self.entries_since_snapshot = 0
+
+    def load(self):
+        # Returns (history, digest, automode_state) from the latest snapshot plus the journal tail after it
+        history, digest, automode_state, offset = [], "", None, 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            history, digest, automode_state, offset = state["history"], state["digest"], state["automode"], state["journal_offset"]
+        tail = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    tail += 1
+                    if entry["op"] == "message":
+                        history.append(entry["message"])
+                    elif entry["op"] == "reset":
+                        history, digest = entry["history"], entry["digest"]
+                    elif entry["op"] == "automode":
+                        automode_state = entry["state"]
+        history = self.decode(history)
+        self.messages, self.digest, self.automode_state = list(history), digest, automode_state
+        self.entries_since_snapshot = tail
+        return history, digest, automode_state
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def open_session_journal(argv):
+    # --session NAME journals to (and resumes) that session; --resume picks the most recently used one
+    if not SESSION_JOURNAL:
+        return None
+    name = None
+    if "--session" in argv and argv.index("--session") + 1 < len(argv):
+        name = argv[argv.index("--session") + 1]
+    elif "--resume" in argv:
+        name = SessionJournal.latest()
+        if name is None:
+            console.print(Panel("No session to resume; starting a new one.", title="Session", style="yellow"))
+    return SessionJournal(name or time.strftime("%Y%m%d-%H%M%S"))
+
+def restore_session(journal):
+    # Returns (history, digest, automode_state) and reports what was restored
+    started = time.perf_counter()
+    history, digest, automode_state = journal.load()
+    if history:
+        console.print(Panel(f"Resumed session '{journal.name}': {len(history)} messages restored in {(time.perf_counter() - started) * 1000:.0f} ms.", title="Session", title_align="left", style="green"))
+    else:
+        console.print(Panel(f"Session '{journal.name}' is journaled to {journal.dir}. Resume it with --session {journal.name}.", title="Session", title_align="left", style="blue"))
+    return history, digest, automode_state
+
 # base prompt
 base_system_prompt = """
 You are Claude, an AI assistant powered by Anthropic's Claude-3.5-Sonnet model, specializing in software development. Your capabilities include:
@@ -51,14 +464,23 @@ Available tools and their optimal use cases:
 1. create_folder: Create new directories in the project structure.
 2. create_file: Generate new files with specified content.
 3. edit_and_apply: Examine and modify existing files.FULLY.
-4. read_file: View the contents of existing files without making changes.
-5. list_files: Understand the current project structure or locate specific files.
-6. tavily_search: Obtain current information on technologies, libraries, or best practices.
-7. Analyzing images provided by the user
+4. patch_file: Make targeted changes to existing files with search/replace edits or unified diff hunks.
+5. batch_edit: Change, create or delete many files in one all-or-nothing transaction.
+6. rollback_transaction: Undo a batch_edit transaction.
+7. read_file: View the contents of existing files without making changes.
+8. list_files: Understand the current project structure or locate specific files.
+9. search_file: Find where code or text appears across the project, with line numbers and context.
+10. code_outline: See the classes, functions and signatures of a file or directory, with line ranges.
+11. tavily_search: Obtain current information on technologies, libraries, or best practices.
+12. Analyzing images provided by the user
 
 Tool Usage Guidelines:
 - Always use the most appropriate tool for the task at hand.
 - For file modifications, use edit_and_apply. Read the file first, then apply changes if needed.
+- For small changes to large files, prefer patch_file so only the changed regions have to be written out.
+- When a change spans several files (renames, refactors, API changes), make it with a single batch_edit call.
+- To explore a project, call list_files once with recursive set instead of listing folders one at a time.
+- To understand code, call code_outline first and then read_file only the line ranges you need instead of whole files.
 - After making changes, always review the diff output to ensure accuracy.
 - Proactively use tavily_search when you need up-to-date information or context.
 
@@ -118,14 +540,14 @@ You are currently in automode. Follow these guidelines:
 Remember: Focus on completing the established goals efficiently and effectively. Avoid unnecessary conversations or requests for additional tasks.
 """
 
-def update_system_prompt(current_iteration=None, max_iterations=None):
-    global base_system_prompt, automode_system_prompt
+@lru_cache(maxsize=64)
+def build_system_prompt(automode_enabled, current_iteration=None, max_iterations=None):
     chain_of_thought_prompt = """
     Answer the user's request using relevant tools (if they are available). Before calling a tool, do some analysis within <thinking></thinking> tags. First, think about which of the provided tools is the relevant tool to answer the user's request. Second, go through each of the required parameters of the relevant tool and determine if the user has directly provided or given enough information to infer a value. When deciding if the parameter can be inferred, carefully consider all the context to see if it supports a specific value. If all of the required parameters are present or can be reasonably inferred, close the thinking tag and proceed with the tool call. BUT, if one of the values for a required parameter is missing, DO NOT invoke the function (not even with fillers for the missing params) and instead, ask the user to provide the missing parameters. DO NOT ask for more information on optional parameters if it is not provided.
 
     Do not reflect on the quality of the returned search results in your response.
     """
-    if automode:
+    if automode_enabled:
         iteration_info = ""
         if current_iteration is not None and max_iterations is not None:
             iteration_info = f"You are currently on iteration {current_iteration} out of {max_iterations} in automode."
@@ -133,56 +555,1103 @@ def update_system_prompt(current_iteration=None, max_iterations=None):
     else:
         return base_system_prompt + "\n\n" + chain_of_thought_prompt
 
+def system_prompt_blocks(current_iteration=None, max_iterations=None, automode_enabled=None):
+    automode_enabled = automode if automode_enabled is None else automode_enabled
+    # The iteration line changes every automode iteration, so it lives in its own block after the cached prefix
+    blocks = [{"type": "text", "text": build_system_prompt(automode_enabled), "cache_control": {"type": "ephemeral"}}]
+    if automode_enabled and current_iteration is not None and max_iterations is not None:
+        blocks.append({"type": "text", "text": f"You are currently on iteration {current_iteration} out of {max_iterations} in automode."})
+    return blocks
+
+def add_cache_breakpoint(message):
+    content = message["content"]
+    if isinstance(content, str):
+        if not content:
+            return message
+        content = [{"type": "text", "text": content}]
+    elif not content:
+        return message
+    content = list(content)
+    content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+    return dict(message, content=content)
+
+def build_request(model, messages, current_iteration=None, max_iterations=None, stable_len=0, max_tokens=4000, automode_enabled=None, digest=None):
+    automode_enabled = automode if automode_enabled is None else automode_enabled
+    digest = conversation_digest if digest is None else digest
+    messages = materialize_images(messages)
+    if digest and messages:
+        messages = [prepend_digest(messages[0], digest)] + list(messages[1:])
+
+    if not PROMPT_CACHING:
+        return dict(
+            model=model,
+            max_tokens=max_tokens,
+            system=build_system_prompt(automode_enabled, current_iteration, max_iterations),
+            messages=messages,
+            tools=tools,
+            tool_choice={"type": "auto"}
+        )
+
+    # Breakpoints: tools, system, end of the stored history and end of the current turn (the API allows four)
+    cached_messages = list(messages)
+    for index in {stable_len - 1, len(cached_messages) - 1}:
+        if 0 <= index < len(cached_messages):
+            cached_messages[index] = add_cache_breakpoint(cached_messages[index])
+
+    cached_tools = list(tools)
+    cached_tools[-1] = dict(cached_tools[-1], cache_control={"type": "ephemeral"})
+
+    return dict(
+        model=model,
+        max_tokens=max_tokens,
+        system=system_prompt_blocks(current_iteration, max_iterations, automode_enabled),
+        messages=cached_messages,
+        tools=cached_tools,
+        tool_choice={"type": "auto"}
+    )
+
+def estimate_tokens(value):
+    # Roughly four characters per token is close enough for budgeting
+    return len(json.dumps(value, default=str)) // 4
+
+def is_tool_result_message(message):
+    return message["role"] == "user" and isinstance(message["content"], list) and any(
+        block.get("type") == "tool_result" for block in message["content"]
+    )
+
+def user_turn_starts(history):
+    return [i for i, message in enumerate(history) if message["role"] == "user" and not is_tool_result_message(message)]
+
+def elide_stale_tool_payloads(history, protected_from):
+    # A read_file result is stale once the same file is read or written again later on;
+    # file contents sent through edit_and_apply/create_file/batch_edit are already on disk.
+    # Partial reads and "unchanged" notices do not replace an earlier full read.
+    unchanged_reads = {
+        block["tool_use_id"]
+        for message in history if is_tool_result_message(message)
+        for block in message["content"]
+        if block.get("type") == "tool_result" and str(block.get("content", "")).startswith(READ_UNCHANGED_MARKER)
+    }
+    tool_calls = {}
+    last_touch = {}
+    for i, message in enumerate(history):
+        if message["role"] == "assistant" and isinstance(message["content"], list):
+            for block in message["content"]:
+                if block.get("type") == "tool_use" and block["name"] in ("read_file", "edit_and_apply", "patch_file", "create_file"):
+                    path = os.path.normpath(block["input"].get("path", ""))
+                    tool_calls[block["id"]] = (block["name"], path, i)
+                    partial = any(block["input"].get(field) is not None for field in ("start_line", "end_line", "max_bytes"))
+                    if block["name"] != "read_file" or not (partial or block["id"] in unchanged_reads):
+                        last_touch[path] = i
+                elif block.get("type") == "tool_use" and block["name"] == "batch_edit":
+                    for change in block["input"].get("changes") or []:
+                        if isinstance(change, dict) and isinstance(change.get("path"), str):
+                            last_touch[os.path.normpath(change["path"])] = i
+
+    # Messages with nothing to elide are kept as the same objects, so the session journal can tell an
+    # unchanged history from a rewritten one
+    compacted = []
+    for i, message in enumerate(history):
+        if i >= protected_from or not isinstance(message["content"], list):
+            compacted.append(message)
+            continue
+        content = []
+        for block in message["content"]:
+            if block.get("type") == "tool_result" and block.get("tool_use_id") in tool_calls:
+                name, path, called_at = tool_calls[block["tool_use_id"]]
+                if name == "read_file" and last_touch.get(path, -1) > called_at and not str(block.get("content", "")).startswith("[Elided"):
+                    block = dict(block, content=f"[Elided: stale contents of {path}; the file was read or modified again later]")
+            elif block.get("type") == "tool_use" and block["name"] in ("edit_and_apply", "create_file"):
+                field = "new_content" if block["name"] == "edit_and_apply" else "content"
+                written = block["input"].get(field)
+                if isinstance(written, str) and not written.startswith("[Elided"):
+                    block = dict(block, input=dict(block["input"], **{field: f"[Elided: {len(written)} characters written to {block['input'].get('path')}]"}))
+            elif block.get("type") == "tool_use" and block["name"] == "batch_edit" and isinstance(block["input"].get("changes"), list):
+                changes = [
+                    dict(change, content=f"[Elided: {len(change['content'])} characters written to {change.get('path')}]")
+                    if isinstance(change, dict) and isinstance(change.get("content"), str) and not change["content"].startswith("[Elided") else change
+                    for change in block["input"]["changes"]
+                ]
+                if any(new is not old for new, old in zip(changes, block["input"]["changes"])):
+                    block = dict(block, input=dict(block["input"], changes=changes))
+            content.append(block)
+        changed = any(new is not old for new, old in zip(content, message["content"]))
+        compacted.append(dict(message, content=content) if changed else message)
+    return compacted
+
+def summarize_messages(messages):
+    lines = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for block in content:
+            block_type = block.get("type")
+            if block_type == "text" and block["text"].strip():
+                text = " ".join(block["text"].split())
+                lines.append(f"{message['role'].capitalize()}: {text[:300]}{'...' if len(text) > 300 else ''}")
+            elif block_type == "tool_use":
+                target = block["input"].get("path") or block["input"].get("query") or ""
+                lines.append(f"Tool call: {block['name']}({target})")
+            elif block_type == "image":
+                lines.append("User attached an image.")
+    return "\n".join(lines)
+
+def prepend_digest(message, digest):
+    note = f"[Summary of earlier conversation]\n{digest}\n[End of summary]\n\n"
+    content = message["content"]
+    if isinstance(content, str):
+        return dict(message, content=note + content)
+    return dict(message, content=[{"type": "text", "text": note}] + list(content))
+
+def compact_history(history, digest, budget=None):
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    before = estimate_tokens(history) + estimate_tokens(digest)
+    if before <= budget:
+        return history, digest
+
+    turn_starts = user_turn_starts(history)
+    protected_from = turn_starts[-CONTEXT_KEEP_RECENT_TURNS] if len(turn_starts) >= CONTEXT_KEEP_RECENT_TURNS else 0
+    original = history
+    history = elide_stale_tool_payloads(history, protected_from)
+    elided = any(new is not old for new, old in zip(history, original))
+
+    # Drop whole turns from the front, so every tool_use keeps its tool_result
+    cut = 0
+    size = estimate_tokens(history) + estimate_tokens(digest)
+    for start in turn_starts:
+        if size <= budget or start > protected_from:
+            break
+        cut = start
+        size = estimate_tokens(history[cut:]) + estimate_tokens(digest)
+    if cut:
+        summary = summarize_messages(history[:cut])
+        digest = (digest + "\n" + summary).strip()
+        if len(digest) > CONTEXT_DIGEST_MAX_CHARS:
+            digest = digest[-CONTEXT_DIGEST_MAX_CHARS:].split("\n", 1)[-1]
+        history = history[cut:]
+    if not elided and not cut:
+        # Everything left is in the protected recent turns; compacting again next turn would change nothing
+        return original, digest
+
+    # Elided or summarized reads are no longer in context, so the next read must return full contents
+    forget_file_reads()
+
+    after = estimate_tokens(history) + estimate_tokens(digest)
+    session = current_session.get()
+    if session is None or session.render:
+        console.print(Panel(f"Conversation compacted from ~{before} to ~{after} tokens ({cut} messages summarized).", title="Context", title_align="left", expand=False, style="blue"))
+    return history, digest
+
+turn_usage = {}
+
+def reset_turn_usage(totals=None):
+    totals = turn_usage if totals is None else totals
+    totals.clear()
+    totals.update(requests=0, input_tokens=0, output_tokens=0, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+
+def record_usage(usage, totals=None):
+    totals = turn_usage if totals is None else totals
+    if usage is None:
+        return
+    totals["requests"] = totals.get("requests", 0) + 1
+    for field in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"):
+        totals[field] = totals.get(field, 0) + (getattr(usage, field, None) or 0)
+
+def print_turn_usage(totals=None):
+    totals = turn_usage if totals is None else totals
+    if not totals.get("requests"):
+        return
+    console.print(Panel(
+        f"Requests: {totals['requests']}  |  "
+        f"Cache hit: {totals['cache_read_input_tokens']}  |  "
+        f"Cache write: {totals['cache_creation_input_tokens']}  |  "
+        f"Uncached input: {totals['input_tokens']}  |  "
+        f"Output: {totals['output_tokens']}",
+        title="Token Usage", title_align="left", expand=False, style="blue"
+    ))
+
+def session_label():
+    session = current_session.get()
+    if session is not None:
+        return session.name
+    return session_journal.name if session_journal is not None else "repl"
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def usage_counts(usage):
+    return {field: getattr(usage, field, None) or 0 for field in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")}
+
+class Metrics:
+    # Timed spans (API calls, tools, diffs, rendering) and token usage for the whole process. Spans are
+    # aggregated per name and added to the open turn of the session they ran in; each finished turn
+    # keeps its time breakdown so slow turns can be found and costs attributed per session.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.tokens = {}
+        self.open_turns = {}
+        self.turns = deque(maxlen=METRICS_RECENT_TURNS)
+        self.routes = {}
+
+    @contextmanager
+    def span(self, name, export=True, **attributes):
+        # Attributes can be added to the yielded dict inside the block and are exported with the span
+        started = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.record_span(name, time.perf_counter() - started, attributes, export)
+
+    def record_span(self, name, seconds, attributes=None, export=True):
+        label = session_label()
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = {"count": 0, "seconds": 0.0, "max": 0.0, "recent": deque(maxlen=METRICS_RECENT_SPANS)}
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["recent"].append(seconds)
+            turn = self.open_turns.get(label)
+            if turn is not None:
+                turn["spans"][name] = turn["spans"].get(name, 0.0) + seconds
+                turn["counts"][name] = turn["counts"].get(name, 0) + 1
+        if export:
+            self.export_record({"type": "span", "name": name, "session": label, "seconds": round(seconds, 6), **(attributes or {})})
+
+    def record_tokens(self, model, usage):
+        if usage is None:
+            return
+        label = session_label()
+        counts = usage_counts(usage)
+        with self.lock:
+            totals = self.tokens.setdefault((label, model), {"requests": 0, "input_tokens": 0, "output_tokens": 0, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0})
+            totals["requests"] += 1
+            turn = self.open_turns.get(label)
+            for field, count in counts.items():
+                totals[field] += count
+                if turn is not None:
+                    turn["tokens"][field] = turn["tokens"].get(field, 0) + count
+        self.export_record({"type": "usage", "session": label, "model": model, **counts})
+
+    def record_route(self, decision):
+        with self.lock:
+            key = (decision["route"], decision["model"])
+            self.routes[key] = self.routes.get(key, 0) + 1
+        self.export_record({"type": "route", "session": session_label(), **decision})
+
+    def begin_turn(self):
+        turn = {"session": session_label(), "started": time.time(), "clock": time.perf_counter(), "spans": {}, "counts": {}, "tokens": {}}
+        with self.lock:
+            self.open_turns[turn["session"]] = turn
+        return turn
+
+    def end_turn(self, turn):
+        record = {
+            "type": "turn",
+            "session": turn["session"],
+            "started": turn["started"],
+            "seconds": round(time.perf_counter() - turn["clock"], 6),
+            "spans": {name: round(seconds, 6) for name, seconds in turn["spans"].items()},
+            "counts": dict(turn["counts"]),
+            "tokens": dict(turn["tokens"]),
+        }
+        with self.lock:
+            if self.open_turns.get(turn["session"]) is turn:
+                del self.open_turns[turn["session"]]
+            self.turns.append(record)
+        self.export_record(record)
+        if METRICS_PROMETHEUS_PATH:
+            self.write_prometheus(METRICS_PROMETHEUS_PATH)
+        return record
+
+    def export_record(self, record):
+        if not METRICS_JSONL_PATH:
+            return
+        line = json.dumps(dict(record, time=record.get("time", time.time())), default=str) + "\n"
+        with self.lock:
+            with open(METRICS_JSONL_PATH, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def snapshot(self):
+        with self.lock:
+            spans = {
+                name: {"count": stats["count"], "seconds": stats["seconds"], "max": stats["max"],
+                       "p50": percentile(stats["recent"], 0.5), "p95": percentile(stats["recent"], 0.95)}
+                for name, stats in self.spans.items()
+            }
+            tokens = {key: dict(totals) for key, totals in self.tokens.items()}
+            turns = list(self.turns)
+        return spans, tokens, turns
+
+    def route_counts(self):
+        with self.lock:
+            return dict(self.routes)
+
+    def write_jsonl(self, path):
+        spans, tokens, turns = self.snapshot()
+        with open(path, 'w', encoding='utf-8') as f:
+            for name, stats in spans.items():
+                f.write(json.dumps({"type": "span_summary", "name": name, **stats}) + "\n")
+            for (label, model), totals in tokens.items():
+                f.write(json.dumps({"type": "usage_summary", "session": label, "model": model, **totals}) + "\n")
+            for turn in turns:
+                f.write(json.dumps(turn, default=str) + "\n")
+
+    def write_prometheus(self, path):
+        spans, tokens, _ = self.snapshot()
+        escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"')
+        lines = [
+            "# HELP claude_engineer_span_seconds_total Time spent in instrumented operations.",
+            "# TYPE claude_engineer_span_seconds_total counter",
+        ]
+        lines += [f'claude_engineer_span_seconds_total{{span="{escape(name)}"}} {stats["seconds"]:.6f}' for name, stats in spans.items()]
+        lines += ["# HELP claude_engineer_spans_total Number of instrumented operations.", "# TYPE claude_engineer_spans_total counter"]
+        lines += [f'claude_engineer_spans_total{{span="{escape(name)}"}} {stats["count"]}' for name, stats in spans.items()]
+        lines += ["# HELP claude_engineer_tokens_total Tokens reported by the API per session, model and kind.", "# TYPE claude_engineer_tokens_total counter"]
+        for (label, model), totals in tokens.items():
+            for field in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"):
+                lines.append(f'claude_engineer_tokens_total{{session="{escape(label)}",model="{escape(model)}",kind="{field[:-len("_tokens")]}"}} {totals[field]}')
+        lines += ["# HELP claude_engineer_api_requests_total API requests per session and model.", "# TYPE claude_engineer_api_requests_total counter"]
+        lines += [f'claude_engineer_api_requests_total{{session="{escape(label)}",model="{escape(model)}"}} {totals["requests"]}' for (label, model), totals in tokens.items()]
+        lines += ["# HELP claude_engineer_tool_followups_total Follow-up requests after tool results per route and model.", "# TYPE claude_engineer_tool_followups_total counter"]
+        lines += [f'claude_engineer_tool_followups_total{{route="{route}",model="{escape(model)}"}} {count}' for (route, model), count in self.route_counts().items()]
+        lines += ["# HELP claude_engineer_scheduler_events_total Request scheduler events.", "# TYPE claude_engineer_scheduler_events_total counter"]
+        lines += [f'claude_engineer_scheduler_events_total{{event="{name}"}} {value}' for name, value in scheduler.stats.items() if name != "wait_seconds"]
+        lines += ["# HELP claude_engineer_scheduler_wait_seconds_total Time requests waited for rate limits or retries.", "# TYPE claude_engineer_scheduler_wait_seconds_total counter",
+                  f"claude_engineer_scheduler_wait_seconds_total {scheduler.stats['wait_seconds']:.6f}"]
+        # Written to a temporary file and renamed so a scraper never sees a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+metrics = Metrics()
+
+class InstrumentedConsole(Console):
+    # Times every print as a "render" span; prints nested inside another (Live refreshing) count once
+    render_depth = threading.local()
+
+    def print(self, *args, **kwargs):
+        if getattr(self.render_depth, "value", 0):
+            return super().print(*args, **kwargs)
+        self.render_depth.value = 1
+        started = time.perf_counter()
+        try:
+            return super().print(*args, **kwargs)
+        finally:
+            self.render_depth.value = 0
+            metrics.record_span("render", time.perf_counter() - started, export=False)
+
+console = InstrumentedConsole()
+
+def print_stats():
+    spans, tokens, turns = metrics.snapshot()
+
+    span_table = Table(title="Spans", title_justify="left")
+    for column in ("span", "count", "total s", "p50 ms", "p95 ms", "max ms"):
+        span_table.add_column(column, justify="left" if column == "span" else "right")
+    for name, stats in sorted(spans.items(), key=lambda item: -item[1]["seconds"]):
+        span_table.add_row(name, str(stats["count"]), f"{stats['seconds']:.2f}", f"{stats['p50'] * 1000:.1f}", f"{stats['p95'] * 1000:.1f}", f"{stats['max'] * 1000:.1f}")
+    console.print(span_table)
+
+    token_table = Table(title="Tokens", title_justify="left")
+    for column in ("session", "model", "requests", "input", "cache read", "cache write", "output"):
+        token_table.add_column(column, justify="left" if column in ("session", "model") else "right")
+    for (label, model), totals in sorted(tokens.items()):
+        token_table.add_row(label, model, str(totals["requests"]), str(totals["input_tokens"]), str(totals["cache_read_input_tokens"]),
+                            str(totals["cache_creation_input_tokens"]), str(totals["output_tokens"]))
+    console.print(token_table)
+
+    if turns:
+        turn_table = Table(title="Slowest recent turns", title_justify="left")
+        for column in ("session", "started", "total s", "api s", "tools s", "diff s", "render s", "input tokens"):
+            turn_table.add_column(column, justify="left" if column in ("session", "started") else "right")
+        for turn in sorted(turns, key=lambda turn: -turn["seconds"])[:5]:
+            turn_table.add_row(
+                turn["session"], time.strftime("%H:%M:%S", time.localtime(turn["started"])), f"{turn['seconds']:.2f}",
+                f"{turn['spans'].get('api_call', 0.0):.2f}", f"{turn['spans'].get('tool', 0.0):.2f}",
+                f"{turn['spans'].get('diff', 0.0):.2f}", f"{turn['spans'].get('render', 0.0):.2f}",
+                str(turn["tokens"].get("input_tokens", 0) + turn["tokens"].get("cache_read_input_tokens", 0) + turn["tokens"].get("cache_creation_input_tokens", 0))
+            )
+        console.print(turn_table)
+
+    tavily = tavily_cache_stats()
+    outline = dict(outline_counters)
+    routes = metrics.route_counts()
+    console.print(Panel(
+        "Scheduler: " + "  |  ".join(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}" for name, value in scheduler.stats.items()) + "\n"
+        + ("Tool follow-ups: " + "  |  ".join(f"{route} ({model}): {count}" if model else f"{route}: {count}" for (route, model), count in sorted(routes.items())) + "\n" if routes else "") +
+        f"Tavily cache: hits {tavily['hits']}  |  misses {tavily['misses']}  |  coalesced {tavily['coalesced']}  |  "
+        f"errors {tavily['errors']}  |  entries {tavily['entries']}  |  hit rate {tavily['hit_rate']:.0%}\n"
+        f"Outline index: hits {outline['hits']}  |  rehashed {outline['rehashed']}  |  parsed {outline['parsed']}  |  background {outline['background']}",
+        title="Requests", title_align="left", expand=False, style="blue"
+    ))
+
+def handle_stats_command(user_input):
+    # "stats" prints the tables; "stats export PATH" writes a Prometheus textfile (.prom) or JSON lines
+    parts = user_input.split(maxsplit=2)
+    if len(parts) == 3 and parts[1] == "export":
+        path = os.path.expanduser(parts[2].strip())
+        try:
+            if path.endswith(".prom"):
+                metrics.write_prometheus(path)
+            else:
+                metrics.write_jsonl(path)
+            console.print(Panel(f"Metrics exported to {path}", title="Stats", title_align="left", style="green"))
+        except OSError as e:
+            console.print(Panel(f"Error exporting metrics: {str(e)}", title="Error", style="bold red"))
+    else:
+        print_stats()
+
+class RenderQueue:
+    # Prints renderables in order on one background thread; flush() waits until everything queued is shown
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, renderable):
+        if not RENDER_OFF_THREAD:
+            console.print(renderable)
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="render", daemon=True)
+                self.thread.start()
+        self.queue.put(renderable)
+
+    def run(self):
+        while True:
+            renderable = self.queue.get()
+            try:
+                console.print(renderable)
+            except Exception as e:
+                sys.stderr.write(f"Error rendering output: {str(e)}\n")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+render_queue = RenderQueue()
+
+expandable_lock = threading.Lock()
+expandable = OrderedDict()
+expandable_ids = itertools.count(1)
+
+def preview_panel(text, title, lexer=None, **panel_options):
+    # Shows the head of long output and keeps the full text for "expand <id>"
+    from rich.syntax import Syntax
+    text = str(text)
+    lines = text.splitlines()
+    footer = None
+    if len(lines) > RENDER_PREVIEW_LINES or len(text) > RENDER_PREVIEW_CHARS:
+        output_id = next(expandable_ids)
+        with expandable_lock:
+            expandable[output_id] = (title, text, lexer)
+            while len(expandable) > RENDER_EXPAND_HISTORY:
+                expandable.popitem(last=False)
+        shown = "\n".join(lines[:RENDER_PREVIEW_LINES])[:RENDER_PREVIEW_CHARS]
+        footer = Text(f"... {len(lines) - shown.count(chr(10)) - 1} more lines. Type 'expand {output_id}' to view all.", style="dim")
+        title = f"{title} [{output_id}]"
+        text = shown
+    body = (highlight_diff(text) if lexer == "diff" else Syntax(text, lexer, theme="monokai", line_numbers=True)) if lexer else Text(text)
+    return Panel(Group(body, footer) if footer is not None else body, title=title, title_align="left", **panel_options)
+
+def expand_output(user_input):
+    from rich.syntax import Syntax
+    parts = user_input.split()
+    entry = None
+    if len(parts) == 2 and parts[1].isdigit():
+        with expandable_lock:
+            entry = expandable.get(int(parts[1]))
+    if entry is None:
+        console.print(Panel(f"No output to expand for '{user_input}'. Only the last {RENDER_EXPAND_HISTORY} truncated outputs are kept.", title="Error", style="bold red"))
+        return
+    render_queue.flush()
+    title, text, lexer = entry
+    with console.pager(styles=True):
+        console.print(Text(title, style="bold"))
+        console.print((highlight_diff(text) if lexer == "diff" else Syntax(text, lexer, theme="monokai", line_numbers=True)) if lexer else Text(text))
+
+def tool_target(tool_input):
+    if not isinstance(tool_input, dict):
+        return ""
+    return str(tool_input.get("path") or tool_input.get("query") or tool_input.get("search_pattern") or "")
+
+def tool_dashboard(tool_uses, tasks, started):
+    # One table for every tool call of a response, built from the state of their futures or tasks
+    table = Table(title=f"Tools ({time.perf_counter() - started:.1f} s)", title_justify="left", expand=False)
+    for column in ("#", "tool", "target", "status", "result"):
+        table.add_column(column)
+    for i, (tool_use, task) in enumerate(zip(tool_uses, tasks), 1):
+        if task.done():
+            result, is_error = task.result()
+            first_line = result.splitlines()[0] if result else ""
+            status = Text("error", style="bold red") if is_error else Text("done", style="green")
+            summary = first_line[:60] if is_error else f"{len(result)} chars"
+        else:
+            running = task.running() if hasattr(task, "running") else True
+            status = Text("running" if running else "queued", style="yellow")
+            summary = ""
+        table.add_row(str(i), tool_use.name, tool_target(tool_use.input)[:60], status, summary)
+    return table
+
+def watch_tool_calls(tool_uses, futures):
+    # Live table of tool activity refreshed in batches instead of one panel per call and result
+    from rich.live import Live
+    started = time.perf_counter()
+    render_queue.flush()
+    with Live(tool_dashboard(tool_uses, futures, started), console=console, refresh_per_second=8) as live:
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=0.125)
+            live.update(tool_dashboard(tool_uses, futures, started))
+
+async def watch_tool_calls_async(tool_uses, tasks):
+    from rich.live import Live
+    started = time.perf_counter()
+    await asyncio.to_thread(render_queue.flush)
+    with Live(tool_dashboard(tool_uses, tasks, started), console=console, refresh_per_second=8) as live:
+        pending = set(tasks)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=0.125)
+            live.update(tool_dashboard(tool_uses, tasks, started))
+
+class TokenBucket:
+    # Reservations may overdraw the bucket; the caller waits until the debt has refilled
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+class RequestScheduler:
+    # Every API call goes through here: token buckets for requests/min and tokens/min, a shared
+    # concurrency limit, and retries with retry-after or capped, jittered exponential backoff.
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrent):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.slot_waiters = []  # (loop, future) of async callers waiting for a slot
+        self.blocked_until = 0.0
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "overloaded": 0, "server_errors": 0, "connection_errors": 0, "wait_seconds": 0.0}
+
+    def admission_delay(self, estimated_tokens):
+        delay = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        with self.lock:
+            delay = max(delay, self.blocked_until - time.monotonic())
+            self.stats["wait_seconds"] += max(delay, 0.0)
+        return delay
+
+    def settle(self, response, estimated_tokens):
+        usage = getattr(response, "usage", None)
+        with self.lock:
+            self.stats["requests"] += 1
+        if usage is not None:
+            actual = (usage.input_tokens or 0) + (getattr(usage, "cache_creation_input_tokens", None) or 0) + (usage.output_tokens or 0)
+            self.tokens.adjust(actual - estimated_tokens)
+
+    def retry_delay(self, error, attempt):
+        if isinstance(error, anthropic_sdk().APIStatusError):
+            status = error.status_code
+            if status == 429:
+                reason = "rate_limited"
+            elif status == 529 or "overloaded" in str(error).lower():
+                reason = "overloaded"
+            elif status >= 500 or status == 408:
+                reason = "server_errors"
+            else:
+                return None
+        elif isinstance(error, anthropic_sdk().APIConnectionError):
+            reason = "connection_errors"
+        else:
+            return None
+        if attempt >= RETRY_MAX_ATTEMPTS:
+            return None
+
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        retry_after = headers.get("retry-after-ms") or headers.get("retry-after")
+        if retry_after:
+            try:
+                seconds = float(retry_after) / (1000 if headers.get("retry-after-ms") else 1)
+                delay = min(RETRY_MAX_DELAY, seconds) + random.uniform(0, 0.5)
+            except ValueError:
+                pass
+
+        with self.lock:
+            self.stats[reason] += 1
+            self.stats["retries"] += 1
+            if reason == "rate_limited":
+                # Hold back every session, not just the one that was throttled
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        session = current_session.get()
+        if session is None or session.render:
+            console.print(Panel(f"{reason.replace('_', ' ').capitalize()}: {str(error)[:200]}\nRetrying in {delay:.1f}s (attempt {attempt + 1} of {RETRY_MAX_ATTEMPTS})...", title="API Error", style="bold yellow"))
+        return delay
+
+    def release_slot(self):
+        # Threads blocked in acquire wake on the semaphore itself; event loops are woken through their futures
+        self.slots.release()
+        with self.lock:
+            waiters, self.slot_waiters = self.slot_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+            except RuntimeError:
+                pass  # that loop has closed
+
+    async def acquire_slot_async(self):
+        # The try and the registration share the lock with release_slot's hand-off, so no wake-up is lost
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.slots.acquire(blocking=False):
+                    return
+                waiter = loop.create_future()
+                self.slot_waiters.append((loop, waiter))
+            await waiter
+
+    def call(self, send, estimated_tokens, retryable=None):
+        attempt = 0
+        while True:
+            delay = self.admission_delay(estimated_tokens)
+            if delay > 0:
+                time.sleep(delay)
+            self.slots.acquire()
+            try:
+                response = send()
+                self.settle(response, estimated_tokens)
+                return response
+            except Exception as e:
+                delay = self.retry_delay(e, attempt) if retryable is None or retryable() else None
+                if delay is None:
+                    raise
+            finally:
+                self.release_slot()
+            attempt += 1
+            time.sleep(delay)
+
+    async def call_async(self, send, estimated_tokens, retryable=None):
+        attempt = 0
+        while True:
+            delay = self.admission_delay(estimated_tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.acquire_slot_async()
+            try:
+                response = await send()
+                self.settle(response, estimated_tokens)
+                return response
+            except Exception as e:
+                delay = self.retry_delay(e, attempt) if retryable is None or retryable() else None
+                if delay is None:
+                    raise
+            finally:
+                self.release_slot()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+scheduler = RequestScheduler(RATE_LIMIT_REQUESTS_PER_MINUTE, RATE_LIMIT_TOKENS_PER_MINUTE, MAX_CONCURRENT_REQUESTS)
+
+# Every tool is declared once with register_tool: the declaration provides the schema sent to the API
+# (in registration order, in `tools`), a validator compiled from that schema and the dispatch entry.
+tools = []
+tool_registry = {}
+
+JSON_SCHEMA_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "array": (list,),
+    "object": (dict,),
+}
+
+def compile_schema_check(label, schema):
+    # Returns a function that checks one value against a (sub)schema and returns an error message or None
+    expected = JSON_SCHEMA_TYPES.get(schema.get("type"))
+    enum = schema.get("enum")
+    item_check = compile_schema_check(f"items of {label}", schema["items"]) if "items" in schema else None
+    property_checks = [(key, compile_schema_check(f"{key} in {label}", prop)) for key, prop in schema.get("properties", {}).items()]
+    required = schema.get("required", [])
+
+    def check(value):
+        if expected is not None and (not isinstance(value, expected) or (isinstance(value, bool) and bool not in expected)):
+            return f"Parameter {label} must be of type {schema['type']}"
+        if enum is not None and value not in enum:
+            return f"Parameter {label} must be one of {', '.join(map(str, enum))}"
+        if item_check is not None:
+            for item in value:
+                error = item_check(item)
+                if error:
+                    return error
+        if isinstance(value, dict):
+            for key in required:
+                if key not in value:
+                    return f"Missing required parameter '{key}' in {label}"
+            for key, property_check in property_checks:
+                if key in value:
+                    error = property_check(value[key])
+                    if error:
+                        return error
+        return None
+    return check
+
+def compile_tool_validator(schema):
+    # Checks are built once per tool; validate() returns (arguments, error) with schema defaults filled in
+    # and unknown parameters dropped
+    properties = schema.get("properties", {})
+    required = schema.get("required", [])
+    checks = [(key, compile_schema_check(f"'{key}'", prop)) for key, prop in properties.items()]
+    defaults = {key: prop["default"] for key, prop in properties.items() if "default" in prop}
+
+    def validate(tool_input):
+        if not isinstance(tool_input, dict):
+            return None, "Input must be an object"
+        for key in required:
+            if key not in tool_input:
+                return None, f"Missing required parameter '{key}'"
+        arguments = dict(defaults)
+        for key, check in checks:
+            if key in tool_input and tool_input[key] is not None:
+                error = check(tool_input[key])
+                if error:
+                    return None, error
+                arguments[key] = tool_input[key]
+        return arguments, None
+    return validate
+
+class ToolError(str):
+    # A tool result that reports a failure. Follow-up routing, the tool dashboard and the is_error flag
+    # of the tool_result go by this type, never by the wording of the result.
+    pass
+
+def register_tool(description, properties, required=(), name=None, handler=None):
+    # Used as a decorator on the tool function, or called with handler="module:function" to add a plugin
+    # tool whose module is only imported the first time the tool is called
+    def register(target):
+        tool_name = name or (target.rpartition(":")[2] if isinstance(target, str) else target.__name__)
+        schema = {"type": "object", "properties": properties}
+        if required:
+            schema["required"] = list(required)
+        tools[:] = [tool for tool in tools if tool["name"] != tool_name]
+        tools.append({"name": tool_name, "description": description, "input_schema": schema})
+        tool_registry[tool_name] = {"handler": target, "schema": schema, "validate": compile_tool_validator(schema)}
+        return target
+    return register if handler is None else register(handler)
+
+def resolve_tool_handler(spec):
+    handler = spec["handler"]
+    if isinstance(handler, str):
+        module_name, _, attribute = handler.partition(":")
+        handler = spec["handler"] = getattr(importlib.import_module(module_name), attribute)
+    return handler
+
+@register_tool(
+    description="Create a new folder at the specified path. Use this when you need to create a new directory in the project structure.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The path where the folder should be created"
+        }
+    },
+    required=["path"]
+)
 def create_folder(path):
     try:
         os.makedirs(path, exist_ok=True)
-        return f"Folder created: {path}"
+        invalidate_tree_snapshots(path)
+        return f"Folder created: {display_path(path)}"
     except Exception as e:
-        return f"Error creating folder: {str(e)}"
+        return ToolError(f"Error creating folder: {str(e)}")
 
+@register_tool(
+    description="Create a new file at the specified path with content. Use this when you need to create a new file in the project structure.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The path where the file should be created"
+        },
+        "content": {
+            "type": "string",
+            "description": "The content of the file"
+        }
+    },
+    required=["path", "content"]
+)
 def create_file(path, content=""):
     try:
-        with open(path, 'w') as f:
-            f.write(content)
-        return f"File created: {path}"
+        atomic_write(path, content)
+        return f"File created: {display_path(path)}"
     except Exception as e:
-        return f"Error creating file: {str(e)}"
+        return ToolError(f"Error creating file: {str(e)}")
 
 def highlight_diff(diff_text):
+    from rich.syntax import Syntax
     return Syntax(diff_text, "diff", theme="monokai", line_numbers=True)
 
-def generate_and_apply_diff(original_content, new_content, path):
-    diff = list(difflib.unified_diff(
-        original_content.splitlines(keepends=True),
-        new_content.splitlines(keepends=True),
-        fromfile=f"a/{path}",
-        tofile=f"b/{path}",
-        n=3
-    ))
+def myers_matches(a, alo, ahi, b, blo, bhi, max_cost):
+    # Greedy O(ND) Myers diff of a[alo:ahi] against b[blo:bhi]; returns the matched (i, j) pairs in
+    # order, or None when the edit distance is above max_cost
+    n, m = ahi - alo, bhi - blo
+    max_d = min(n + m, max_cost)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return myers_backtrack(trace, n, m, alo, blo)
+    return None
 
-    if not diff:
-        return "No changes detected."
+def myers_backtrack(trace, x, y, alo, blo):
+    matches = []
+    for d in range(len(trace) - 1, -1, -1):
+        # trace[d] holds v[-d-1 .. d+1] as it was before step d
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1 + d + 1] < v[k + 1 + d + 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = v[previous_k + d + 1]
+        previous_y = previous_x - previous_k
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+            matches.append((alo + x, blo + y))
+        x, y = previous_x, previous_y
+    matches.reverse()
+    return matches
 
-    try:
-        with open(path, 'w') as f:
-            f.writelines(new_content)
+def unique_anchors(a, alo, ahi, b, blo, bhi):
+    # Patience anchors: lines occurring exactly once on each side, kept in the longest run that is in
+    # order on both sides
+    counts = {}
+    for i in range(alo, ahi):
+        entry = counts.get(a[i])
+        counts[a[i]] = [1, i, -1] if entry is None else [entry[0] + 1, i, -1]
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] = j if entry[2] == -1 else -2
+    candidates = sorted((i, j) for count, i, j in counts.values() if count == 1 and j >= 0)
+    if not candidates:
+        return []
+    # Longest increasing subsequence of j by patience sorting
+    tops, top_indexes, previous = [], [], []
+    for index, (i, j) in enumerate(candidates):
+        pile = bisect.bisect_left(tops, j)
+        if pile == len(tops):
+            tops.append(j)
+            top_indexes.append(index)
+        else:
+            tops[pile] = j
+            top_indexes[pile] = index
+        previous.append(top_indexes[pile - 1] if pile else None)
+    anchors = []
+    index = top_indexes[-1]
+    while index is not None:
+        anchors.append(candidates[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
 
-        diff_text = ''.join(diff)
-        highlighted_diff = highlight_diff(diff_text)
+def matching_pairs(a, b):
+    # Matched (i, j) line pairs of two sequences of interned lines, in order
+    matches = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            previous_i, previous_j = alo, blo
+            for i, j in anchors:
+                matches.append((i, j))
+                stack.append((previous_i, i, previous_j, j))
+                previous_i, previous_j = i + 1, j + 1
+            stack.append((previous_i, ahi, previous_j, bhi))
+        else:
+            # Only repeated lines left (blank lines, braces...): Myers, or a plain replacement when the sides
+            # share nothing or even the lower bound on the edit distance is too costly. The budget leaves
+            # room for matching half the shared lines, so a gap sharing a few blank lines stays cheap.
+            shared = sum((Counter(a[alo:ahi]) & Counter(b[blo:bhi])).values())
+            lower_bound = (ahi - alo) + (bhi - blo) - 2 * shared
+            if shared and lower_bound <= DIFF_MYERS_MAX_COST:
+                budget = min(DIFF_MYERS_MAX_COST, lower_bound + shared)
+                matches.extend(myers_matches(a, alo, ahi, b, blo, bhi, budget) or ())
+    matches.sort()
+    return matches
 
-        diff_panel = Panel(
-            highlighted_diff,
-            title=f"Changes in {path}",
-            expand=False,
-            border_style="cyan"
-        )
+def diff_opcodes(matches, a_length, b_length):
+    # SequenceMatcher-style (tag, i1, i2, j1, j2) opcodes from the matched pairs
+    opcodes = []
+    i = j = 0
+    for mi, mj in matches + [(a_length, b_length)]:
+        if i < mi or j < mj:
+            tag = "replace" if i < mi and j < mj else "delete" if i < mi else "insert"
+            opcodes.append((tag, i, mi, j, mj))
+        if mi < a_length:
+            if opcodes and opcodes[-1][0] == "equal" and opcodes[-1][2] == mi:
+                opcodes[-1] = ("equal", opcodes[-1][1], mi + 1, opcodes[-1][3], mj + 1)
+            else:
+                opcodes.append(("equal", mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return opcodes
 
-        console.print(diff_panel)
+def grouped_opcodes(opcodes, context):
+    # Hunks of changes with up to `context` equal lines around them (as difflib's get_grouped_opcodes)
+    if not opcodes:
+        return []
+    if opcodes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if opcodes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    groups, group = [], []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    return groups
 
-        added_lines = sum(1 for line in diff if line.startswith('+') and not line.startswith('+++'))
-        removed_lines = sum(1 for line in diff if line.startswith('-') and not line.startswith('---'))
+def unified_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1 if length else start},{length}"
 
-        summary = f"Changes applied to {path}:\n"
+def count_lines(text):
+    return text.count("\n") + (bool(text) and not text.endswith("\n"))
+
+def changed_line_counts(original_content, new_content):
+    # (added, removed) lines between the common leading and trailing lines, found by comparing the strings
+    # themselves (binary search over slices) instead of splitting huge files into lines
+    limit = min(len(original_content), len(new_content))
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if original_content[:middle] == new_content[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    start = original_content.rfind("\n", 0, low) + 1
+    low, high = 0, limit - start
+    while low < high:
+        middle = (low + high + 1) // 2
+        if original_content[len(original_content) - middle:] == new_content[len(new_content) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    # The common suffix only counts from the first line that starts inside it on both sides
+    end = len(original_content) - low
+    new_end = len(new_content) - low
+    if (end > start and original_content[end - 1] != "\n") or (new_end > start and new_content[new_end - 1] != "\n"):
+        newline = original_content.find("\n", end)
+        end = len(original_content) if newline == -1 else newline + 1
+        new_end = end + len(new_content) - len(original_content)
+    return count_lines(new_content[start:new_end]), count_lines(original_content[start:end])
+
+def line_diff(original_content, new_content):
+    # Returns (old lines, new lines, opcodes, added, removed). Lines are interned to ints so comparisons
+    # are cheap; above DIFF_MAX_BYTES only the changed line counts are found and the rest is None.
+    if len(original_content) + len(new_content) > DIFF_MAX_BYTES:
+        return (None, None, None) + changed_line_counts(original_content, new_content)
+    a_lines = original_content.splitlines(keepends=True)
+    b_lines = new_content.splitlines(keepends=True)
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a_lines]
+    b = [ids.setdefault(line, len(ids)) for line in b_lines]
+    matches = matching_pairs(a, b)
+    return a_lines, b_lines, diff_opcodes(matches, len(a), len(b)), len(b) - len(matches), len(a) - len(matches)
+
+def file_diff(original_content, new_content, path, context=DIFF_CONTEXT_LINES):
+    # Returns (unified diff text, lines added, lines removed); the text is "" when nothing changed and a
+    # one-hunk summary for files too big to diff line by line
+    a_lines, b_lines, opcodes, added, removed = line_diff(original_content, new_content)
+    if not added and not removed:
+        return "", 0, 0
+    output = [f"--- a/{path}\n", f"+++ b/{path}\n"]
+    if opcodes is None:
+        output.append(f"@@ {count_lines(original_content)} -> {count_lines(new_content)} lines; too large for a line diff, {removed} lines replaced by {added} @@\n")
+        return "".join(output), added, removed
+    for group in grouped_opcodes(opcodes, context):
+        output.append(f"@@ -{unified_range(group[0][1], group[-1][2])} +{unified_range(group[0][3], group[-1][4])} @@\n")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                output.extend(" " + line for line in a_lines[i1:i2])
+                continue
+            output.extend("-" + line for line in a_lines[i1:i2])
+            output.extend("+" + line for line in b_lines[j1:j2])
+    # Lines without a trailing newline get the marker diff and patch use
+    return "".join(line if line.endswith("\n") else line + "\n\\ No newline at end of file\n" for line in output), added, removed
+
+def generate_and_apply_diff(original_content, new_content, path):
+    with metrics.span("diff", path=path):
+        diff_text, added_lines, removed_lines = file_diff(original_content, new_content, display_path(path))
+
+    if not diff_text:
+        return "No changes detected."
+
+    try:
+        atomic_write(path, new_content)
+
+        session = current_session.get()
+        if session is None or session.render:
+            render_queue.put(preview_panel(diff_text, f"Changes in {display_path(path)}", lexer="diff", expand=False, border_style="cyan"))
+
+        summary = f"Changes applied to {display_path(path)}:\n"
         summary += f"  Lines added: {added_lines}\n"
         summary += f"  Lines removed: {removed_lines}\n"
 
@@ -195,355 +1664,2758 @@ def generate_and_apply_diff(original_content, new_content, path):
             style="bold red"
         )
         console.print(error_panel)
-        return f"Error applying changes: {str(e)}"
+        return ToolError(f"Error applying changes: {str(e)}")
 
 
 
 # Update the edit_file function
+@register_tool(
+    description="Apply changes to a file. Use this when you need to edit an existing file. YOU ALWAYS PROVIDE THE FULL FILE CONTENT WHEN EDITING. NO PARTIAL CONTENT OR COMMENTS. YOU MUST PROVIDE THE FULL FILE CONTENT.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The path of the file to edit"
+        },
+        "new_content": {
+            "type": "string",
+            "description": "The new content to apply to the file"
+        }
+    },
+    required=["path", "new_content"]
+)
 def edit_and_apply(path, new_content):
     try:
         with open(path, 'r') as file:
             original_content = file.read()
         
         if new_content != original_content:
-            diff_result = generate_and_apply_diff(original_content, new_content, path)
-            return f"Changes applied to {path}:\n{diff_result}"
+            # Already headed "Changes applied to ..." on success; an error has to reach the model unwrapped
+            return generate_and_apply_diff(original_content, new_content, path)
         else:
-            return f"No changes needed for {path}"
+            return f"No changes needed for {display_path(path)}"
     except Exception as e:
-        return f"Error editing/applying to file: {str(e)}"
+        return ToolError(f"Error editing/applying to file: {str(e)}")
 
-def read_file(path):
+def atomic_write(path, content):
+    # Write to a temp file in the same directory, fsync it and rename it over the target, so a crash
+    # leaves either the old or the new file and never a truncated one
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
     try:
-        with open(path, 'r') as f:
-            content = f.read()
-        return content
-    except Exception as e:
-        return f"Error reading file: {str(e)}"
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    fsync_directory(directory)
+    on_file_written(path)
 
-def list_files(path="."):
-    try:
-        files = os.listdir(path)
-        return "\n".join(files)
-    except Exception as e:
-        return f"Error listing files: {str(e)}"
+def on_file_written(path):
+    # Keep derived state in sync with files written by our own tools
+    forget_file_reads(path)
+    update_search_index(path)
+    invalidate_tree_snapshots(path)
+    schedule_outline_refresh(path)
 
-def tavily_search(query):
-    try:
-        response = tavily.qna_search(query=query, search_depth="advanced")
-        return response
-    except Exception as e:
-        return f"Error performing search: {str(e)}"
-
-tools = [
-    {
-        "name": "create_folder",
-        "description": "Create a new folder at the specified path. Use this when you need to create a new directory in the project structure.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "path": {
-                    "type": "string",
-                    "description": "The path where the folder should be created"
-                }
-            },
-            "required": ["path"]
-        }
-    },
-    {
-        "name": "create_file",
-        "description": "Create a new file at the specified path with content. Use this when you need to create a new file in the project structure.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "path": {
-                    "type": "string",
-                    "description": "The path where the file should be created"
-                },
-                "content": {
-                    "type": "string",
-                    "description": "The content of the file"
-                }
-            },
-            "required": ["path", "content"]
-        }
-    },
-    {
-        "name": "search_file",
-        "description": "Search for a specific pattern in a file and return the line numbers where the pattern is found. Use this to locate specific code or text within a file.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "path": {
-                    "type": "string",
-                    "description": "The path of the file to search"
+def normalize_line(line):
+    return " ".join(line.split())
+
+def find_anchor(lines, search_lines, hint=None):
+    # Locate search_lines in lines: exact, then whitespace-insensitive, then by similarity.
+    # When several places match, the one closest to hint wins.
+    size = len(search_lines)
+    if size == 0 or size > len(lines):
+        return None
+
+    def closest(candidates):
+        if not candidates:
+            return None
+        if hint is None:
+            return candidates[0] if len(candidates) == 1 else None
+        return min(candidates, key=lambda start: abs(start - hint))
+
+    exact = [i for i in range(len(lines) - size + 1) if lines[i:i + size] == search_lines]
+    if exact:
+        return closest(exact)
+
+    normalized_lines = [normalize_line(line) for line in lines]
+    normalized_search = [normalize_line(line) for line in search_lines]
+    loose = [i for i in range(len(lines) - size + 1) if normalized_lines[i:i + size] == normalized_search]
+    if loose:
+        return closest(loose)
+
+    target = "\n".join(normalized_search)
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    matcher.set_seq2(target)
+    best_start, best_ratio = None, FUZZY_MATCH_THRESHOLD
+    for i in range(len(lines) - size + 1):
+        matcher.set_seq1("\n".join(normalized_lines[i:i + size]))
+        if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+            continue
+        ratio = matcher.ratio()
+        if ratio > best_ratio or (ratio == best_ratio and best_start is not None and hint is not None and abs(i - hint) < abs(best_start - hint)):
+            best_start, best_ratio = i, ratio
+    return best_start
+
+def parse_unified_diff(diff_text):
+    hunks = []
+    current = None
+    remaining = 0
+    lines = diff_text.splitlines()
+    for number, line in enumerate(lines):
+        header = re.match(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@', line)
+        if header:
+            # An empty old range ("-5,0") names the line the insertion goes after, not the first line replaced
+            start = int(header.group(1)) if header.group(2) == "0" else max(int(header.group(1)) - 1, 0)
+            current = {"start": start, "old": [], "new": []}
+            hunks.append(current)
+            remaining = int(header.group(2) or 1) + int(header.group(3) or 1)
+            continue
+        if current is not None and line.startswith(('--- ', '+++ ', 'index ')):
+            # "--- -- comment" inside a hunk removes a line; it only starts a new file once the hunk's ranges
+            # are used up, or when the header pair is plainly followed by a hunk header
+            after = lines[number + 1:number + 3]
+            if remaining <= 0 or (len(after) == 2 and line.startswith('--- ') and after[0].startswith('+++ ') and after[1].startswith('@@')):
+                current = None
+        if line.startswith('diff '):
+            current = None
+        if current is None or line.startswith('\\'):
+            continue
+        elif line.startswith('-'):
+            current["old"].append(line[1:])
+            remaining -= 1
+        elif line.startswith('+'):
+            current["new"].append(line[1:])
+            remaining -= 1
+        else:
+            context = line[1:] if line.startswith(' ') else line
+            current["old"].append(context)
+            current["new"].append(context)
+            remaining -= 2
+    return hunks
+
+def apply_hunks(content, hunks):
+    lines = content.split("\n")
+    offset = 0
+    for number, hunk in enumerate(hunks, 1):
+        hint = hunk["start"] + offset
+        if not hunk["old"]:
+            position = min(hint, len(lines))
+        else:
+            position = find_anchor(lines, hunk["old"], hint)
+            if position is None:
+                raise ValueError(f"hunk {number} could not be located")
+        lines[position:position + len(hunk["old"])] = hunk["new"]
+        offset += len(hunk["new"]) - len(hunk["old"])
+    return "\n".join(lines)
+
+def apply_search_replace(content, edits):
+    for number, edit in enumerate(edits, 1):
+        search, replace = edit["search"], edit["replace"]
+        if not search:
+            raise ValueError(f"edit {number} has an empty search block")
+        occurrences = content.count(search)
+        if occurrences == 1:
+            content = content.replace(search, replace, 1)
+            continue
+        if occurrences > 1:
+            raise ValueError(f"edit {number} matches {occurrences} places; include more surrounding lines")
+        lines = content.split("\n")
+        search_lines = search.strip("\n").split("\n")
+        position = find_anchor(lines, search_lines)
+        if position is None:
+            raise ValueError(f"edit {number} could not be located")
+        lines[position:position + len(search_lines)] = replace.strip("\n").split("\n")
+        content = "\n".join(lines)
+    return content
+
+@register_tool(
+    description="Apply targeted changes to an existing file without resending its full content. Provide either a list of search/replace edits or unified diff hunks. Search text is matched exactly when possible, otherwise whitespace-insensitively or by close similarity. Prefer this over edit_and_apply for small changes to large files.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The path of the file to patch"
+        },
+        "edits": {
+            "type": "array",
+            "description": "Search/replace edits applied in order. Each search block should include enough surrounding lines to be unique.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "search": {
+                        "type": "string",
+                        "description": "The existing text to replace"
+                    },
+                    "replace": {
+                        "type": "string",
+                        "description": "The text to put in its place"
+                    }
                 },
-                "search_pattern": {
-                    "type": "string",
-                    "description": "The pattern to search for in the file"
-                }
-            },
-            "required": ["path", "search_pattern"]
-        }
-    },
-    {
-    "name": "edit_and_apply",
-    "description": "Apply changes to a file. Use this when you need to edit an existing file. YOU ALWAYS PROVIDE THE FULL FILE CONTENT WHEN EDITING. NO PARTIAL CONTENT OR COMMENTS. YOU MUST PROVIDE THE FULL FILE CONTENT.",
-    "input_schema": {
-        "type": "object",
-        "properties": {
-            "path": {
-                "type": "string",
-                "description": "The path of the file to edit"
-            },
-            "new_content": {
-                "type": "string",
-                "description": "The new content to apply to the file"
+                "required": [
+                    "search",
+                    "replace"
+                ]
             }
         },
-        "required": ["path", "new_content"]
-    }
-},
-    {
-        "name": "read_file",
-        "description": "Read the contents of a file at the specified path. Use this when you need to examine the contents of an existing file.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "path": {
-                    "type": "string",
-                    "description": "The path of the file to read"
-                }
-            },
-            "required": ["path"]
-        }
-    },
-    {
-        "name": "list_files",
-        "description": "List all files and directories in the specified folder. Use this when you need to see the contents of a directory.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "path": {
-                    "type": "string",
-                    "description": "The path of the folder to list (default: current directory)"
-                }
-            }
+        "diff": {
+            "type": "string",
+            "description": "Unified diff hunks (with @@ headers) to apply to the file"
         }
     },
-    {
-        "name": "tavily_search",
-        "description": "Perform a web search using Tavily API to get up-to-date information or additional context. Use this when you need current information or feel a search could provide a better answer.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "query": {
-                    "type": "string",
-                    "description": "The search query"
-                }
-            },
-            "required": ["query"]
-        }
-    }
-]
-
-# Update the execute_tool function
-def execute_tool(tool_name, tool_input):
+    required=["path"]
+)
+def patch_file(path, edits=None, diff=None):
     try:
-        if tool_name == "create_folder":
-            return create_folder(tool_input["path"])
-        elif tool_name == "create_file":
-            return create_file(tool_input["path"], tool_input.get("content", ""))
-        elif tool_name == "edit_and_apply":
-            return edit_and_apply(tool_input["path"], tool_input.get("new_content"))
-        elif tool_name == "read_file":
-            return read_file(tool_input["path"])
-        elif tool_name == "list_files":
-            return list_files(tool_input.get("path", "."))
-        elif tool_name == "tavily_search":
-            return tavily_search(tool_input["query"])
-        else:
-            return f"Unknown tool: {tool_name}"
-    except KeyError as e:
-        return f"Error: Missing required parameter {str(e)} for tool {tool_name}"
+        if not edits and not diff:
+            return ToolError("Error patching file: provide either edits or diff")
+        with open(path, 'r') as file:
+            original_content = file.read()
+
+        new_content = original_content
+        if edits:
+            new_content = apply_search_replace(new_content, edits)
+        if diff:
+            new_content = apply_hunks(new_content, parse_unified_diff(diff))
+
+        if new_content == original_content:
+            return f"No changes needed for {display_path(path)}"
+        return generate_and_apply_diff(original_content, new_content, path)
+    except ValueError as e:
+        return ToolError(f"Error patching file {display_path(path)}: {str(e)}")
     except Exception as e:
-        return f"Error executing tool {tool_name}: {str(e)}"
+        return ToolError(f"Error patching file: {str(e)}")
 
-def encode_image_to_base64(image_path):
+def fsync_directory(directory):
+    # Makes renames in the directory durable; not every platform can open a directory for this
     try:
-        with Image.open(image_path) as img:
-            max_size = (1024, 1024)
-            img.thumbnail(max_size, Image.DEFAULT_STRATEGY)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='JPEG')
-            return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-    except Exception as e:
-        return f"Error encoding image: {str(e)}"
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
-def parse_goals(response):
-    goals = re.findall(r'Goal \d+: (.+)', response)
-    return goals
+def write_synced(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
 
-def execute_goals(goals):
-    global automode
-    for i, goal in enumerate(goals, 1):
-        console.print(Panel(f"Executing Goal {i}: {goal}", title="Goal Execution", style="bold yellow"))
-        response, _ = chat_with_claude(f"Continue working on goal: {goal}")
-        if CONTINUATION_EXIT_PHRASE in response:
-            automode = False
-            console.print(Panel("Exiting automode.", title="Automode", style="bold green"))
-            break
+def content_hash(content):
+    return None if content is None else hashlib.sha256(content.encode('utf-8', 'surrogatepass')).hexdigest()
 
-def chat_with_claude(user_input, image_path=None, current_iteration=None, max_iterations=None):
-    global conversation_history, automode
+def read_text_or_none(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
 
-    current_conversation = []
+def count_changed_lines(original_content, new_content):
+    _, _, _, added, removed = line_diff(original_content or "", new_content or "")
+    return added, removed
 
-    if image_path:
-        console.print(Panel(f"Processing image at path: {image_path}", title_align="left", title="Image Processing", expand=False, style="yellow"))
-        image_base64 = encode_image_to_base64(image_path)
+class FileTransaction:
+    # A set of file changes applied all-or-nothing. The new contents and backups of the originals are
+    # written and fsynced under TRANSACTION_DIR/<id>/ first; writing transaction.json with status
+    # "prepared" is the commit point. Files are then replaced with atomic_write and the status becomes
+    # "committed". A crash after the commit point is rolled forward by recover_transactions on the next run,
+    # a crash before it leaves the tree untouched. Committed transactions can be rolled back from the backups.
+    def __init__(self, root, transaction_id=None, description=""):
+        self.root = root
+        self.id = transaction_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+        self.dir = os.path.join(root, self.id)
+        self.journal_path = os.path.join(self.dir, "transaction.json")
+        self.description = description
+        self.status = None
+        self.created = time.time()
+        self.files = []
+        self.owner = None
 
-        if image_base64.startswith("Error"):
-            console.print(Panel(f"Error encoding image: {image_base64}", title="Error", style="bold red"))
-            return "I'm sorry, there was an error processing the image. Please try again.", False
+    @classmethod
+    def load(cls, root, transaction_id):
+        transaction = cls(root, transaction_id)
+        with open(transaction.journal_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        transaction.description, transaction.status, transaction.created, transaction.files = state["description"], state["status"], state["created"], state["files"]
+        return transaction
 
-        image_message = {
-            "role": "user",
-            "content": [
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": image_base64
-                    }
+    def save(self, status):
+        self.status = status
+        state = {"id": self.id, "status": status, "created": self.created, "description": self.description, "files": self.files}
+        fd, temp_path = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.journal_path)
+        fsync_directory(self.dir)
+
+    def claim(self, directory=None):
+        # Takes the owner lock; False while another process, or another FileTransaction here, holds it
+        try:
+            owner = open(os.path.join(directory or self.dir, TRANSACTION_OWNER_FILE), "a+")
+        except FileNotFoundError:
+            return False  # pruned or discarded meanwhile
+        if not try_lock_file(owner):
+            owner.close()
+            return False
+        owner.seek(0)
+        owner.truncate()
+        owner.write(f"{os.getpid()}\n")
+        owner.flush()
+        self.owner = owner
+        return True
+
+    def release(self):
+        if self.owner is not None:
+            self.owner.close()
+            self.owner = None
+
+    def create(self):
+        # The directory is claimed under a temporary name and renamed into place, so recovery never finds
+        # a transaction directory that has no locked owner yet
+        os.makedirs(self.root, exist_ok=True)
+        claiming = tempfile.mkdtemp(prefix=".claim-", dir=self.root)
+        self.claim(claiming)
+        os.rename(claiming, self.dir)
+
+    def staged_path(self, entry, kind):
+        return os.path.join(self.dir, kind, str(entry["index"]))
+
+    def stage(self, changes):
+        # changes: [(path, original content or None, new content or None)]; None means absent / deleted
+        self.create()
+        for kind in ("staged", "backup"):
+            os.makedirs(os.path.join(self.dir, kind), exist_ok=True)
+        for index, (path, original_content, new_content) in enumerate(changes):
+            added, removed = count_changed_lines(original_content, new_content)
+            entry = {"index": index, "path": os.path.abspath(path), "display": display_path(path), "before": content_hash(original_content),
+                     "after": content_hash(new_content), "added": added, "removed": removed}
+            if original_content is not None:
+                write_synced(self.staged_path(entry, "backup"), original_content)
+                entry["mode"] = os.stat(path).st_mode & 0o7777
+            if new_content is not None:
+                write_synced(self.staged_path(entry, "staged"), new_content)
+            self.files.append(entry)
+        for kind in ("staged", "backup"):
+            fsync_directory(os.path.join(self.dir, kind))
+        self.save("prepared")
+
+    def replace_files(self, kind, content_key):
+        # Puts every file into the state recorded by content_key ("after" from staged, "before" from backup)
+        for entry in self.files:
+            if entry[content_key] is None:
+                if os.path.exists(entry["path"]):
+                    os.unlink(entry["path"])
+                    fsync_directory(os.path.dirname(entry["path"]))
+                    on_file_written(entry["path"])
+                continue
+            with open(self.staged_path(entry, kind), 'r') as f:
+                content = f.read()
+            if read_text_or_none(entry["path"]) == content:
+                continue
+            os.makedirs(os.path.dirname(entry["path"]), exist_ok=True)
+            atomic_write(entry["path"], content)
+            if entry.get("mode") is not None and kind == "backup":
+                os.chmod(entry["path"], entry["mode"])
+
+    def commit(self):
+        self.replace_files("staged", "after")
+        self.save("committed")
+
+    def conflicts(self):
+        # Files changed by something else since this transaction committed
+        return [entry["display"] for entry in self.files if content_hash(read_text_or_none(entry["path"])) != entry["after"]]
+
+    def rollback(self):
+        self.save("rolling_back")
+        self.replace_files("backup", "before")
+        self.save("rolled_back")
+
+    def summary(self):
+        lines = []
+        for entry in self.files:
+            if entry["before"] is None:
+                state = "created"
+            elif entry["after"] is None:
+                state = "deleted"
+            else:
+                state = "modified"
+            lines.append(f"  {entry['display']}: {state}, +{entry['added']} -{entry['removed']}")
+        return "\n".join(lines)
+
+def try_lock_file(handle):
+    # Non-blocking exclusive lock, held until the handle is closed or the process exits
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+def transaction_root():
+    return session_path(TRANSACTION_DIR)
+
+def list_transactions(root, orphans=None):
+    # Transactions with a journal, oldest first. A directory without one is another transaction still
+    # staging (or one that crashed while staging); its name is added to orphans when a list is given.
+    try:
+        names = [name for name in os.listdir(root) if not name.startswith(".") and os.path.isdir(os.path.join(root, name))]
+    except FileNotFoundError:
+        return []
+    transactions = []
+    for name in names:
+        try:
+            transactions.append(FileTransaction.load(root, name))
+        except (OSError, ValueError, KeyError):
+            if orphans is not None:
+                orphans.append(name)
+    return sorted(transactions, key=lambda transaction: transaction.created)
+
+def prune_transactions(root):
+    # Only finished transactions are removed; anything staging or mid-commit belongs to a live writer
+    finished = [transaction for transaction in list_transactions(root) if transaction.status in ("committed", "rolled_back")]
+    for transaction in finished[:-TRANSACTION_KEEP] if TRANSACTION_KEEP else finished:
+        if transaction.claim():
+            shutil.rmtree(transaction.dir, ignore_errors=True)
+            transaction.release()
+
+def recover_transactions(root=None):
+    # Finishes transactions whose owner crashed; those still owned by a live process are left to it
+    root = root or transaction_root()
+    recovered = []
+    orphans = []
+    transactions = list_transactions(root, orphans)
+    for name in orphans:
+        # Staging never reached the commit point; nothing in the tree was touched
+        orphan = FileTransaction(root, name)
+        if orphan.claim():
+            shutil.rmtree(orphan.dir, ignore_errors=True)
+            orphan.release()
+    for transaction in transactions:
+        if transaction.status not in ("prepared", "rolling_back") or not transaction.claim():
+            continue
+        try:
+            # The owner may have finished between listing and claiming
+            transaction.status = FileTransaction.load(root, transaction.id).status
+            with lock_files(entry["path"] for entry in transaction.files):
+                if transaction.status == "prepared":
+                    transaction.commit()
+                    recovered.append(f"{transaction.id}: committed")
+                elif transaction.status == "rolling_back":
+                    transaction.rollback()
+                    recovered.append(f"{transaction.id}: rolled back")
+        finally:
+            transaction.release()
+    return recovered
+
+def report_recovered_transactions():
+    recovered = recover_transactions()
+    if recovered:
+        console.print(Panel("Finished file transactions interrupted by the last run:\n" + "\n".join(recovered), title="Recovery", title_align="left", style="bold yellow"))
+
+def stage_batch_changes(changes):
+    # Computes the new content of every file before anything is written; later changes to the same
+    # path apply on top of earlier ones. Returns [(path, original, new)] in first-mention order.
+    originals, contents, order = {}, {}, []
+    for number, change in enumerate(changes, 1):
+        path = change["path"]
+        key = os.path.abspath(path)
+        if key not in originals:
+            originals[key] = contents[key] = read_text_or_none(path)
+            order.append((key, path))
+        current = contents[key]
+        try:
+            if change.get("delete"):
+                if current is None:
+                    raise ValueError("file does not exist")
+                contents[key] = None
+            elif change.get("content") is not None:
+                contents[key] = change["content"]
+            elif change.get("edits") or change.get("diff"):
+                if current is None:
+                    raise ValueError("file does not exist; use content to create it")
+                if change.get("edits"):
+                    current = apply_search_replace(current, change["edits"])
+                if change.get("diff"):
+                    current = apply_hunks(current, parse_unified_diff(change["diff"]))
+                contents[key] = current
+            else:
+                raise ValueError("provide content, edits, diff or delete")
+        except ValueError as e:
+            raise ValueError(f"change {number} ({display_path(path)}): {str(e)}")
+    return [(path, originals[key], contents[key]) for key, path in order if originals[key] != contents[key]]
+
+@register_tool(
+    description="Apply changes to many files in one call, all or nothing. Each change names a file and either its full new content (which also creates the file), search/replace edits, unified diff hunks, or delete. Nothing is written unless every change applies cleanly, and an interrupted commit is completed on the next start. Returns per-file line counts and a transaction id that rollback_transaction can undo. Prefer this over separate calls for refactors that touch several files.",
+    properties={
+        "changes": {
+            "type": "array",
+            "description": "The file changes, applied in order",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "path": {"type": "string", "description": "The path of the file to change"},
+                    "content": {"type": "string", "description": "The full new content of the file"},
+                    "edits": {
+                        "type": "array",
+                        "description": "Search/replace edits, as for patch_file",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "search": {"type": "string", "description": "The existing text to replace"},
+                                "replace": {"type": "string", "description": "The text to put in its place"}
+                            },
+                            "required": ["search", "replace"]
+                        }
+                    },
+                    "diff": {"type": "string", "description": "Unified diff hunks (with @@ headers) to apply to the file"},
+                    "delete": {"type": "boolean", "description": "Delete the file"}
                 },
-                {
-                    "type": "text",
-                    "text": f"User input for image: {user_input}"
-                }
-            ]
+                "required": ["path"]
+            }
+        },
+        "description": {
+            "type": "string",
+            "description": "A short description of the change, kept with the transaction"
         }
-        current_conversation.append(image_message)
-        console.print(Panel("Image message added to conversation history", title_align="left", title="Image Added", style="green"))
+    },
+    required=["changes"]
+)
+def batch_edit(changes, description=""):
+    try:
+        staged = stage_batch_changes(changes)
+    except Exception as e:
+        return ToolError(f"Error in batch edit, no files were changed: {str(e)}")
+    if not staged:
+        return "No changes needed."
+
+    root = transaction_root()
+    transaction = FileTransaction(root, description=description)
+    try:
+        try:
+            transaction.stage(staged)
+        except Exception as e:
+            shutil.rmtree(transaction.dir, ignore_errors=True)
+            return ToolError(f"Error in batch edit, no files were changed: {str(e)}")
+        try:
+            transaction.commit()
+        except Exception as e:
+            # Past the commit point: the journal lets recover_transactions finish it, roll back instead
+            transaction.rollback()
+            return ToolError(f"Error in batch edit, transaction {transaction.id} was rolled back: {str(e)}")
+    finally:
+        transaction.release()
+    prune_transactions(root)
+
+    session = current_session.get()
+    if session is None or session.render:
+        diff_text = "".join(file_diff(original or "", new or "", display_path(path))[0] for path, original, new in staged)
+        render_queue.put(preview_panel(diff_text, f"Transaction {transaction.id}: {len(staged)} files", lexer="diff", expand=False, border_style="cyan"))
+    return (f"Transaction {transaction.id} committed, {len(staged)} files changed:\n{transaction.summary()}\n"
+            f"Undo it with rollback_transaction (transaction_id {transaction.id}).")
+
+@register_tool(
+    description="Undo a transaction made by batch_edit, restoring every file it changed, created or deleted. Without a transaction_id the most recent committed transaction is rolled back. Files changed since the transaction are reported and left alone unless force is set.",
+    properties={
+        "transaction_id": {
+            "type": "string",
+            "description": "The id returned by batch_edit"
+        },
+        "force": {
+            "type": "boolean",
+            "description": "Restore files even if they were changed after the transaction",
+            "default": False
+        }
+    }
+)
+def rollback_transaction(transaction_id=None, force=False):
+    root = transaction_root()
+    committed = [transaction for transaction in list_transactions(root) if transaction.status == "committed"]
+    if transaction_id:
+        committed = [transaction for transaction in committed if transaction.id == transaction_id]
+    if not committed:
+        return ToolError(f"Error: no committed transaction {transaction_id or 'to roll back'}")
+    transaction = committed[-1]
+    if not transaction.claim():
+        return ToolError(f"Error: transaction {transaction.id} is in use by another process")
+    try:
+        with lock_files(entry["path"] for entry in transaction.files):
+            conflicts = transaction.conflicts()
+            if conflicts and not force:
+                return ToolError(f"Error: files changed since transaction {transaction.id}: {', '.join(conflicts)}. Set force to restore them anyway.")
+            transaction.rollback()
+    finally:
+        transaction.release()
+    return f"Transaction {transaction.id} rolled back, {len(transaction.files)} files restored:\n{transaction.summary()}"
+
+read_cache_lock = threading.Lock()
+read_cache = OrderedDict()
+# Reads whose results are in the committed history, and reads of the running turn, which only count once
+# the turn's history is committed (a cancelled or failed turn drops its tool results)
+read_history = {}
+pending_reads = {}
+
+def file_cache_key(stat):
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def line_offsets(data):
+    offsets = array('Q', [0])
+    for match in re.finditer(b"\n", data):
+        offsets.append(match.end())
+    if offsets[-1] != len(data):
+        offsets.append(len(data))
+    return offsets
+
+def load_cached_file(path):
+    stat = os.stat(path)
+    key = file_cache_key(stat)
+    with read_cache_lock:
+        entry = read_cache.get(path)
+        if entry and entry["key"] == key:
+            read_cache.move_to_end(path)
+            return entry
+
+    entry = {"key": key, "size": stat.st_size, "data": None, "offsets": None}
+    if stat.st_size >= READ_MMAP_THRESHOLD:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            entry["offsets"] = line_offsets(mapped)
     else:
-        current_conversation.append({"role": "user", "content": user_input})
+        with open(path, 'rb') as f:
+            entry["data"] = f.read()
 
-    messages = conversation_history + current_conversation
+    with read_cache_lock:
+        read_cache[path] = entry
+        read_cache.move_to_end(path)
+        while len(read_cache) > READ_CACHE_MAX_FILES:
+            read_cache.popitem(last=False)
+    return entry
+
+def read_byte_range(path, entry, start, end):
+    if entry["data"] is not None:
+        return entry["data"][start:end]
+    if entry["size"] == 0:
+        return b""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return mapped[start:end]
+
+def active_read_history():
+    # (committed, pending) read records of the current session, or of the sync REPL
+    session = current_session.get()
+    return (session.read_history, session.pending_reads) if session is not None else (read_history, pending_reads)
+
+def begin_file_reads():
+    # Called at the start of a turn: reads left pending by a turn that never committed are dropped
+    with read_cache_lock:
+        active_read_history()[1].clear()
+
+def commit_file_reads():
+    # Called with the turn's history commit: its read results are now in the history the model sees
+    with read_cache_lock:
+        committed, pending = active_read_history()
+        committed.update(pending)
+        pending.clear()
+
+def forget_file_reads(path=None):
+    with read_cache_lock:
+        if path is None:
+            for history in active_read_history():
+                history.clear()
+            return
+        path = os.path.abspath(path)
+        read_cache.pop(path, None)
+        histories = [read_history, pending_reads]
+        for session in list(live_sessions):
+            histories += [session.read_history, session.pending_reads]
+        for history in histories:
+            for request in [request for request in history if request[0] == path]:
+                del history[request]
+
+@register_tool(
+    description="Read the contents of a file at the specified path, optionally limited to a range of lines. Use this when you need to examine the contents of an existing file. If the file has not changed since you last read it, a short notice is returned instead of the contents.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The path of the file to read"
+        },
+        "start_line": {
+            "type": "integer",
+            "description": "First line to read, 1-based (default: start of file)"
+        },
+        "end_line": {
+            "type": "integer",
+            "description": "Last line to read, inclusive (default: end of file)"
+        },
+        "max_bytes": {
+            "type": "integer",
+            "description": "Maximum number of bytes to return; longer content is truncated at a line boundary"
+        }
+    },
+    required=["path"]
+)
+def read_file(path, start_line=None, end_line=None, max_bytes=None):
+    try:
+        abs_path = os.path.abspath(path)
+        entry = load_cached_file(abs_path)
+
+        request = (abs_path, start_line, end_line, max_bytes)
+        with read_cache_lock:
+            unchanged = any(history.get(request) == entry["key"] for history in active_read_history())
+        if unchanged:
+            return f"{READ_UNCHANGED_MARKER}: {display_path(path)}. Its contents are in the earlier read_file result.]"
+
+        header = ""
+        if start_line is not None or end_line is not None:
+            if entry["offsets"] is None:
+                entry["offsets"] = line_offsets(entry["data"])
+            total_lines = len(entry["offsets"]) - 1
+            first = max(int(start_line or 1), 1)
+            last = min(int(end_line or total_lines), total_lines)
+            if first > last:
+                return ToolError(f"Error reading file: line range {first}-{last} is outside {display_path(path)} ({total_lines} lines)")
+            data = read_byte_range(abs_path, entry, entry["offsets"][first - 1], entry["offsets"][last])
+            header = f"[Lines {first}-{last} of {total_lines} in {display_path(path)}]\n"
+        else:
+            data = read_byte_range(abs_path, entry, 0, entry["size"])
+
+        truncated = ""
+        if max_bytes is not None and len(data) > int(max_bytes):
+            cut = data.rfind(b"\n", 0, int(max_bytes)) + 1 or int(max_bytes)
+            truncated = f"\n[... truncated after {cut} of {len(data)} bytes; use start_line/end_line to read more]"
+            data = data[:cut]
+
+        content = data.decode('utf-8', errors='replace').replace("\r\n", "\n")
+        with read_cache_lock:
+            active_read_history()[1][request] = entry["key"]
+        return header + content + truncated
+    except Exception as e:
+        return ToolError(f"Error reading file: {str(e)}")
+
+tree_snapshot_lock = threading.Lock()
+tree_snapshots = OrderedDict()
+
+def gitignore_pattern_regex(pattern):
+    regex, i = "", 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            body = pattern[i + 1:end]
+            regex += "[" + ("^" + body[1:] if body.startswith("!") else body) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
 
+def load_gitignore(directory):
+    rules = []
     try:
-        response = client.messages.create(
-            model=MAINMODEL,
-            max_tokens=4000,
-            system=update_system_prompt(current_iteration, max_iterations),
-            messages=messages,
-            tools=tools,
-            tool_choice={"type": "auto"}
+        with open(os.path.join(directory, ".gitignore"), 'r', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        # A trailing slash only makes the pattern directory-only; a leading or inner one anchors it to this
+        # directory, so both are decided before the slashes are stripped
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        anchored = "/" in line
+        regex = gitignore_pattern_regex(line.lstrip("/"))
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        rules.append((directory, re.compile(regex + "$"), negate, dir_only))
+    return rules
+
+def is_gitignored(path, is_dir, rules):
+    ignored = False
+    for base, regex, negate, dir_only in rules:
+        if dir_only and not is_dir:
+            continue
+        relative = os.path.relpath(path, base).replace(os.sep, "/")
+        if regex.match(relative):
+            ignored = not negate
+    return ignored
+
+def gitignore_stat(directory):
+    # (mtime, size) of the directory's .gitignore, or None when it has none
+    try:
+        stat = os.stat(os.path.join(directory, ".gitignore"))
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def gitignore_ancestors(directory):
+    # Directories above the listed folder whose .gitignore still applies, up to the repository root
+    ancestors = []
+    current = directory
+    while not os.path.exists(os.path.join(current, ".git")):
+        parent = os.path.dirname(current)
+        if parent == current:
+            return []
+        ancestors.append(parent)
+        current = parent
+    return list(reversed(ancestors))
+
+def scan_tree(root, max_depth, max_entries):
+    # Entry names only: sizes and times change without touching the directory, so list_files stats them
+    # on every call. The .gitignore of every directory involved is recorded so in-place edits are noticed.
+    snapshot = {"entries": [], "dirs": {}, "gitignores": {}, "truncated": False}
+
+    def walk(directory, depth, rules):
+        try:
+            snapshot["dirs"][directory] = os.stat(directory).st_mtime_ns
+            snapshot["gitignores"][directory] = gitignore_stat(directory)
+            rules = rules + load_gitignore(directory)
+            with os.scandir(directory) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            if len(snapshot["entries"]) >= max_entries:
+                snapshot["truncated"] = True
+                return
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if entry.name == ".git" or (is_dir and entry.name in IGNORED_DIRS) or is_gitignored(entry.path, is_dir, rules):
+                continue
+            relative = os.path.relpath(entry.path, root).replace(os.sep, "/")
+            if is_dir:
+                relative += "/"
+            snapshot["entries"].append(relative)
+            if is_dir and depth < max_depth:
+                walk(entry.path, depth + 1, rules)
+
+    rules = []
+    for ancestor in gitignore_ancestors(root):
+        snapshot["gitignores"][ancestor] = gitignore_stat(ancestor)
+        rules += load_gitignore(ancestor)
+    walk(root, 1, rules)
+    return snapshot
+
+def snapshot_is_current(snapshot):
+    for directory, mtime in snapshot["dirs"].items():
+        try:
+            if os.stat(directory).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return all(gitignore_stat(directory) == stat for directory, stat in snapshot["gitignores"].items())
+
+def invalidate_tree_snapshots(path):
+    path = os.path.abspath(path)
+    with tree_snapshot_lock:
+        for key in [key for key in tree_snapshots if path == key[0] or path.startswith(key[0] + os.sep)]:
+            del tree_snapshots[key]
+
+def get_tree_snapshot(root, max_depth, max_entries):
+    key = (os.path.abspath(root), max_depth, max_entries)
+    with tree_snapshot_lock:
+        snapshot = tree_snapshots.get(key)
+    if snapshot is None or not snapshot_is_current(snapshot):
+        snapshot = scan_tree(key[0], max_depth, max_entries)
+    with tree_snapshot_lock:
+        tree_snapshots[key] = snapshot
+        tree_snapshots.move_to_end(key)
+        while len(tree_snapshots) > TREE_SNAPSHOT_CACHE_SIZE:
+            tree_snapshots.popitem(last=False)
+    return snapshot
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+@register_tool(
+    description="List all files and directories in the specified folder. Use this when you need to see the contents of a directory. Set recursive to get the whole project layout in a single call instead of listing folders one by one.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The path of the folder to list (default: current directory)",
+            "default": "."
+        },
+        "recursive": {
+            "type": "boolean",
+            "description": "List the whole tree below the folder, skipping .gitignored files and build/virtualenv directories (default: false)"
+        },
+        "max_depth": {
+            "type": "integer",
+            "description": "How many directory levels to descend when recursive (default: 4)"
+        },
+        "max_entries": {
+            "type": "integer",
+            "description": "Maximum number of entries to return (default: 500)"
+        },
+        "include_details": {
+            "type": "boolean",
+            "description": "Include file size and modification time for each entry (default: false)"
+        }
+    }
+)
+def list_files(path=".", recursive=False, max_depth=None, max_entries=None, include_details=False):
+    try:
+        if not recursive and not include_details:
+            files = os.listdir(path)
+            return "\n".join(files)
+
+        max_depth = max(int(max_depth or LIST_FILES_DEFAULT_DEPTH), 1) if recursive else 1
+        max_entries = int(max_entries or LIST_FILES_MAX_ENTRIES)
+        if not os.path.isdir(path):
+            return ToolError(f"Error listing files: {display_path(path)} is not a directory")
+        snapshot = get_tree_snapshot(path, max_depth, max_entries)
+
+        lines = []
+        for relative in snapshot["entries"]:
+            if not include_details:
+                lines.append(relative)
+                continue
+            try:
+                stat = os.stat(os.path.join(path, relative), follow_symlinks=False)
+            except OSError:
+                continue
+            size_text = "-" if relative.endswith("/") else format_size(stat.st_size)
+            lines.append(f"{relative}  ({size_text}, modified {time.strftime('%Y-%m-%d %H:%M', time.localtime(stat.st_mtime))})")
+        if snapshot["truncated"]:
+            lines.append(f"[... stopped after {max_entries} entries; list a subdirectory or lower max_depth to see more]")
+        return "\n".join(lines)
+    except Exception as e:
+        return ToolError(f"Error listing files: {str(e)}")
+
+search_index_lock = threading.RLock()
+search_index = {"files": {}, "trigrams": {}, "roots": {}}
+
+def extract_trigrams(text):
+    text = text.lower()
+    return set(map("".join, zip(text, text[1:], text[2:])))
+
+def read_indexable_text(path, stat):
+    if stat.st_size > SEARCH_INDEX_MAX_FILE_BYTES:
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b"\0" in data[:8192]:
+        return None
+    return data.decode('utf-8', errors='replace')
+
+def remove_from_search_index(path):
+    with search_index_lock:
+        entry = search_index["files"].pop(path, None)
+        if entry:
+            for trigram in entry[2]:
+                postings = search_index["trigrams"].get(trigram)
+                if postings is not None:
+                    postings.discard(path)
+                    if not postings:
+                        del search_index["trigrams"][trigram]
+
+def index_file(path, stat=None):
+    try:
+        stat = stat or os.stat(path)
+        with search_index_lock:
+            entry = search_index["files"].get(path)
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                return
+        text = read_indexable_text(path, stat)
+    except OSError:
+        remove_from_search_index(path)
+        return
+    trigrams = extract_trigrams(text) if text is not None else None
+    with search_index_lock:
+        remove_from_search_index(path)
+        search_index["files"][path] = (stat.st_mtime_ns, stat.st_size, trigrams or set(), trigrams is not None)
+        for trigram in trigrams or ():
+            search_index["trigrams"].setdefault(trigram, set()).add(path)
+
+def walk_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+def ensure_search_index(root):
+    # Every search walks the tree and compares each file's mtime and size with the index, so files created,
+    # changed or deleted outside our tools are caught before candidates are picked; only those are read
+    root = os.path.abspath(root)
+    seen = set()
+    for path in walk_files(root):
+        seen.add(path)
+        index_file(path)
+    with search_index_lock:
+        stale = [path for path in search_index["files"] if path.startswith(root + os.sep) and path not in seen]
+    for path in stale:
+        remove_from_search_index(path)
+    with search_index_lock:
+        search_index["roots"][root] = time.time()
+
+def update_search_index(path):
+    path = os.path.abspath(path)
+    with search_index_lock:
+        tracked = path in search_index["files"] or any(path.startswith(root + os.sep) for root in search_index["roots"])
+    if tracked and not any(part in IGNORED_DIRS for part in path.split(os.sep)):
+        index_file(path)
+
+def required_literals(pattern):
+    # Literal runs that every match must contain; None when the pattern cannot be narrowed down
+    if "|" in pattern.replace("\\|", ""):
+        return None
+    literals, current, depth, i = [], "", 0, 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            i += 2
+            if escaped.isalnum():
+                literals.append(current)
+                current = ""
+                continue
+            char = escaped
+        elif char == "[":
+            end = pattern.find("]", i + 2)
+            literals.append(current)
+            current = ""
+            i = end + 1 if end != -1 else len(pattern)
+            continue
+        elif char in "()":
+            depth += 1 if char == "(" else -1
+            literals.append(current)
+            current = ""
+            i += 1
+            continue
+        elif char in ".^$":
+            literals.append(current)
+            current = ""
+            i += 1
+            continue
+        elif char in "*?{":
+            # The previous character is optional or repeated, so it cannot be required
+            literals.append(current[:-1])
+            current = ""
+            i = pattern.find("}", i) + 1 if char == "{" and "}" in pattern[i:] else i + 1
+            continue
+        elif char == "+":
+            literals.append(current)
+            current = ""
+            i += 1
+            continue
+        else:
+            i += 1
+        if depth == 0:
+            current += char
+    literals.append(current)
+    return [literal for literal in literals if len(literal) >= 3]
+
+def candidate_files(root, pattern):
+    root = os.path.abspath(root)
+    literals = required_literals(pattern)
+    with search_index_lock:
+        files = search_index["files"]
+        candidates = {path for path, entry in files.items() if path.startswith(root + os.sep) and entry[3]}
+        for literal in literals or ():
+            for trigram in extract_trigrams(literal):
+                candidates &= search_index["trigrams"].get(trigram, set())
+                if not candidates:
+                    return []
+    return sorted(candidates)
+
+@register_tool(
+    description="Search for a regular expression across a file or a whole directory tree and return matching lines with file paths, line numbers and surrounding context. Use this to find where something is defined or used instead of reading whole files.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The file or directory to search (default: current directory)",
+            "default": "."
+        },
+        "search_pattern": {
+            "type": "string",
+            "description": "The regular expression to search for"
+        },
+        "context_lines": {
+            "type": "integer",
+            "description": "Number of context lines to show around each match (default: 2)"
+        },
+        "max_results": {
+            "type": "integer",
+            "description": "Maximum number of matches to return (default: 100)"
+        }
+    },
+    required=["search_pattern"]
+)
+def search_file(path, search_pattern, context_lines=2, max_results=SEARCH_MAX_RESULTS):
+    try:
+        try:
+            regex = re.compile(search_pattern)
+        except re.error:
+            regex = re.compile(re.escape(search_pattern))
+
+        if os.path.isdir(path):
+            ensure_search_index(path)
+            paths = candidate_files(path, regex.pattern)
+        elif os.path.isfile(path):
+            paths = [os.path.abspath(path)]
+        else:
+            return ToolError(f"Error searching files: {display_path(path)} does not exist")
+
+        output = []
+        matches = 0
+        matched_files = 0
+        for file_path in paths:
+            try:
+                with open(file_path, 'r', errors='replace') as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                continue
+            hits = [i for i, line in enumerate(lines) if regex.search(line)]
+            if not hits:
+                continue
+            matched_files += 1
+            shown_path = display_path(file_path)
+            last_printed = -1
+            for hit in hits:
+                if matches >= max_results:
+                    break
+                start = max(hit - context_lines, last_printed + 1)
+                if last_printed >= 0 and start > last_printed + 1:
+                    output.append("--")
+                for i in range(start, min(hit + context_lines, len(lines) - 1) + 1):
+                    if i <= last_printed:
+                        continue
+                    separator = ":" if regex.search(lines[i]) else "-"
+                    output.append(f"{shown_path}{separator}{i + 1}{separator}{lines[i]}")
+                    last_printed = i
+                matches += 1
+            if matches >= max_results:
+                output.append(f"... stopped after {max_results} matches")
+                break
+
+        if not matches:
+            return f"No matches found for '{search_pattern}' in {display_path(path)}"
+        return f"Found {matches} matches in {matched_files} files for '{search_pattern}':\n" + "\n".join(output)
+    except Exception as e:
+        return ToolError(f"Error searching files: {str(e)}")
+
+OUTLINE_LANGUAGES = {
+    ".py": "python", ".pyi": "python",
+    ".js": "javascript", ".jsx": "javascript", ".mjs": "javascript", ".cjs": "javascript", ".ts": "javascript", ".tsx": "javascript",
+    ".go": "go", ".rs": "rust",
+    ".java": "java", ".kt": "java", ".kts": "java", ".cs": "java", ".swift": "java", ".scala": "java",
+    ".c": "c", ".h": "c", ".cc": "c", ".cpp": "c", ".cxx": "c", ".hpp": "c", ".hh": "c",
+    ".rb": "ruby", ".php": "php",
+}
+
+# Declaration lines per language family for the regex scanner (everything but parseable Python)
+OUTLINE_PATTERNS = {
+    "python": [r"[ \t]*(?:async\s+)?def\s+\w+", r"[ \t]*class\s+\w+"],
+    "javascript": [
+        r"\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*\w+\s*[(<]",
+        r"\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?(?:class|interface|enum)\s+\w+",
+        r"\s*(?:export\s+)?type\s+\w+(?:<[^>]*>)?\s*=",
+        r"\s*(?:export\s+)?(?:const|let|var)\s+\w+\s*(?::[^=]+)?=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*(?::[^=]+)?=>|\w+\s*=>)",
+        r"\s+(?:(?:public|private|protected|static|async|readonly|override|get|set)\s+)*(?!(?:if|for|while|switch|catch|return|function)\b)\w+\s*\([^)]*\)\s*(?::\s*[^{]+)?\{\s*$",
+    ],
+    "go": [r"func\s+", r"type\s+\w+\s+(?:struct|interface)\b"],
+    "rust": [
+        r"\s*(?:pub(?:\([^)]*\))?\s+)?(?:const\s+)?(?:async\s+)?(?:unsafe\s+)?(?:extern\s+\"[^\"]*\"\s+)?fn\s+\w+",
+        r"\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait|union|mod)\s+\w+",
+        r"\s*(?:unsafe\s+)?impl\b",
+    ],
+    "java": [
+        r"\s*(?:(?:public|private|protected|internal|static|final|abstract|sealed|open|data|partial)\s+)*(?:class|interface|enum|record|struct|object|trait)\s+\w+",
+        r"\s*(?:(?:public|private|protected|internal|static|final|abstract|synchronized|native|override|virtual|async|open|suspend|inline)\s+)+[\w<>\[\],.?\s]*?\b\w+\s*\([^;]*$",
+        r"\s*(?:(?:public|private|protected|internal|open|override|static|final|class|suspend|inline|private\(set\))\s+)*(?:fun|func|def)\s+\w+",
+    ],
+    "c": [
+        r"(?:[\w*&:<>,]+\s+)+\**[\w:~]+\s*\([^;]*$",
+        r"\s*(?:typedef\s+)?(?:struct|class|enum|union|namespace)\s+\w+[^;]*$",
+    ],
+    "ruby": [r"\s*def\s+", r"\s*(?:class|module)\s+\w+"],
+    "php": [
+        r"\s*(?:(?:public|private|protected|static|abstract|final)\s+)*function\s+\w+",
+        r"\s*(?:(?:abstract|final)\s+)?(?:class|interface|trait|enum)\s+\w+",
+    ],
+}
+OUTLINE_REGEXES = {language: re.compile("^(?:" + "|".join(patterns) + ")") for language, patterns in OUTLINE_PATTERNS.items()}
+OUTLINE_STRIP_LITERALS = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|//.*|/\*.*?\*/|#.*')
+
+outline_cache_lock = threading.Lock()
+outline_cache_db = None
+outline_pool = None
+outline_pending = set()
+outline_counters = {"hits": 0, "rehashed": 0, "parsed": 0, "background": 0}
+
+def outline_language(path):
+    return OUTLINE_LANGUAGES.get(os.path.splitext(path)[1].lower())
+
+def outline_signature(text):
+    text = " ".join(text.split())
+    return text if len(text) <= OUTLINE_SIGNATURE_MAX_CHARS else text[:OUTLINE_SIGNATURE_MAX_CHARS] + "..."
+
+def python_outline(text):
+    # Symbols are [depth, start line, end line, signature]; a symbol's range includes its decorators
+    symbols = []
+
+    def visit(body, depth):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                bases = ", ".join(ast.unparse(base) for base in node.bases + node.keywords)
+                signature = f"class {node.name}({bases})" if bases else f"class {node.name}"
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                signature = f"{'async def' if isinstance(node, ast.AsyncFunctionDef) else 'def'} {node.name}({ast.unparse(node.args)})"
+                if node.returns is not None:
+                    signature += f" -> {ast.unparse(node.returns)}"
+            else:
+                # Definitions under "if TYPE_CHECKING:", try/except import fallbacks and the like
+                for field in ("body", "orelse", "finalbody"):
+                    visit(getattr(node, field, None) or [], depth)
+                for handler in getattr(node, "handlers", None) or []:
+                    visit(handler.body, depth)
+                continue
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            symbols.append([depth, start, node.end_lineno, outline_signature(signature)])
+            # Methods and nested classes are listed; functions local to a function are not
+            if isinstance(node, ast.ClassDef):
+                visit(node.body, depth + 1)
+
+    visit(ast.parse(text).body, 0)
+    return symbols
+
+def symbol_end(lines, start, language):
+    # Last line of the symbol declared on lines[start]: braces are matched for brace languages,
+    # indentation (and Ruby's "end") decides for the others
+    if language not in ("python", "ruby"):
+        depth, opened = 0, False
+        for i in range(start, len(lines)):
+            code = OUTLINE_STRIP_LITERALS.sub("", lines[i])
+            depth += code.count("{") - code.count("}")
+            opened = opened or "{" in code
+            if opened and depth <= 0:
+                return i + 1
+            if not opened and (code.rstrip().endswith(";") or i - start >= 3):
+                return start + 1
+        return len(lines)
+    indent = len(lines[start]) - len(lines[start].lstrip())
+    end = start
+    for i in range(start + 1, len(lines)):
+        stripped = lines[i].strip()
+        if not stripped:
+            continue
+        if len(lines[i]) - len(lines[i].lstrip()) <= indent:
+            return i + 1 if language == "ruby" and stripped == "end" else end + 1
+        end = i
+    return end + 1
+
+def regex_outline(text, language):
+    lines = text.splitlines()
+    regex = OUTLINE_REGEXES[language]
+    symbols, open_symbols = [], []
+    for i, line in enumerate(lines):
+        if not regex.match(line):
+            continue
+        start, end = i + 1, symbol_end(lines, i, language)
+        while open_symbols and open_symbols[-1] < start:
+            open_symbols.pop()
+        symbols.append([len(open_symbols), start, end, outline_signature(line.strip().rstrip("{").rstrip().rstrip(":"))])
+        open_symbols.append(end)
+    return symbols
+
+def build_outline(text, language):
+    if language == "python":
+        try:
+            return python_outline(text)
+        except (SyntaxError, ValueError, RecursionError):
+            pass
+    return regex_outline(text, language)
+
+def get_outline_cache_db():
+    global outline_cache_db
+    if outline_cache_db is None:
+        try:
+            os.makedirs(os.path.dirname(OUTLINE_CACHE_PATH), exist_ok=True)
+            outline_cache_db = sqlite3.connect(OUTLINE_CACHE_PATH, check_same_thread=False)
+        except (OSError, sqlite3.Error):
+            outline_cache_db = sqlite3.connect(":memory:", check_same_thread=False)
+        outline_cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS outlines ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT, outline TEXT, indexed REAL)"
         )
-    except APIStatusError as e:
-        if e.status_code == 429:
-            console.print(Panel("Rate limit exceeded. Retrying after a short delay...", title="API Error", style="bold yellow"))
-            time.sleep(5)
-            return chat_with_claude(user_input, image_path, current_iteration, max_iterations)
+        outline_cache_db.execute("CREATE INDEX IF NOT EXISTS outlines_indexed ON outlines (indexed)")
+        outline_cache_db.commit()
+    return outline_cache_db
+
+def outline_files(paths):
+    # Outlines ({"lines": n, "symbols": [...]}, or None for files that cannot be outlined) by absolute path.
+    # Unchanged files (same mtime and size) come straight from the index; files whose contents hash the same
+    # only have their stat refreshed; the rest are parsed and all updates are written in one commit.
+    paths = [os.path.abspath(path) for path in paths]
+    with outline_cache_lock:
+        db = get_outline_cache_db()
+        rows = {}
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            query = f"SELECT path, mtime_ns, size, hash, outline FROM outlines WHERE path IN ({','.join('?' * len(chunk))})"
+            rows.update((row[0], row[1:]) for row in db.execute(query, chunk))
+
+    outlines, updates = {}, []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            row = rows.get(path)
+            if row and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+                outlines[path] = json.loads(row[3])
+                outline_counters["hits"] += 1
+                continue
+            if stat.st_size > OUTLINE_MAX_FILE_BYTES:
+                outlines[path] = None
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            outlines[path] = None
+            continue
+        digest = hashlib.sha256(data).hexdigest()
+        if row and row[2] == digest:
+            outlines[path] = json.loads(row[3])
+            outline_counters["rehashed"] += 1
         else:
-            console.print(Panel(f"API Error: {str(e)}", title="API Error", style="bold red"))
-            return "I'm sorry, there was an error communicating with the AI. Please try again.", False
-    except APIError as e:
-        console.print(Panel(f"API Error: {str(e)}", title="API Error", style="bold red"))
-        return "I'm sorry, there was an error communicating with the AI. Please try again.", False
+            text = data.decode('utf-8', errors='replace')
+            outlines[path] = {"lines": text.count("\n") + (not text.endswith("\n") and bool(text)), "symbols": build_outline(text, outline_language(path))}
+            outline_counters["parsed"] += 1
+        updates.append((path, stat.st_mtime_ns, stat.st_size, digest, json.dumps(outlines[path]), time.time()))
 
-    assistant_response = ""
-    exit_continuation = False
-    tool_uses = []
+    if updates:
+        with outline_cache_lock:
+            db = get_outline_cache_db()
+            db.executemany("INSERT OR REPLACE INTO outlines (path, mtime_ns, size, hash, outline, indexed) VALUES (?, ?, ?, ?, ?, ?)", updates)
+            excess = db.execute("SELECT COUNT(*) FROM outlines").fetchone()[0] - OUTLINE_CACHE_MAX_ENTRIES
+            if excess > 0:
+                db.execute("DELETE FROM outlines WHERE path IN (SELECT path FROM outlines ORDER BY indexed LIMIT ?)", (excess,))
+            db.commit()
+    return outlines
 
-    for content_block in response.content:
-        if content_block.type == "text":
-            assistant_response += content_block.text
-            if CONTINUATION_EXIT_PHRASE in content_block.text:
-                exit_continuation = True
-        elif content_block.type == "tool_use":
-            tool_uses.append(content_block)
+def refresh_outline(path):
+    try:
+        if os.path.exists(path):
+            outline_files([path])
+        else:
+            with outline_cache_lock:
+                db = get_outline_cache_db()
+                db.execute("DELETE FROM outlines WHERE path = ?", (path,))
+                db.commit()
+        outline_counters["background"] += 1
+    finally:
+        with outline_cache_lock:
+            outline_pending.discard(path)
+
+def schedule_outline_refresh(path):
+    # Re-outline a file our tools changed in the background, so the next code_outline finds it indexed
+    global outline_pool
+    if outline_language(path) is None:
+        return
+    path = os.path.abspath(path)
+    with outline_cache_lock:
+        if path in outline_pending:
+            return
+        outline_pending.add(path)
+        if outline_pool is None:
+            outline_pool = ThreadPoolExecutor(max_workers=OUTLINE_WORKERS, thread_name_prefix="outline")
+    outline_pool.submit(refresh_outline, path)
+
+@register_tool(
+    description="Get an outline of the classes, functions and methods in a source file or in every source file under a directory, with signatures and line ranges. Use this to find your way around code before reading it, then read only the ranges you need with read_file start_line/end_line. Python is outlined from its syntax tree; JavaScript/TypeScript, Go, Rust, Java, Kotlin, C#, Swift, C/C++, Ruby and PHP by declaration patterns.",
+    properties={
+        "path": {
+            "type": "string",
+            "description": "The file or directory to outline",
+            "default": "."
+        },
+        "max_files": {
+            "type": "integer",
+            "description": f"Maximum number of files to outline for a directory (default {OUTLINE_MAX_FILES})"
+        }
+    }
+)
+def code_outline(path=".", max_files=None):
+    try:
+        max_files = max_files or OUTLINE_MAX_FILES
+        if os.path.isdir(path):
+            files = sorted(file_path for file_path in walk_files(path) if outline_language(file_path))
+        elif os.path.isfile(path):
+            files = [path]
+        else:
+            return ToolError(f"Error outlining code: {display_path(path)} does not exist")
+        if not files:
+            return f"No source files to outline in {display_path(path)}"
+
+        output = []
+        for file_path, outline in outline_files(files[:max_files]).items():
+            if outline is None:
+                output.append(f"{display_path(file_path)}: not outlined (too large or unreadable)")
+                continue
+            output.append(f"{display_path(file_path)} ({outline['lines']} lines)" + ("" if outline["symbols"] else ": no symbols"))
+            for depth, start, end, signature in outline["symbols"]:
+                output.append(f"{'  ' * (depth + 1)}{signature}  [{start}-{end}]" if end > start else f"{'  ' * (depth + 1)}{signature}  [{start}]")
+        if len(files) > max_files:
+            output.append(f"... {len(files) - max_files} more files; outline a subdirectory or raise max_files")
+        return "\n".join(output)
+    except Exception as e:
+        return ToolError(f"Error outlining code: {str(e)}")
+
+tavily_cache_lock = threading.RLock()  # re-entered when cached_tavily_search re-checks the cache
+tavily_cache_db = None
+tavily_in_flight = {}
+tavily_cache_counters = {"hits": 0, "misses": 0, "coalesced": 0, "expired": 0, "evictions": 0, "errors": 0}
+
+def normalize_search_query(query):
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(query.split()).rstrip("?.! ")
+
+def get_tavily_cache_db():
+    global tavily_cache_db
+    if tavily_cache_db is None:
+        try:
+            os.makedirs(os.path.dirname(TAVILY_CACHE_PATH), exist_ok=True)
+            tavily_cache_db = sqlite3.connect(TAVILY_CACHE_PATH, check_same_thread=False)
+        except (OSError, sqlite3.Error):
+            tavily_cache_db = sqlite3.connect(":memory:", check_same_thread=False)
+        tavily_cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS searches ("
+            "key TEXT PRIMARY KEY, query TEXT, search_depth TEXT, response TEXT, created REAL, last_used REAL)"
+        )
+        tavily_cache_db.execute("CREATE INDEX IF NOT EXISTS searches_last_used ON searches (last_used)")
+        tavily_cache_db.commit()
+    return tavily_cache_db
+
+def tavily_cache_get(key):
+    with tavily_cache_lock:
+        db = get_tavily_cache_db()
+        row = db.execute("SELECT response, created FROM searches WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > TAVILY_CACHE_TTL:
+            db.execute("DELETE FROM searches WHERE key = ?", (key,))
+            db.commit()
+            tavily_cache_counters["expired"] += 1
+            return None
+        db.execute("UPDATE searches SET last_used = ? WHERE key = ?", (time.time(), key))
+        db.commit()
+        return json.loads(row[0])
+
+def tavily_cache_put(key, query, search_depth, response):
+    with tavily_cache_lock:
+        db = get_tavily_cache_db()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO searches (key, query, search_depth, response, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, query, search_depth, json.dumps(response), now, now)
+        )
+        excess = db.execute("SELECT COUNT(*) FROM searches").fetchone()[0] - TAVILY_CACHE_MAX_ENTRIES
+        if excess > 0:
+            db.execute("DELETE FROM searches WHERE key IN (SELECT key FROM searches ORDER BY last_used LIMIT ?)", (excess,))
+            tavily_cache_counters["evictions"] += excess
+        db.commit()
+
+def tavily_cache_stats():
+    with tavily_cache_lock:
+        stats = dict(tavily_cache_counters)
+        stats["entries"] = get_tavily_cache_db().execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+    lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+    stats["hit_rate"] = (stats["hits"] + stats["coalesced"]) / lookups if lookups else 0.0
+    return stats
+
+def cached_tavily_search(query, search_depth="advanced"):
+    normalized = normalize_search_query(query)
+    key = hashlib.sha256(f"{search_depth}\0{normalized}".encode('utf-8')).hexdigest()
+
+    cached = tavily_cache_get(key)
+    if cached is not None:
+        with tavily_cache_lock:
+            tavily_cache_counters["hits"] += 1
+        return cached
+
+    # Identical searches already running share the one request
+    with tavily_cache_lock:
+        # A search that finished since the lookup above has already stored its answer and left tavily_in_flight
+        cached = tavily_cache_get(key)
+        if cached is not None:
+            tavily_cache_counters["hits"] += 1
+            return cached
+        future = tavily_in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = tavily_in_flight[key] = Future()
+            tavily_cache_counters["misses"] += 1
+        else:
+            tavily_cache_counters["coalesced"] += 1
+    if not owner:
+        return future.result()
+
+    try:
+        response = get_tavily().qna_search(query=query, search_depth=search_depth)
+        tavily_cache_put(key, normalized, search_depth, response)
+        future.set_result(response)
+        return response
+    except Exception as e:
+        with tavily_cache_lock:
+            tavily_cache_counters["errors"] += 1
+        future.set_exception(e)
+        raise
+    finally:
+        with tavily_cache_lock:
+            tavily_in_flight.pop(key, None)
+
+@register_tool(
+    description="Perform a web search using Tavily API to get up-to-date information or additional context. Use this when you need current information or feel a search could provide a better answer.",
+    properties={
+        "query": {
+            "type": "string",
+            "description": "The search query"
+        },
+        "search_depth": {
+            "type": "string",
+            "enum": ["basic", "advanced"],
+            "description": "Use basic for quick lookups; advanced (the default) is slower but more thorough"
+        }
+    },
+    required=["query"]
+)
+def tavily_search(query, search_depth="advanced"):
+    try:
+        response = cached_tavily_search(query, search_depth)
+        return response
+    except Exception as e:
+        return ToolError(f"Error performing search: {str(e)}")
+
+# Update the execute_tool function
+# Tools that write files hold a per-path lock, so concurrent sessions never interleave edits to one file
+FILE_MUTATING_TOOLS = {"create_file", "edit_and_apply", "patch_file", "batch_edit"}
+file_locks_lock = threading.Lock()
+file_locks = {}
+
+def tool_paths(tool_input):
+    # The files a tool call names: its "path" and the "path" of each of its "changes" (batch_edit)
+    if not isinstance(tool_input, dict):
+        return []
+    paths = [tool_input["path"]] if isinstance(tool_input.get("path"), str) and tool_input["path"] else []
+    if isinstance(tool_input.get("changes"), list):
+        paths += [change["path"] for change in tool_input["changes"] if isinstance(change, dict) and isinstance(change.get("path"), str) and change["path"]]
+    return paths
+
+@contextmanager
+def lock_files(paths):
+    # Locks are always taken in sorted order so two multi-file writers cannot deadlock
+    keys = sorted({os.path.abspath(path) for path in paths})
+    with file_locks_lock:
+        locks = [file_locks.setdefault(key, threading.Lock()) for key in keys]
+    with ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        yield
+
+def tool_file_lock(tool_name, tool_input):
+    if tool_name not in FILE_MUTATING_TOOLS:
+        return nullcontext()
+    return lock_files(tool_paths(tool_input))
+
+def session_path(path):
+    # Relative tool paths resolve against the session's working directory (batch mode), otherwise the process
+    # cwd. A session with a working directory cannot reach outside it, through absolute paths or "..".
+    session = current_session.get()
+    if session is None or session.workdir is None:
+        return path
+    resolved = os.path.join(session.workdir, path)
+    root, target = os.path.realpath(session.workdir), os.path.realpath(resolved)
+    if target != root and not target.startswith(root + os.sep):
+        raise ValueError(f"{path} is outside the working directory")
+    return resolved
+
+def display_path(path):
+    # How tool results name a file: relative to the session's working directory (or the cwd) when the file
+    # is inside it, so the model can pass the name straight back to another tool
+    session = current_session.get()
+    relative = os.path.relpath(path, session.workdir if session is not None and session.workdir else os.getcwd())
+    return path if relative.startswith(os.pardir) else relative
+
+def resolve_tool_paths(tool_name, tool_input):
+    # Resolved before locking so the same name in two workdirs gets two locks and the same file one lock.
+    # An omitted path takes the schema default first, so it too means the working directory.
+    if not isinstance(tool_input, dict):
+        return tool_input
+    spec = tool_registry.get(tool_name)
+    default = spec["schema"]["properties"].get("path", {}).get("default") if spec is not None else None
+    if tool_input.get("path") is None and default is not None:
+        tool_input = dict(tool_input, path=default)
+    if isinstance(tool_input.get("path"), str):
+        tool_input = dict(tool_input, path=session_path(tool_input["path"]))
+    if isinstance(tool_input.get("changes"), list):
+        tool_input = dict(tool_input, changes=[
+            dict(change, path=session_path(change["path"])) if isinstance(change, dict) and isinstance(change.get("path"), str) else change
+            for change in tool_input["changes"]
+        ])
+    return tool_input
+
+def execute_tool(tool_name, tool_input):
+    session = current_session.get()
+    if session is not None and tool_name in FILE_MUTATING_TOOLS:
+        session.files_written.update(os.path.normpath(path) for path in tool_paths(tool_input))
+    if session is not None and session.workdir is not None:
+        try:
+            tool_input = resolve_tool_paths(tool_name, tool_input)
+        except ValueError as e:
+            return ToolError(f"Error: {str(e)} for tool {tool_name}")
+    with metrics.span("tool", tool=tool_name), tool_file_lock(tool_name, tool_input):
+        return dispatch_tool(tool_name, tool_input)
+
+def dispatch_tool(tool_name, tool_input):
+    spec = tool_registry.get(tool_name)
+    if spec is None:
+        return ToolError(f"Unknown tool: {tool_name}")
+    arguments, error = spec["validate"](tool_input)
+    if error:
+        return ToolError(f"Error: {error} for tool {tool_name}")
+    try:
+        return resolve_tool_handler(spec)(**arguments)
+    except Exception as e:
+        return ToolError(f"Error executing tool {tool_name}: {str(e)}")
 
-    console.print(Panel(Markdown(assistant_response), title="Claude's Response", title_align="left", expand=False))
+image_cache_lock = threading.Lock()
+image_cache = OrderedDict()
+image_process_pool = None
 
-    for tool_use in tool_uses:
-        tool_name = tool_use.name
-        tool_input = tool_use.input
-        tool_use_id = tool_use.id
+def choose_image_format(img):
+    # Screenshots, diagrams and UI captures have large flat areas and few colours and stay sharp as PNG;
+    # photos compress far better as JPEG.
+    from PIL import Image
+    if img.mode in ("RGBA", "LA", "P", "1", "L") or "transparency" in img.info:
+        return "PNG"
+    sample = img.resize((128, 128), Image.NEAREST).convert("RGB")
+    colors = sample.getcolors(maxcolors=128 * 128)
+    return "PNG" if colors is not None and len(colors) < 1024 else "JPEG"
 
-        console.print(Panel(f"Tool Used: {tool_name}", style="green"))
-        console.print(Panel(f"Tool Input: {json.dumps(tool_input, indent=2)}", style="green"))
+def encode_image_file(image_path, max_size=IMAGE_MAX_SIZE):
+    from PIL import Image
+    with Image.open(image_path) as img:
+        if img.format == "JPEG":
+            # Let the JPEG decoder scale down while decoding instead of decoding at full size
+            img.draft("RGB", max_size)
+        image_format = choose_image_format(img)
+        img.thumbnail(max_size, reducing_gap=2.0)
+        output = io.BytesIO()
+        if image_format == "JPEG":
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY)
+        else:
+            if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+                img = img.convert('RGBA')
+            img.save(output, format='PNG')
+        return f"image/{image_format.lower()}", base64.b64encode(output.getvalue()).decode('utf-8')
+
+def get_image_process_pool():
+    global image_process_pool
+    if image_process_pool is None:
+        image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_ENCODE_WORKERS)
+    return image_process_pool
+
+def encode_images(image_paths):
+    # Returns one (media_type, base64_data) tuple or error string per path, in order
+    results = [None] * len(image_paths)
+    pending = {}
+    for i, image_path in enumerate(image_paths):
+        try:
+            with open(image_path, 'rb') as f:
+                key = (hashlib.sha256(f.read()).hexdigest(), IMAGE_MAX_SIZE)
+        except OSError as e:
+            results[i] = f"Error encoding image: {str(e)}"
+            continue
+        with image_cache_lock:
+            if key in image_cache:
+                image_cache.move_to_end(key)
+                results[i] = image_cache[key]
+                continue
+        pending.setdefault(key, []).append((i, image_path))
 
+    # A single image is cheaper to encode in-process than to ship to a worker
+    if len(pending) > 1:
+        pool = get_image_process_pool()
+        jobs = {key: pool.submit(encode_image_file, paths[0][1], IMAGE_MAX_SIZE) for key, paths in pending.items()}
+    else:
+        jobs = {}
+
+    for key, paths in pending.items():
         try:
-            result = execute_tool(tool_name, tool_input)
-            console.print(Panel(result, title_align="left", title="Tool Result", style="green"))
+            encoded = jobs[key].result() if key in jobs else encode_image_file(paths[0][1], IMAGE_MAX_SIZE)
         except Exception as e:
-            result = f"Error executing tool: {str(e)}"
-            console.print(Panel(result, title="Tool Execution Error", style="bold red"))
-        
-        current_conversation.append({
+            encoded = f"Error encoding image: {str(e)}"
+        else:
+            with image_cache_lock:
+                image_cache[key] = encoded
+                while len(image_cache) > IMAGE_CACHE_MAX_ENTRIES:
+                    image_cache.popitem(last=False)
+        for i, _ in paths:
+            results[i] = encoded
+    return results
+
+# History holds {"type": "image", "source": {"type": "stored", "hash": ...}} references;
+# the base64 data lives here once per distinct image and is only expanded when a request is built
+image_store_lock = threading.Lock()
+image_store = {}
+
+def store_image(media_type, image_base64):
+    image_hash = hashlib.sha256(image_base64.encode('ascii')).hexdigest()
+    with image_store_lock:
+        image_store.setdefault(image_hash, {"media_type": media_type, "data": image_base64, "thumbnail": None})
+    return {"type": "image", "source": {"type": "stored", "hash": image_hash, "media_type": media_type}}
+
+def image_thumbnail(entry):
+    from PIL import Image
+    if entry["thumbnail"] is None:
+        with Image.open(io.BytesIO(base64.b64decode(entry["data"]))) as img:
+            img.thumbnail(IMAGE_THUMBNAIL_SIZE)
+            output = io.BytesIO()
+            img.save(output, format=entry["media_type"].split("/")[1].upper())
+        entry["thumbnail"] = base64.b64encode(output.getvalue()).decode('utf-8')
+    return entry["thumbnail"]
+
+def materialize_image(block, age, policy=None):
+    policy = policy or IMAGE_HISTORY_POLICY
+    source = block["source"]
+    entry = image_store.get(source["hash"])
+    if entry is None:
+        return {"type": "text", "text": "[Image no longer available]"}
+    if age < IMAGE_HISTORY_KEEP_TURNS or policy == "keep":
+        data = entry["data"]
+    elif policy == "thumbnail":
+        data = image_thumbnail(entry)
+    else:
+        return {"type": "text", "text": f"[Image {source['hash'][:12]} shared {age} turns ago was removed to save context]"}
+    return dict(block, source={"type": "base64", "media_type": entry["media_type"], "data": data})
+
+def materialize_images(messages, policy=None):
+    # Expand stored image references into API blocks, downgrading images older than IMAGE_HISTORY_KEEP_TURNS
+    turn_starts = user_turn_starts(messages)
+    materialized = []
+    for i, message in enumerate(messages):
+        content = message["content"]
+        if not isinstance(content, list) or not any(
+            block.get("type") == "image" and block["source"].get("type") == "stored" for block in content
+        ):
+            materialized.append(message)
+            continue
+        age = sum(1 for start in turn_starts if start > i)
+        materialized.append(dict(message, content=[
+            materialize_image(block, age, policy) if block.get("type") == "image" and block["source"].get("type") == "stored" else block
+            for block in content
+        ]))
+    return materialized
+
+def parse_image_paths(raw):
+    # Drag and drop may paste several paths at once, quoted or with escaped spaces
+    raw = raw.strip()
+    if os.path.isfile(raw.strip("'\"")):
+        return [raw.strip("'\"")]
+    try:
+        paths = shlex.split(raw)
+    except ValueError:
+        return None
+    return paths if paths and all(os.path.isfile(path) for path in paths) else None
+
+def parse_goals(response):
+    # "Goal 3: description (depends on: 1, 2)" -> {"id": 3, "goal": "description", "depends_on": [1, 2]}.
+    # Only earlier goals can be prerequisites, which keeps the dependency graph acyclic.
+    goals = []
+    for number, description in re.findall(r'Goal (\d+): (.+)', response):
+        match = re.search(r'\s*\((?:depends on|after)\s*:?\s*([^)]*)\)\s*$', description, re.IGNORECASE)
+        depends_on = []
+        if match:
+            description = description[:match.start()]
+            depends_on = sorted({int(n) for n in re.findall(r'\d+', match.group(1)) if int(n) < int(number)})
+        goals.append({"id": int(number), "goal": description.strip(), "depends_on": depends_on})
+    known = {goal["id"] for goal in goals}
+    for goal in goals:
+        goal["depends_on"] = [n for n in goal["depends_on"] if n in known]
+    return goals
+
+def run_tool_call(tool_name, tool_input, after=()):
+    for earlier in after:
+        earlier.result()
+    try:
+        result = execute_tool(tool_name, tool_input)
+        return result, isinstance(result, ToolError)
+    except Exception as e:
+        return ToolError(f"Error executing tool: {str(e)}"), True
+
+def tool_path_keys(tool_use):
+    # Every file the call touches, batch_edit changes included, so two calls sharing any one are ordered
+    return {os.path.abspath(path) for path in tool_paths(tool_use.input)}
+
+def earlier_calls(last_by_path, keys):
+    # The most recent call on each of the keys, each listed once
+    return list({id(call): call for call in (last_by_path[key] for key in keys if key in last_by_path)}.values())
+
+class ToolCallBatch:
+    # Calls touching a common path stay in their original order; everything else runs concurrently.
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=MAX_TOOL_WORKERS)
+        self.futures = []
+        self.last_by_path = {}
+
+    def submit(self, tool_use):
+        keys = tool_path_keys(tool_use)
+        future = self.executor.submit(run_tool_call, tool_use.name, tool_use.input, earlier_calls(self.last_by_path, keys))
+        for key in keys:
+            self.last_by_path[key] = future
+        self.futures.append(future)
+
+    def results(self):
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown(wait=True)
+
+class StreamAssembler:
+    # Accumulates streamed text and rebuilds tool_use blocks from their input_json deltas
+    def __init__(self, title):
+        self.title = title
+        self.text = ""
+        self.partial_tool_uses = {}
+
+    def panel(self):
+        from rich.markdown import Markdown
+        return Panel(Markdown(self.text), title=self.title, title_align="left", expand=False)
+
+    def feed(self, event):
+        if event.type == "content_block_start" and event.content_block.type == "tool_use":
+            self.partial_tool_uses[event.index] = (event.content_block.id, event.content_block.name, [])
+        elif event.type == "content_block_delta":
+            if event.delta.type == "text_delta":
+                self.text += event.delta.text
+            elif event.delta.type == "input_json_delta":
+                self.partial_tool_uses[event.index][2].append(event.delta.partial_json)
+        elif event.type == "content_block_stop" and event.index in self.partial_tool_uses:
+            tool_use_id, tool_name, json_parts = self.partial_tool_uses.pop(event.index)
+            raw_input = "".join(json_parts)
+            return anthropic_sdk().types.ToolUseBlock(type="tool_use", id=tool_use_id, name=tool_name, input=json.loads(raw_input) if raw_input else {})
+        return None
+
+def stream_claude_response(title, tool_batch=None, **request):
+    from rich.live import Live
+    assembler = StreamAssembler(title)
+
+    with get_client().messages.stream(**request) as stream:
+        with Live(assembler.panel(), console=console, refresh_per_second=10, vertical_overflow="visible") as live:
+            for event in stream:
+                tool_use = assembler.feed(event)
+                if tool_use is not None and tool_batch is not None:
+                    tool_batch.submit(tool_use)
+                elif event.type == "content_block_delta":
+                    live.update(assembler.panel())
+            live.update(assembler.panel())
+        return stream.get_final_message()
+
+def build_image_message(user_input, images):
+    return {
+        "role": "user",
+        "content": [store_image(media_type, image_base64) for media_type, image_base64 in images] + [
+            {
+                "type": "text",
+                "text": f"User input for {'image' if len(images) == 1 else 'images'}: {user_input}"
+            }
+        ]
+    }
+
+def tool_result_block(tool_use_id, result, is_error):
+    block = {"type": "tool_result", "tool_use_id": tool_use_id, "content": result}
+    if is_error:
+        block["is_error"] = True
+    return block
+
+def tool_exchange_messages(tool_uses, results):
+    return [
+        {
             "role": "assistant",
             "content": [
                 {
                     "type": "tool_use",
-                    "id": tool_use_id,
-                    "name": tool_name,
-                    "input": tool_input
+                    "id": tool_use.id,
+                    "name": tool_use.name,
+                    "input": tool_use.input
                 }
+                for tool_use in tool_uses
             ]
-        })
-
-        current_conversation.append({
+        },
+        {
             "role": "user",
             "content": [
-                {
-                    "type": "tool_result",
-                    "tool_use_id": tool_use_id,
-                    "content": result
-                }
+                tool_result_block(tool_use.id, result, is_error)
+                for tool_use, (result, is_error) in zip(tool_uses, results)
             ]
-        })
+        }
+    ]
 
-        messages = conversation_history + current_conversation
+def split_response(response):
+    text = ""
+    tool_uses = []
+    exit_continuation = False
+    for content_block in response.content:
+        if content_block.type == "text":
+            text += content_block.text
+            if CONTINUATION_EXIT_PHRASE in content_block.text:
+                exit_continuation = True
+        elif content_block.type == "tool_use":
+            tool_uses.append(content_block)
+    return text, tool_uses, exit_continuation
 
-        try:
-            tool_response = client.messages.create(
-                model=TOOLCHECKERMODEL,
-                max_tokens=4000,
-                system=update_system_prompt(current_iteration, max_iterations),
-                messages=messages,
-                tools=tools,
-                tool_choice={"type": "auto"}
-            )
+def route_tool_followup(tool_uses, results, automode_enabled):
+    # Picks the model and output budget for the follow-up after a set of tool results (see TOOL_ROUTING);
+    # route "skip" means no request, the results are acknowledged in the turn's reply instead
+    names = [tool_use.name for tool_use in tool_uses]
+    decision = {"route": "main", "model": TOOLCHECKERMODEL, "max_tokens": TOOL_ROUTING_MAX_TOKENS, "tools": names}
+    failed = [name for name, (_, is_error) in zip(names, results) if is_error]
+    size = sum(len(str(result)) for result, _ in results)
+    if not TOOL_ROUTING:
+        decision["reason"] = "routing disabled"
+    elif failed:
+        decision["reason"] = f"error from {', '.join(failed)}"
+    elif all(name in ACKNOWLEDGEMENT_TOOLS for name in names):
+        if automode_enabled:
+            decision.update(route="small", model=SMALLMODEL, max_tokens=TOOL_ROUTING_SMALL_MAX_TOKENS, reason="acknowledgements in automode")
+        else:
+            decision.update(route="skip", model=None, max_tokens=0, reason="acknowledgements only")
+    elif all(name in ACKNOWLEDGEMENT_TOOLS or name in SHORT_RESULT_TOOLS for name in names) and size <= TOOL_ROUTING_SHORT_RESULT_CHARS:
+        decision.update(route="small", model=SMALLMODEL, max_tokens=TOOL_ROUTING_SMALL_MAX_TOKENS, reason=f"short results ({size} chars)")
+    else:
+        decision["reason"] = f"results to reason about ({size} chars)"
+    metrics.record_route(decision)
+    if decision["route"] == "skip":
+        decision["acknowledgement"] = "\n".join(str(result).strip().splitlines()[0] for result, _ in results if str(result).strip())
+    return decision
+
+def print_route(decision):
+    if decision["route"] != "main":
+        action = "skipped" if decision["route"] == "skip" else f"sent to {decision['model']}"
+        render_queue.put(Text(f"Tool follow-up {action} ({decision['reason']})", style="dim"))
+
+def print_tool_call(tool_name, tool_input):
+    render_queue.put(Panel(f"Tool Used: {tool_name}", style="green"))
+    render_queue.put(preview_panel(f"Tool Input: {json.dumps(tool_input, indent=2)}", "Tool Input", style="green"))
+
+def print_tool_result(tool_name, result, is_error=False):
+    if is_error:
+        render_queue.put(preview_panel(result, "Tool Execution Error", style="bold red"))
+    else:
+        render_queue.put(preview_panel(result, f"Tool Result: {tool_name}", style="green"))
 
-            tool_checker_response = ""
-            for tool_content_block in tool_response.content:
-                if tool_content_block.type == "text":
-                    tool_checker_response += tool_content_block.text
+def print_tool_results(tool_uses, results):
+    for tool_use, (result, is_error) in zip(tool_uses, results):
+        print_tool_result(tool_use.name, result, is_error)
+
+def create_message(title, request, tool_batch=None):
+    if STREAMING:
+        send = lambda: stream_claude_response(title, tool_batch=tool_batch, **request)
+    else:
+        send = lambda: get_client().messages.create(**request)
+    # Once tools have started running, the response cannot be requested again
+    retryable = lambda: tool_batch is None or not tool_batch.futures
+    with metrics.span("api_call", model=request["model"], title=title) as span:
+        response = scheduler.call(send, estimate_tokens(request["messages"]) + estimate_tokens(request["system"]), retryable)
+        span.update(usage_counts(response.usage))
+    metrics.record_tokens(request["model"], response.usage)
+    return response
+
+def get_tool_checker_response(messages, route, current_iteration=None, max_iterations=None, stable_len=0):
+    from rich.markdown import Markdown
+    print_route(route)
+    if route["route"] == "skip":
+        return "\n\n" + route["acknowledgement"]
+    try:
+        request = build_request(route["model"], messages, current_iteration, max_iterations, stable_len, max_tokens=route["max_tokens"])
+        tool_response = create_message("Claude's Response to Tool Result", request)
+        record_usage(tool_response.usage)
+
+        tool_checker_response, _, _ = split_response(tool_response)
+        if not STREAMING:
             console.print(Panel(Markdown(tool_checker_response), title="Claude's Response to Tool Result", title_align="left"))
-            assistant_response += "\n\n" + tool_checker_response
-        except APIError as e:
-            error_message = f"Error in tool response: {str(e)}"
-            console.print(Panel(error_message, title="Error", style="bold red"))
-            assistant_response += f"\n\n{error_message}"
+        return "\n\n" + tool_checker_response
+    except anthropic_sdk().APIError as e:
+        error_message = f"Error in tool response: {str(e)}"
+        console.print(Panel(error_message, title="Error", style="bold red"))
+        return f"\n\n{error_message}"
+
+def chat_with_claude(user_input, image_path=None, current_iteration=None, max_iterations=None):
+    from rich.markdown import Markdown
+    global conversation_history, conversation_digest, automode
+
+    current_conversation = []
+    reset_turn_usage()
+    begin_file_reads()
+    turn = metrics.begin_turn()
+    conversation_history, conversation_digest = compact_history(conversation_history, conversation_digest)
+
+    if image_path:
+        image_paths = [image_path] if isinstance(image_path, str) else list(image_path)
+        console.print(Panel(f"Processing image at path: {', '.join(image_paths)}", title_align="left", title="Image Processing", expand=False, style="yellow"))
+        images = encode_images(image_paths)
+
+        errors = [image for image in images if isinstance(image, str)]
+        if errors:
+            console.print(Panel("\n".join(errors), title="Error", style="bold red"))
+            metrics.end_turn(turn)
+            return "I'm sorry, there was an error processing the image. Please try again.", False
+
+        current_conversation.append(build_image_message(user_input, images))
+        console.print(Panel("Image message added to conversation history", title_align="left", title="Image Added", style="green"))
+    else:
+        current_conversation.append({"role": "user", "content": user_input})
+
+    messages = conversation_history + current_conversation
+
+    request = build_request(MAINMODEL, messages, current_iteration, max_iterations, len(conversation_history))
+    tool_batch = ToolCallBatch() if STREAMING and PARALLEL_TOOL_CALLS else None
+
+    try:
+        response = create_message("Claude's Response", request, tool_batch)
+    except anthropic_sdk().APIError as e:
+        if tool_batch is not None:
+            tool_batch.results()
+        console.print(Panel(f"API Error: {str(e)}", title="API Error", style="bold red"))
+        metrics.end_turn(turn)
+        return "I'm sorry, there was an error communicating with the AI. Please try again.", False
+
+    record_usage(response.usage)
+    assistant_response, tool_uses, exit_continuation = split_response(response)
+
+    if not STREAMING:
+        console.print(Panel(Markdown(assistant_response), title="Claude's Response", title_align="left", expand=False))
+
+    if tool_batch is not None and not tool_uses:
+        tool_batch.results()
+    elif tool_batch is not None or (PARALLEL_TOOL_CALLS and len(tool_uses) > 1):
+        if tool_batch is None:
+            tool_batch = ToolCallBatch()
+            for tool_use in tool_uses:
+                tool_batch.submit(tool_use)
+        watch_tool_calls(tool_uses, tool_batch.futures)
+        results = tool_batch.results()
+        print_tool_results(tool_uses, results)
+
+        current_conversation.extend(tool_exchange_messages(tool_uses, results))
+        messages = conversation_history + current_conversation
+        route = route_tool_followup(tool_uses, results, automode)
+        assistant_response += get_tool_checker_response(messages, route, current_iteration, max_iterations, len(conversation_history))
+    else:
+        for tool_use in tool_uses:
+            tool_name = tool_use.name
+            tool_input = tool_use.input
+            tool_use_id = tool_use.id
+
+            print_tool_call(tool_name, tool_input)
+
+            try:
+                result = execute_tool(tool_name, tool_input)
+            except Exception as e:
+                result = ToolError(f"Error executing tool: {str(e)}")
+            is_error = isinstance(result, ToolError)
+            print_tool_result(tool_name, result, is_error)
+        
+            current_conversation.append({
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "tool_use",
+                        "id": tool_use_id,
+                        "name": tool_name,
+                        "input": tool_input
+                    }
+                ]
+            })
+
+            current_conversation.append({
+                "role": "user",
+                "content": [
+                    tool_result_block(tool_use_id, result, is_error)
+                ]
+            })
+
+            messages = conversation_history + current_conversation
+
+            route = route_tool_followup([tool_use], [(result, is_error)], automode)
+            assistant_response += get_tool_checker_response(messages, route, current_iteration, max_iterations, len(conversation_history))
 
     if assistant_response:
         current_conversation.append({"role": "assistant", "content": assistant_response})
 
     conversation_history = messages + [{"role": "assistant", "content": assistant_response}]
+    commit_file_reads()
+    if session_journal is not None:
+        session_journal.record(conversation_history, conversation_digest)
+    render_queue.flush()
+    print_turn_usage()
+    metrics.end_turn(turn)
 
     return assistant_response, exit_continuation
 
+async def run_tool_call_async(tool_name, tool_input, after=()):
+    if after:
+        await asyncio.wait(after)
+    try:
+        # to_thread carries the session context into the worker thread
+        result = await asyncio.to_thread(execute_tool, tool_name, tool_input)
+        return result, isinstance(result, ToolError)
+    except Exception as e:
+        return ToolError(f"Error executing tool: {str(e)}"), True
+
+class AsyncToolCallBatch:
+    # Async counterpart of ToolCallBatch: calls sharing a path are chained, the rest run concurrently
+    def __init__(self):
+        self.tasks = []
+        self.last_by_path = {}
+
+    def submit(self, tool_use):
+        keys = tool_path_keys(tool_use)
+        task = asyncio.create_task(run_tool_call_async(tool_use.name, tool_use.input, earlier_calls(self.last_by_path, keys)))
+        for key in keys:
+            self.last_by_path[key] = task
+        self.tasks.append(task)
+
+    async def results(self):
+        try:
+            return list(await asyncio.gather(*self.tasks))
+        except BaseException:
+            for task in self.tasks:
+                task.cancel()
+            raise
+
+async def create_message_async(session, title, request, tool_batch=None):
+    from rich.live import Live
+    async def send():
+        if not STREAMING:
+            return await get_async_client().messages.create(**request)
+        assembler = StreamAssembler(title)
+        async with get_async_client().messages.stream(**request) as stream:
+            live = Live(assembler.panel(), console=console, refresh_per_second=10, vertical_overflow="visible") if session.render else nullcontext()
+            with live:
+                async for event in stream:
+                    tool_use = assembler.feed(event)
+                    if tool_use is not None and tool_batch is not None:
+                        tool_batch.submit(tool_use)
+                    elif session.render and event.type == "content_block_delta":
+                        live.update(assembler.panel())
+                if session.render:
+                    live.update(assembler.panel())
+            return await stream.get_final_message()
+
+    retryable = lambda: tool_batch is None or not tool_batch.tasks
+    with metrics.span("api_call", model=request["model"], title=title) as span:
+        response = await scheduler.call_async(send, estimate_tokens(request["messages"]) + estimate_tokens(request["system"]), retryable)
+        span.update(usage_counts(response.usage))
+    metrics.record_tokens(request["model"], response.usage)
+    return response
+
+async def get_tool_checker_response_async(session, messages, route, current_iteration=None, max_iterations=None, stable_len=0):
+    from rich.markdown import Markdown
+    title = "Claude's Response to Tool Result"
+    if session.render:
+        print_route(route)
+    if route["route"] == "skip":
+        return "\n\n" + route["acknowledgement"]
+    try:
+        request = build_request(route["model"], messages, current_iteration, max_iterations, stable_len, max_tokens=route["max_tokens"],
+                                automode_enabled=session.automode, digest=session.digest)
+        tool_response = await create_message_async(session, title, request)
+        record_usage(tool_response.usage, session.usage)
+        tool_checker_response, _, _ = split_response(tool_response)
+        if session.render and not STREAMING:
+            console.print(Panel(Markdown(tool_checker_response), title=title, title_align="left"))
+        return "\n\n" + tool_checker_response
+    except anthropic_sdk().APIError as e:
+        error_message = f"Error in tool response: {str(e)}"
+        if session.render:
+            console.print(Panel(error_message, title="Error", style="bold red"))
+        return f"\n\n{error_message}"
+
+async def chat_with_claude_async(session, user_input, image_path=None, current_iteration=None, max_iterations=None):
+    # The session is only updated once the turn completes, so a cancelled turn leaves its history untouched
+    from rich.markdown import Markdown
+    context_token = current_session.set(session)
+    turn = metrics.begin_turn()
+    try:
+        reset_turn_usage(session.usage)
+        begin_file_reads()
+        session.history, session.digest = compact_history(session.history, session.digest)
+
+        current_conversation = []
+        if image_path:
+            images = await asyncio.to_thread(encode_images, [image_path] if isinstance(image_path, str) else list(image_path))
+            errors = [image for image in images if isinstance(image, str)]
+            if errors:
+                if session.render:
+                    console.print(Panel("\n".join(errors), title="Error", style="bold red"))
+                return "I'm sorry, there was an error processing the image. Please try again.", False
+            current_conversation.append(build_image_message(user_input, images))
+        else:
+            current_conversation.append({"role": "user", "content": user_input})
+
+        messages = session.history + current_conversation
+        request = build_request(MAINMODEL, messages, current_iteration, max_iterations, len(session.history),
+                                automode_enabled=session.automode, digest=session.digest)
+        tool_batch = AsyncToolCallBatch()
+
+        try:
+            response = await create_message_async(session, "Claude's Response", request, tool_batch)
+        except anthropic_sdk().APIError as e:
+            await tool_batch.results()
+            if session.render:
+                console.print(Panel(f"API Error: {str(e)}", title="API Error", style="bold red"))
+            return "I'm sorry, there was an error communicating with the AI. Please try again.", False
+
+        record_usage(response.usage, session.usage)
+        assistant_response, tool_uses, exit_continuation = split_response(response)
+        if session.render and not STREAMING:
+            console.print(Panel(Markdown(assistant_response), title="Claude's Response", title_align="left", expand=False))
+
+        if tool_uses:
+            if not STREAMING:
+                for tool_use in tool_uses:
+                    tool_batch.submit(tool_use)
+            if session.render:
+                await watch_tool_calls_async(tool_uses, tool_batch.tasks)
+            results = await tool_batch.results()
+            if session.render:
+                print_tool_results(tool_uses, results)
+
+            current_conversation.extend(tool_exchange_messages(tool_uses, results))
+            messages = session.history + current_conversation
+            route = route_tool_followup(tool_uses, results, session.automode)
+            assistant_response += await get_tool_checker_response_async(session, messages, route, current_iteration, max_iterations, len(session.history))
+
+        session.history = messages + [{"role": "assistant", "content": assistant_response}]
+        commit_file_reads()
+        if session.journal is not None:
+            session.journal.record(session.history, session.digest)
+        if session.render:
+            await asyncio.to_thread(render_queue.flush)
+            print_turn_usage(session.usage)
+        return assistant_response, exit_continuation
+    finally:
+        metrics.end_turn(turn)
+        current_session.reset(context_token)
+
+async def run_cancellable(coroutine):
+    # Ctrl+C cancels the running request instead of raising KeyboardInterrupt; returns None when cancelled
+    task = asyncio.create_task(coroutine)
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+    except (NotImplementedError, RuntimeError):
+        pass
+    try:
+        await asyncio.wait([task])
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (NotImplementedError, RuntimeError):
+            pass
+    if task.cancelled():
+        return None
+    return task.result()
+
+async def run_automode_async(session, user_input, max_iterations, iteration_count=0):
+    session.automode = True
+    goal = user_input
+    while session.automode and iteration_count < max_iterations:
+        if session.journal is not None:
+            session.journal.record_automode({"goal": goal, "iteration": iteration_count, "max_iterations": max_iterations})
+        result = await run_cancellable(chat_with_claude_async(session, user_input, current_iteration=iteration_count + 1, max_iterations=max_iterations))
+        if result is None:
+            console.print(Panel("Automode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
+            break
+        response, exit_continuation = result
+
+        if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
+            console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))
+            break
+        console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))
+        user_input = AUTOMODE_CONTINUE_PROMPT
+        iteration_count += 1
+
+        if iteration_count >= max_iterations:
+            console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))
+    session.automode = False
+    if session.journal is not None:
+        session.journal.record_automode(None)
+
+PLANNING_PROMPT = """Plan the following request before any work starts. Break it into goals that can be worked on separately and list each one on its own line as
+Goal 1: <description>
+Goal 2: <description> (depends on: 1)
+Only list a dependency when a goal needs the files or results of an earlier goal. Goals without dependencies are worked on at the same time by separate workers, so keep independent parts in separate goals and avoid having two independent goals edit the same file. Do not start working on the goals yet.
+
+Request: {request}"""
+
+GOAL_PROMPT = """You are one of several workers carrying out a plan in parallel. Overall request: {request}
+
+Plan:
+{plan}
+
+Work only on Goal {id}: {goal}
+{prerequisites}Other goals are handled by other workers; do not work on them. When Goal {id} is complete, summarize what you did and which files you changed, and say AUTOMODE_COMPLETE."""
+
+def goal_summary(response):
+    text = response.replace(CONTINUATION_EXIT_PHRASE, "").strip()
+    return text if len(text) <= PLAN_RESULT_MAX_CHARS else text[:PLAN_RESULT_MAX_CHARS] + "..."
+
+async def run_goal_worker(parent, request, goals, goal, prerequisites, max_iterations):
+    # Each goal gets its own session seeded with the parent's history (a shared, cached prefix)
+    worker = Session(history=parent.history, automode=True, render=False, name=f"{parent.name}/goal-{goal['id']}")
+    worker.digest = parent.digest
+    done = [result for result in prerequisites if result["status"] == "completed"]
+    user_input = GOAL_PROMPT.format(
+        request=request,
+        plan="\n".join(f"Goal {g['id']}: {g['goal']}" for g in goals),
+        id=goal["id"],
+        goal=goal["goal"],
+        prerequisites="".join(f"Goal {result['id']} is finished: {result['summary']}\n" for result in done),
+    )
+    started = time.perf_counter()
+    status, iterations, response = "incomplete", 0, ""
+    console.print(Panel(f"Goal {goal['id']} started: {goal['goal']}", title="Planned Automode", title_align="left", style="yellow"))
+    try:
+        while iterations < max_iterations:
+            iterations += 1
+            response, exit_continuation = await chat_with_claude_async(worker, user_input, current_iteration=iterations, max_iterations=max_iterations)
+            # A turn that failed returns an apology without adding its reply to the history
+            if not worker.history or worker.history[-1]["content"] is not response:
+                status = "failed"
+                break
+            if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
+                status = "completed"
+                break
+            user_input = AUTOMODE_CONTINUE_PROMPT
+    except Exception as e:
+        status = f"failed: {str(e)}"
+    result = {
+        "id": goal["id"],
+        "goal": goal["goal"],
+        "status": status,
+        "iterations": iterations,
+        "seconds": time.perf_counter() - started,
+        "files": sorted(worker.files_written),
+        "summary": goal_summary(response),
+    }
+    console.print(Panel(
+        f"Goal {goal['id']} {status} after {iterations} iteration(s) in {result['seconds']:.1f} s"
+        + (f"\nFiles changed: {', '.join(result['files'])}" if result["files"] else ""),
+        title="Planned Automode", title_align="left", style="green" if status == "completed" else "bold red"
+    ))
+    return result
+
+async def execute_goals(parent, request, goals, max_iterations):
+    # Every goal waits for its prerequisites, then runs as soon as a worker slot is free
+    slots = asyncio.Semaphore(PLAN_MAX_PARALLEL_GOALS)
+    tasks = {}
+
+    async def run(goal):
+        prerequisites = [await tasks[n] for n in goal["depends_on"]]
+        async with slots:
+            return await run_goal_worker(parent, request, goals, goal, prerequisites, max_iterations)
+
+    for goal in goals:
+        tasks[goal["id"]] = asyncio.ensure_future(run(goal))
+    try:
+        return list(await asyncio.gather(*tasks.values()))
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+def merge_goal_results(results):
+    lines = ["[Planned automode results] The goals of the plan were worked on by separate workers:"]
+    for result in results:
+        lines.append(f"\nGoal {result['id']} ({result['status']}, {result['iterations']} iteration(s)): {result['goal']}")
+        if result["files"]:
+            lines.append(f"Files changed: {', '.join(result['files'])}")
+        if result["summary"]:
+            lines.append(result["summary"])
+    writers = {}
+    for result in results:
+        for path in result["files"]:
+            writers.setdefault(path, []).append(result["id"])
+    shared = {path: ids for path, ids in writers.items() if len(ids) > 1}
+    if shared:
+        lines.append("\nFiles changed by more than one goal: " + "; ".join(f"{path} (goals {', '.join(map(str, ids))})" for path, ids in sorted(shared.items())))
+    lines.append("\nReview the combined result, fix anything that does not fit together or is unfinished, and say AUTOMODE_COMPLETE when the request is done.")
+    return "\n".join(lines)
+
+async def run_planned_automode_async(session, user_input, max_iterations):
+    # Plan with the parent session, run the goals concurrently as workers, then merge their results back
+    session.automode = True
+    try:
+        started = time.perf_counter()
+        response, _ = await chat_with_claude_async(session, PLANNING_PROMPT.format(request=user_input), current_iteration=1, max_iterations=max_iterations)
+        goals = parse_goals(response)
+        if not goals:
+            console.print(Panel("No goals found in the plan; continuing in regular automode.", title="Planned Automode", title_align="left", style="yellow"))
+            await run_automode_async(session, AUTOMODE_CONTINUE_PROMPT, max_iterations)
+            return
+        console.print(Panel(
+            "\n".join(f"Goal {goal['id']}: {goal['goal']}" + (f"  (after {', '.join(map(str, goal['depends_on']))})" if goal["depends_on"] else "") for goal in goals),
+            title=f"Plan: {len(goals)} goals", title_align="left", style="bold yellow"
+        ))
+        results = await execute_goals(session, user_input, goals, max_iterations)
+        await chat_with_claude_async(session, merge_goal_results(results), current_iteration=1, max_iterations=1)
+        console.print(Panel(f"Planned automode finished {sum(r['status'] == 'completed' for r in results)} of {len(goals)} goals in {time.perf_counter() - started:.1f} s.", title="Planned Automode", title_align="left", style="green"))
+    finally:
+        session.automode = False
+
+def resume_automode_input(automode_state):
+    # The goal is only in history once the first iteration has finished
+    return AUTOMODE_CONTINUE_PROMPT if automode_state["iteration"] else automode_state["goal"]
+
+def cli_option(argv, flag, default=None):
+    if flag in argv and argv.index(flag) + 1 < len(argv):
+        return argv[argv.index(flag) + 1]
+    return default
+
+def load_batch_prompts(path):
+    # One JSON object per line with a "prompt" (or a backlog-style "title" and "body") and optional "id",
+    # "workdir" and "max_iterations"; lines that are not JSON objects are taken as the prompt itself
+    items, ids = [], set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                entry = line
+            if not isinstance(entry, dict):
+                entry = {"prompt": str(entry)}
+            prompt = entry.get("prompt") or "\n\n".join(part for part in (entry.get("title"), entry.get("body")) if part)
+            if not prompt:
+                raise ValueError(f"{path}:{number}: no prompt")
+            item_id = str(entry.get("id") or entry.get("request_id") or f"{number:04d}")
+            if item_id in ids:
+                raise ValueError(f"{path}:{number}: duplicate id {item_id!r}")
+            ids.add(item_id)
+            items.append({"id": item_id, "prompt": prompt, "workdir": entry.get("workdir"), "max_iterations": entry.get("max_iterations")})
+    return items
+
+class BatchResultLog:
+    # JSON lines, one per finished prompt, written as each prompt finishes. It doubles as the progress
+    # record: a rerun skips prompts that already have a result and retries the ones that failed.
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def load(self):
+        results = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    results[result["id"]] = result
+        return results
+
+    def append(self, result):
+        if self.file is None:
+            # Drop a partial last line left by a crash mid-write before appending after it
+            if os.path.exists(self.path):
+                with open(self.path, 'rb+') as f:
+                    data = f.read()
+                    if data and not data.endswith(b"\n"):
+                        f.truncate(data.rfind(b"\n") + 1)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(result, default=str) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def batch_item_failed(result):
+    return result is None or result["status"].startswith("failed")
+
+async def run_batch_item(item, max_iterations, root, template=None):
+    # Runs one prompt in automode in its own session and working directory. With journaling on, an
+    # interrupted prompt continues from its last finished iteration when the batch is run again.
+    safe_name = re.sub(r"[^\w.-]", "_", item["id"])
+    workdir = os.path.abspath(item["workdir"] or os.path.join(root, safe_name))
+    if template and not os.path.isdir(workdir):
+        await asyncio.to_thread(shutil.copytree, template, workdir, ignore=shutil.ignore_patterns(*IGNORED_DIRS))
+    os.makedirs(workdir, exist_ok=True)
+    await asyncio.to_thread(recover_transactions, os.path.join(workdir, TRANSACTION_DIR))
+    max_iterations = item["max_iterations"] or max_iterations
+
+    session = Session(automode=True, render=False, name=item["id"], workdir=workdir)
+    iterations, user_input = 0, item["prompt"]
+    if SESSION_JOURNAL:
+        session.journal = SessionJournal(safe_name, os.path.join(root, SESSION_DIR))
+        session.history, session.digest, automode_state = session.journal.load()
+        if automode_state:
+            iterations, user_input = automode_state["iteration"], resume_automode_input(automode_state)
+
+    started = time.perf_counter()
+    status, response, usage = "incomplete", "", {}
+    try:
+        while iterations < max_iterations:
+            if session.journal is not None:
+                session.journal.record_automode({"goal": item["prompt"], "iteration": iterations, "max_iterations": max_iterations})
+            iterations += 1
+            response, exit_continuation = await chat_with_claude_async(session, user_input, current_iteration=iterations, max_iterations=max_iterations)
+            for field, count in session.usage.items():
+                usage[field] = usage.get(field, 0) + count
+            # A turn that failed returns an apology without adding its reply to the history
+            if not session.history or session.history[-1]["content"] is not response:
+                status = "failed: API error"
+                break
+            if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
+                status = "completed"
+                break
+            user_input = AUTOMODE_CONTINUE_PROMPT
+    except Exception as e:
+        status = f"failed: {str(e)}"
+    finally:
+        if session.journal is not None:
+            session.journal.close()
+    text = response.replace(CONTINUATION_EXIT_PHRASE, "").strip()
+    return {
+        "id": item["id"],
+        "status": status,
+        "iterations": iterations,
+        "seconds": round(time.perf_counter() - started, 3),
+        "workdir": workdir,
+        "files": sorted(session.files_written),
+        "usage": usage,
+        "response": text if len(text) <= BATCH_RESPONSE_MAX_CHARS else text[:BATCH_RESPONSE_MAX_CHARS] + "...",
+    }
+
+async def run_batch(argv):
+    # Headless entry point: --batch prompts.jsonl [--concurrency N] [--max-iterations N] [--output results.jsonl]
+    # [--workdir-root DIR] [--template DIR]. Every session's API calls share the process-wide scheduler, so
+    # the rate limits hold across the whole batch however many sessions run at once.
+    path = cli_option(argv, "--batch")
+    concurrency = int(cli_option(argv, "--concurrency", BATCH_CONCURRENCY))
+    max_iterations = int(cli_option(argv, "--max-iterations", MAX_CONTINUATION_ITERATIONS))
+    output = cli_option(argv, "--output") or os.path.splitext(path)[0] + ".results.jsonl"
+    root = cli_option(argv, "--workdir-root", BATCH_WORKDIR_ROOT)
+    template = cli_option(argv, "--template")
+
+    items = load_batch_prompts(path)
+    log = BatchResultLog(output)
+    previous = log.load()
+    pending = [item for item in items if batch_item_failed(previous.get(item["id"]))]
+    console.print(Panel(
+        f"{len(items)} prompts, {len(items) - len(pending)} already done; running {len(pending)} with {concurrency} concurrent sessions.\n"
+        f"Working directories: {os.path.abspath(root)}\nResults: {os.path.abspath(output)}",
+        title="Batch", title_align="left", style="bold green"
+    ))
+
+    started = time.perf_counter()
+    statuses = {}
+    remaining = iter(pending)
+
+    async def worker():
+        for item in remaining:
+            result = await run_batch_item(item, max_iterations, root, template)
+            log.append(result)
+            status = result["status"].split(":")[0]
+            statuses[status] = statuses.get(status, 0) + 1
+            style = {"completed": "green", "incomplete": "yellow"}.get(status, "bold red")
+            console.print(f"[{style}]{result['id']}[/{style}] {result['status']} after {result['iterations']} iteration(s) in {result['seconds']:.1f} s "
+                          f"({sum(statuses.values())}/{len(pending)})", markup=True, highlight=False)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(pending)))))
+    finally:
+        log.close()
+        if async_client is not None:
+            await async_client.close()
+    stats = scheduler.stats
+    console.print(Panel(
+        (", ".join(f"{count} {status}" for status, count in sorted(statuses.items())) or "Nothing to run") + f" in {time.perf_counter() - started:.1f} s\n"
+        f"API requests: {stats['requests']}  |  Retries: {stats['retries']}  |  Rate limited: {stats['rate_limited']}  |  Admission wait: {stats['wait_seconds']:.1f} s",
+        title="Batch Finished", title_align="left", style="bold green"
+    ))
+
+async def main_async():
+    session = Session()
+    console.print(Panel("Welcome to the Claude-3-Sonnet Engineer Chat with Image Support! (async engine)", title="Welcome", style="bold green"))
+    console.print("Type 'exit' to end the conversation.")
+    console.print("Type 'image' to include an image in your message.")
+    console.print("Type 'automode [number]' to enter Autonomous mode with a specific number of iterations.")
+    console.print("Type 'automode plan [number]' to plan the work into goals and run independent goals in parallel.")
+    console.print("Type 'expand <id>' to page through a truncated tool result or diff.")
+    console.print("Type 'stats' for timing and token statistics, or 'stats export <file>' to save them.")
+    console.print("Press Ctrl+C while Claude is working to cancel the current request.")
+
+    report_recovered_transactions()
+    session.journal = open_session_journal(sys.argv[1:])
+    if session.journal is not None:
+        session.name = session.journal.name
+        session.history, session.digest, automode_state = restore_session(session.journal)
+        if automode_state:
+            console.print(Panel(f"Resuming automode at iteration {automode_state['iteration'] + 1} of {automode_state['max_iterations']}.", title_align="left", title="Automode", style="bold yellow"))
+            await run_automode_async(session, resume_automode_input(automode_state), automode_state["max_iterations"], automode_state["iteration"])
+            console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
+
+    while True:
+        user_input = await asyncio.to_thread(console.input, "[bold cyan]You:[/bold cyan] ")
+
+        if user_input.lower() == 'exit':
+            console.print(Panel("Thank you for chatting. Goodbye!", title_align="left", title="Goodbye", style="bold green"))
+            break
+
+        if user_input.lower() == 'stats' or user_input.lower().startswith('stats '):
+            handle_stats_command(user_input)
+            continue
+
+        if user_input.lower().startswith('expand '):
+            expand_output(user_input)
+            continue
+
+        if user_input.lower() == 'image':
+            image_paths = parse_image_paths(await asyncio.to_thread(console.input, "[bold cyan]Drag and drop your images here, then press enter:[/bold cyan] "))
+            if not image_paths:
+                console.print(Panel("Invalid image path. Please try again.", title="Error", style="bold red"))
+                continue
+            user_input = await asyncio.to_thread(console.input, "[bold cyan]You (prompt for image):[/bold cyan] ")
+            result = await run_cancellable(chat_with_claude_async(session, user_input, image_paths))
+        elif user_input.lower().startswith('automode plan'):
+            parts = user_input.split()
+            max_iterations = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else MAX_CONTINUATION_ITERATIONS
+            console.print(Panel(f"Entering planned automode with up to {max_iterations} iterations per goal. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))
+            user_input = await asyncio.to_thread(console.input, "[bold cyan]You:[/bold cyan] ")
+            if await run_cancellable(run_planned_automode_async(session, user_input, max_iterations)) is None:
+                console.print(Panel("Planned automode interrupted by user.", title_align="left", title="Automode", style="bold red"))
+            console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
+            continue
+        elif user_input.lower().startswith('automode'):
+            parts = user_input.split()
+            max_iterations = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else MAX_CONTINUATION_ITERATIONS
+            console.print(Panel(f"Entering automode with {max_iterations} iterations. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))
+            console.print(Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow"))
+            user_input = await asyncio.to_thread(console.input, "[bold cyan]You:[/bold cyan] ")
+            await run_automode_async(session, user_input, max_iterations)
+            console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
+            continue
+        else:
+            result = await run_cancellable(chat_with_claude_async(session, user_input))
+
+        if result is None:
+            console.print(Panel("Request cancelled.", title_align="left", title="Cancelled", style="bold yellow"))
+
+    if session.journal is not None:
+        session.journal.close()
+    if async_client is not None:
+        await async_client.close()
+
+def run_automode(user_input, max_iterations, iteration_count=0):
+    global automode
+    automode = True
+    goal = user_input
+    try:
+        while automode and iteration_count < max_iterations:
+            if session_journal is not None:
+                session_journal.record_automode({"goal": goal, "iteration": iteration_count, "max_iterations": max_iterations})
+            response, exit_continuation = chat_with_claude(user_input, current_iteration=iteration_count+1, max_iterations=max_iterations)
+
+            if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
+                console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))
+                automode = False
+            else:
+                console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))
+                user_input = AUTOMODE_CONTINUE_PROMPT
+            iteration_count += 1
+
+            if iteration_count >= max_iterations:
+                console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))
+                automode = False
+    except KeyboardInterrupt:
+        console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
+        automode = False
+        if conversation_history and conversation_history[-1]["role"] == "user":
+            conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})
+    if session_journal is not None:
+        session_journal.record(conversation_history, conversation_digest)
+        session_journal.record_automode(None)
+
+planning_loop = None
+
+def run_planned_automode(user_input, max_iterations):
+    # The sync REPL runs planned automode on the async engine, in one event loop kept for the process
+    # so the pooled async client's connections stay valid between runs
+    global conversation_history, conversation_digest, planning_loop
+    session = Session(history=conversation_history, name=session_label())
+    session.digest = conversation_digest
+    session.journal = session_journal
+    planning_loop = planning_loop or asyncio.new_event_loop()
+    task = planning_loop.create_task(run_planned_automode_async(session, user_input, max_iterations))
+    try:
+        planning_loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        planning_loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        console.print(Panel("\nPlanned automode interrupted by user.", title_align="left", title="Automode", style="bold red"))
+    finally:
+        conversation_history, conversation_digest = session.history, session.digest
+
 def main():
-    global automode, conversation_history
+    global automode, conversation_history, conversation_digest, session_journal
     console.print(Panel("Welcome to the Claude-3-Sonnet Engineer Chat with Image Support!", title="Welcome", style="bold green"))
     console.print("Type 'exit' to end the conversation.")
     console.print("Type 'image' to include an image in your message.")
     console.print("Type 'automode [number]' to enter Autonomous mode with a specific number of iterations.")
+    console.print("Type 'automode plan [number]' to plan the work into goals and run independent goals in parallel.")
+    console.print("Type 'expand <id>' to page through a truncated tool result or diff.")
+    console.print("Type 'stats' for timing and token statistics, or 'stats export <file>' to save them.")
     console.print("While in automode, press Ctrl+C at any time to exit the automode to return to regular chat.")
 
+    report_recovered_transactions()
+    session_journal = open_session_journal(sys.argv[1:])
+    if session_journal is not None:
+        conversation_history, conversation_digest, automode_state = restore_session(session_journal)
+        if automode_state:
+            console.print(Panel(f"Resuming automode at iteration {automode_state['iteration'] + 1} of {automode_state['max_iterations']}.", title_align="left", title="Automode", style="bold yellow"))
+            run_automode(resume_automode_input(automode_state), automode_state["max_iterations"], automode_state["iteration"])
+            console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
+
     while True:
         user_input = console.input("[bold cyan]You:[/bold cyan] ")
 
@@ -551,15 +4423,34 @@ def main():
             console.print(Panel("Thank you for chatting. Goodbye!", title_align="left", title="Goodbye", style="bold green"))
             break
 
+        if user_input.lower() == 'stats' or user_input.lower().startswith('stats '):
+            handle_stats_command(user_input)
+            continue
+
+        if user_input.lower().startswith('expand '):
+            expand_output(user_input)
+            continue
+
         if user_input.lower() == 'image':
-            image_path = console.input("[bold cyan]Drag and drop your image here, then press enter:[/bold cyan] ").strip().replace("'", "")
+            image_paths = parse_image_paths(console.input("[bold cyan]Drag and drop your images here, then press enter:[/bold cyan] "))
 
-            if os.path.isfile(image_path):
+            if image_paths:
                 user_input = console.input("[bold cyan]You (prompt for image):[/bold cyan] ")
-                response, _ = chat_with_claude(user_input, image_path)
+                response, _ = chat_with_claude(user_input, image_paths)
             else:
                 console.print(Panel("Invalid image path. Please try again.", title="Error", style="bold red"))
                 continue
+        elif user_input.lower().startswith('automode plan'):
+            parts = user_input.split()
+            max_iterations = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else MAX_CONTINUATION_ITERATIONS
+            console.print(Panel(f"Entering planned automode with up to {max_iterations} iterations per goal. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))
+            console.print(Panel("Press Ctrl+C at any time to stop all workers.", style="bold yellow"))
+            try:
+                user_input = console.input("[bold cyan]You:[/bold cyan] ")
+                run_planned_automode(user_input, max_iterations)
+            except KeyboardInterrupt:
+                console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
+            console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
         elif user_input.lower().startswith('automode'):
             try:
                 parts = user_input.split()
@@ -573,27 +4464,7 @@ def main():
                 console.print(Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow"))
                 user_input = console.input("[bold cyan]You:[/bold cyan] ")
 
-                iteration_count = 0
-                try:
-                    while automode and iteration_count < max_iterations:
-                        response, exit_continuation = chat_with_claude(user_input, current_iteration=iteration_count+1, max_iterations=max_iterations)
-
-                        if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
-                            console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))
-                            automode = False
-                        else:
-                            console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))
-                            user_input = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."
-                        iteration_count += 1
-
-                        if iteration_count >= max_iterations:
-                            console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))
-                            automode = False
-                except KeyboardInterrupt:
-                    console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
-                    automode = False
-                    if conversation_history and conversation_history[-1]["role"] == "user":
-                        conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})
+                run_automode(user_input, max_iterations)
             except KeyboardInterrupt:
                 console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
                 automode = False
@@ -604,5 +4475,13 @@ def main():
         else:
             response, _ = chat_with_claude(user_input)
 
+    if session_journal is not None:
+        session_journal.close()
+
 if __name__ == "__main__":
-    main()
+    if "--batch" in sys.argv[1:]:
+        asyncio.run(run_batch(sys.argv[1:]))
+    elif "--async" in sys.argv[1:]:
+        asyncio.run(main_async())
+    else:
+        main()
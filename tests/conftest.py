@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def isolated_main(tmp_path, monkeypatch):
+    # Every test runs in its own empty working directory with caches under tmp_path and output discarded
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+    monkeypatch.setattr(main, "TAVILY_CACHE_PATH", str(tmp_path / "cache" / "tavily_cache.sqlite3"))
+    monkeypatch.setattr(main, "OUTLINE_CACHE_PATH", str(tmp_path / "cache" / "outline_cache.sqlite3"))
+    monkeypatch.setattr(main, "console", main.InstrumentedConsole(file=open(os.devnull, "w"), width=120))
+    monkeypatch.setattr(main, "conversation_history", [])
+    monkeypatch.setattr(main, "conversation_digest", "")
+    monkeypatch.setattr(main, "automode", False)
+    monkeypatch.setattr(main, "session_journal", None)
+    monkeypatch.setattr(main, "search_index", {"files": {}, "trigrams": {}, "roots": {}})
+    main.forget_file_reads()
+    main.read_cache.clear()
+    yield workdir
+    main.render_queue.flush()
+    if main.outline_pool is not None:
+        main.outline_pool.shutdown(wait=True)
+        main.outline_pool = None
+    for name in ("outline_cache_db", "tavily_cache_db"):
+        if getattr(main, name) is not None:
+            getattr(main, name).close()
+            setattr(main, name, None)
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    # The bench stand-in for the Messages API; script() the responses a test expects
+    from anthropic import Anthropic, AsyncAnthropic
+
+    import bench
+
+    api = bench.FakeAPI(default_latency=0)
+    monkeypatch.setattr(main, "client", Anthropic(api_key="test", base_url=api.url, max_retries=0))
+    monkeypatch.setattr(main, "async_client", AsyncAnthropic(api_key="test", base_url=api.url, max_retries=0))
+    monkeypatch.setattr(main, "scheduler", main.RequestScheduler(1_000_000, 1_000_000_000, main.MAX_CONCURRENT_REQUESTS))
+    yield api
+    api.close()
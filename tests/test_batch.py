@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def item_session(isolated_main):
+    # A batch item: its workdir sits next to another item's, both below the process cwd
+    for item in ("item1", "item2"):
+        package = isolated_main / "batch" / item / "pkg"
+        package.mkdir(parents=True)
+        (package / "mod.py").write_text(f"def {item}_function():\n    return 'needle'\n")
+    (isolated_main / "outside.txt").write_text("needle\n")
+    session = main.Session(render=False, workdir=os.path.join("batch", "item1"))
+    token = main.current_session.set(session)
+    yield session
+    main.current_session.reset(token)
+
+
+def test_default_paths_mean_the_session_workdir(item_session):
+    listing = main.execute_tool("list_files", {})
+    assert listing.splitlines() == ["pkg"]
+    search = main.execute_tool("search_file", {"search_pattern": "needle"})
+    assert "Found 1 matches in 1 files" in search
+    assert "item2" not in search and "outside.txt" not in search
+    outline = main.execute_tool("code_outline", {})
+    assert "item1_function" in outline and "item2_function" not in outline
+
+
+def test_reported_paths_round_trip_to_other_tools(item_session):
+    search = main.execute_tool("search_file", {"search_pattern": "needle"})
+    reported = next(line for line in search.splitlines() if ":2:" in line).split(":")[0]
+    assert reported == os.path.join("pkg", "mod.py")
+    assert "item1_function" in main.execute_tool("read_file", {"path": reported})
+    assert main.execute_tool("create_file", {"path": "new.txt", "content": "x"}) == "File created: new.txt"
+    assert main.execute_tool("read_file", {"path": "new.txt"}) == "x"
+
+
+def test_paths_cannot_leave_the_session_workdir(item_session, isolated_main):
+    for path in ("../item2/pkg/mod.py", str(isolated_main / "outside.txt")):
+        result = main.execute_tool("read_file", {"path": path})
+        assert result.startswith("Error:") and "outside the working directory" in result
+    result = main.execute_tool("batch_edit", {"changes": [{"path": "../../escape.txt", "content": "x"}]})
+    assert "outside the working directory" in result
+    assert not (isolated_main / "escape.txt").exists()
+    # Absolute paths inside the workdir are fine
+    inside = os.path.abspath(os.path.join("batch", "item1", "pkg", "mod.py"))
+    assert "item1_function" in main.execute_tool("read_file", {"path": inside})
@@ -0,0 +1,141 @@
+import difflib
+import random
+import time
+
+import main
+
+
+def apply_opcodes(a_lines, b_lines, opcodes):
+    result = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            assert a_lines[i1:i2] == b_lines[j1:j2]
+            result.extend(a_lines[i1:i2])
+        else:
+            result.extend(b_lines[j1:j2])
+    return result
+
+
+def random_text(rng, lines):
+    return "".join(rng.choice(["a\n", "b\n", "c\n", "\n", "}\n", f"line {rng.randint(0, 50)}\n"]) for _ in range(lines))
+
+
+def test_opcodes_rebuild_the_new_content():
+    rng = random.Random(1)
+    for _ in range(500):
+        original = random_text(rng, rng.randint(0, 30))
+        new = random_text(rng, rng.randint(0, 30)) if rng.random() < 0.3 else original
+        lines = new.splitlines(keepends=True)
+        for _ in range(rng.randint(0, 4)):
+            position = rng.randint(0, len(lines))
+            lines[position:position + rng.randint(0, 3)] = random_text(rng, rng.randint(0, 3)).splitlines(keepends=True)
+        new = "".join(lines)
+        a_lines, b_lines, opcodes, added, removed = main.line_diff(original, new)
+        assert "".join(apply_opcodes(a_lines, b_lines, opcodes)) == new
+        equal = sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == "equal")
+        assert (added, removed) == (len(b_lines) - equal, len(a_lines) - equal)
+
+
+def test_file_diff_applies_back_with_patch_hunks():
+    rng = random.Random(2)
+    for _ in range(200):
+        original = random_text(rng, rng.randint(1, 40))
+        lines = original.splitlines(keepends=True)
+        for _ in range(rng.randint(1, 3)):
+            position = rng.randint(0, len(lines))
+            lines[position:position + rng.randint(0, 2)] = random_text(rng, rng.randint(0, 2)).splitlines(keepends=True)
+        new = "".join(lines)
+        diff_text, added, removed = main.file_diff(original, new, "f.txt")
+        if original == new:
+            assert diff_text == "" and (added, removed) == (0, 0)
+            continue
+        body = [line for line in diff_text.splitlines() if not line.startswith(("---", "+++", "@@"))]
+        assert (added, removed) == (sum(line.startswith("+") for line in body), sum(line.startswith("-") for line in body))
+        assert main.apply_hunks(original, main.parse_unified_diff(diff_text)) == new
+
+
+def test_scattered_edits_are_no_larger_than_difflib():
+    original = "".join(f"value_{i} = compute({i})\n" for i in range(2000))
+    lines = original.splitlines(keepends=True)
+    for i in range(0, 2000, 97):
+        lines[i] = f"value_{i} = changed({i})\n"
+    new = "".join(lines)
+    _, added, removed = main.file_diff(original, new, "f.py")
+    expected = list(difflib.unified_diff(original.splitlines(True), new.splitlines(True), n=0))
+    assert added == sum(line.startswith("+") and not line.startswith("+++") for line in expected)
+    assert removed == sum(line.startswith("-") and not line.startswith("---") for line in expected)
+
+
+def test_missing_final_newline_is_marked():
+    diff_text, added, removed = main.file_diff("a\nb\n", "a\nc", "f.txt")
+    assert diff_text.endswith("+c\n\\ No newline at end of file\n")
+    assert (added, removed) == (1, 1)
+
+
+def test_huge_files_get_a_summary(monkeypatch):
+    monkeypatch.setattr(main, "DIFF_MAX_BYTES", 100)
+    original = "".join(f"line {i}\n" for i in range(50))
+    new = original.replace("line 20\n", "line twenty\nline 20b\n")
+    diff_text, added, removed = main.file_diff(original, new, "f.txt")
+    assert (added, removed) == (2, 1)
+    assert "50 -> 51 lines; too large for a line diff, 1 lines replaced by 2" in diff_text
+    assert main.count_changed_lines(original, new) == (2, 1)
+
+
+def count_myers_calls(monkeypatch):
+    calls = []
+    myers_matches = main.myers_matches
+
+    def counting(a, alo, ahi, b, blo, bhi, max_cost):
+        calls.append(((ahi - alo) + (bhi - blo), max_cost))
+        return myers_matches(a, alo, ahi, b, blo, bhi, max_cost)
+
+    monkeypatch.setattr(main, "myers_matches", counting)
+    return calls
+
+
+def test_gaps_sharing_no_lines_skip_myers(monkeypatch):
+    # Reordered unique lines leave gaps between the patience anchors that share nothing
+    rng = random.Random(3)
+    lines = [f"item {i}\n" for i in range(5000)]
+    shuffled = lines[:]
+    rng.shuffle(shuffled)
+    calls = count_myers_calls(monkeypatch)
+    a_lines, b_lines, opcodes, _, _ = main.line_diff("".join(lines), "".join(shuffled))
+    assert calls == []
+    assert "".join(apply_opcodes(a_lines, b_lines, opcodes)) == "".join(shuffled)
+
+
+def test_myers_budget_follows_the_shared_lines(monkeypatch):
+    original = "".join(f"def f{i}():\n    pass\n\n" for i in range(300))
+    new = "".join(f"def g{i}():\n    pass\n\n" for i in range(300))
+    calls = count_myers_calls(monkeypatch)
+    _, added, removed = main.file_diff(original, new, "f.py")
+    assert (added, removed) == (300, 300)
+    assert all(max_cost <= main.DIFF_MYERS_MAX_COST for _, max_cost in calls)
+
+
+def reordered_cases():
+    rng = random.Random(1)
+    blocks = [f"def f{i}():\n    x = {rng.randint(0, 9)}\n    return x\n\n" for i in range(5000)]
+    shuffled = blocks[:]
+    for i in rng.sample(range(len(blocks)), 1000):
+        j = rng.randrange(len(blocks))
+        shuffled[i], shuffled[j] = shuffled[j], shuffled[i]
+    yield "".join(blocks), "".join(shuffled)
+    lines = [f"item {i}\n" for i in range(20000)]
+    shuffled = lines[:]
+    rng.shuffle(shuffled)
+    yield "".join(lines), "".join(shuffled)
+
+
+def test_reordered_content_is_not_slower_than_difflib():
+    for original, new in reordered_cases():
+        started = time.perf_counter()
+        main.file_diff(original, new, "f.py")
+        ours = time.perf_counter() - started
+        started = time.perf_counter()
+        list(difflib.unified_diff(original.splitlines(True), new.splitlines(True)))
+        reference = time.perf_counter() - started
+        # Generous margin: only a regression to quadratic gap handling should trip this
+        assert ours < 3 * reference + 0.3
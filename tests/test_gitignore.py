@@ -0,0 +1,78 @@
+import main
+
+
+def write_tree(root, paths):
+    for path in paths:
+        target = root / path
+        if path.endswith("/"):
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_text("")
+
+
+def listed(root):
+    return set(main.scan_tree(str(root), 10, 1000)["entries"])
+
+
+def test_unanchored_patterns_match_at_any_depth(isolated_main):
+    (isolated_main / ".git").mkdir()
+    (isolated_main / ".gitignore").write_text("*.log\nsecret.txt\n")
+    write_tree(isolated_main, ["a.log", "src/b.log", "src/deep/secret.txt", "src/keep.py"])
+    entries = listed(isolated_main)
+    assert "src/keep.py" in entries
+    assert not {"a.log", "src/b.log", "src/deep/secret.txt"} & entries
+
+
+def test_negation_directory_only_and_double_star(isolated_main):
+    (isolated_main / ".git").mkdir()
+    (isolated_main / ".gitignore").write_text("*.tmp\n!keep.tmp\ncache/\ndocs/**/draft.md\n")
+    write_tree(isolated_main, ["x.tmp", "keep.tmp", "cache/", "src/cache/", "data/cache", "docs/a/b/draft.md", "docs/draft.md"])
+    entries = listed(isolated_main)
+    assert "keep.tmp" in entries and "x.tmp" not in entries
+    assert "cache/" not in entries and "src/cache/" not in entries
+    # A directory-only pattern leaves files of that name alone
+    assert "data/cache" in entries
+    assert "docs/a/b/draft.md" not in entries and "docs/draft.md" not in entries
+
+
+def test_nested_gitignore_applies_relative_to_its_directory(isolated_main):
+    (isolated_main / ".git").mkdir()
+    write_tree(isolated_main, ["pkg/out/a.txt", "out/b.txt"])
+    (isolated_main / "pkg" / ".gitignore").write_text("out/\n")
+    entries = listed(isolated_main)
+    assert "pkg/out/" not in entries
+    assert "out/b.txt" in entries
+
+
+def test_leading_and_inner_slashes_anchor_the_pattern(isolated_main):
+    (isolated_main / ".git").mkdir()
+    (isolated_main / ".gitignore").write_text("/assets/\n/out\nsrc/gen/\n")
+    write_tree(isolated_main, ["assets/", "pkg/assets/", "out", "pkg/out", "src/gen/", "lib/src/gen/"])
+    entries = listed(isolated_main)
+    assert "assets/" not in entries and "pkg/assets/" in entries
+    assert "out" not in entries and "pkg/out" in entries
+    assert "src/gen/" not in entries and "lib/src/gen/" in entries
+
+
+def test_details_follow_files_that_change_in_place(isolated_main):
+    write_tree(isolated_main, ["src/"])
+    target = isolated_main / "src" / "data.bin"
+    target.write_bytes(b"x" * 4)
+    assert "src/data.bin  (4 B," in main.list_files(".", recursive=True, include_details=True)
+    # Rewriting an existing file leaves its directory's mtime alone
+    target.write_bytes(b"x" * 4000)
+    listing = main.list_files(".", recursive=True, include_details=True)
+    assert f"src/data.bin  ({main.format_size(4000)}," in listing
+
+
+def test_gitignore_edited_in_place_invalidates_snapshot(isolated_main):
+    (isolated_main / ".git").mkdir()
+    (isolated_main / ".gitignore").write_text("*.log\n")
+    write_tree(isolated_main, ["src/app.py", "notes.txt"])
+    assert "src/app.py" in main.list_files(".", recursive=True)
+    with open(isolated_main / ".gitignore", "a") as handle:
+        handle.write("src/\n")
+    listing = main.list_files(".", recursive=True)
+    assert "src/" not in listing
+    assert "notes.txt" in listing
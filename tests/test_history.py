@@ -0,0 +1,90 @@
+import json
+
+import main
+
+
+def tool_turn(number):
+    tool_use_id = f"toolu_{number}"
+    return [
+        {"role": "user", "content": f"question {number}"},
+        {"role": "assistant", "content": [{"type": "tool_use", "id": tool_use_id, "name": "list_files", "input": {"path": "."}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_use_id, "content": "a.txt\n" * 50}]},
+        {"role": "assistant", "content": f"answer {number}"},
+    ]
+
+
+def journal_ops(journal):
+    with open(journal.journal_path, encoding="utf-8") as f:
+        return [json.loads(line)["op"] for line in f]
+
+
+def test_elision_keeps_messages_it_does_not_change():
+    history = tool_turn(1) + tool_turn(2)
+    elided = main.elide_stale_tool_payloads(history, len(history))
+    assert all(new is old for new, old in zip(elided, history))
+
+
+def test_journal_appends_while_elision_changes_nothing(isolated_main):
+    # Every compaction pass re-runs elision over the older turns; with nothing stale the journal must keep
+    # appending messages instead of logging a full-history reset each turn
+    journal = main.SessionJournal("test", root=str(isolated_main / ".sessions"))
+    history = []
+    for number in range(8):
+        protected_from = len(history)
+        history = main.elide_stale_tool_payloads(history + tool_turn(number), protected_from)
+        journal.record(history, "")
+    assert journal_ops(journal) == ["message"] * 32
+    journal.close()
+    assert main.SessionJournal("test", root=str(isolated_main / ".sessions")).load()[0] == history
+
+
+def test_compaction_with_nothing_to_remove_is_a_no_op(isolated_main, monkeypatch):
+    import io
+
+    output = io.StringIO()
+    monkeypatch.setattr(main, "console", main.InstrumentedConsole(file=output, width=120))
+    (isolated_main / "a.txt").write_text("hello\n")
+    main.read_file("a.txt")
+    main.commit_file_reads()
+    # Three turns, all protected: over budget, but nothing can be elided or summarized
+    history = tool_turn(1) + tool_turn(2) + tool_turn(3)
+    compacted, digest = main.compact_history(history, "", budget=1)
+    assert compacted is history and digest == ""
+    assert "compacted" not in output.getvalue()
+    assert main.read_file("a.txt").startswith(main.READ_UNCHANGED_MARKER)
+
+
+def test_batch_edit_contents_are_elided_and_make_earlier_reads_stale():
+    history = [
+        {"role": "user", "content": "change a.txt"},
+        {"role": "assistant", "content": [{"type": "tool_use", "id": "toolu_read", "name": "read_file", "input": {"path": "a.txt"}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "toolu_read", "content": "old contents\n"}]},
+        {"role": "assistant", "content": [{"type": "tool_use", "id": "toolu_batch", "name": "batch_edit", "input": {"changes": [
+            {"path": "a.txt", "content": "new contents\n"},
+            {"path": "b.txt", "edits": [{"search": "x", "replace": "y"}]},
+        ]}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "toolu_batch", "content": "Transaction committed"}]},
+        {"role": "assistant", "content": "Done."},
+    ]
+    elided = main.elide_stale_tool_payloads(history, len(history))
+    assert elided[2]["content"][0]["content"].startswith("[Elided: stale contents of a.txt")
+    changes = elided[3]["content"][0]["input"]["changes"]
+    assert changes[0]["content"] == "[Elided: 13 characters written to a.txt]"
+    assert changes[1] is history[3]["content"][0]["input"]["changes"][1]
+    assert elided[4] is history[4]
+
+
+def test_compaction_notice_follows_the_session_render_flag(monkeypatch):
+    import io
+
+    output = io.StringIO()
+    monkeypatch.setattr(main, "console", main.InstrumentedConsole(file=output, width=120))
+    history = [message for number in range(6) for message in tool_turn(number)]
+    for render in (False, True):
+        token = main.current_session.set(main.Session(render=render))
+        try:
+            compacted, _ = main.compact_history(history, "", budget=1)
+        finally:
+            main.current_session.reset(token)
+        assert len(compacted) < len(history)
+        assert ("compacted" in output.getvalue()) is render
@@ -0,0 +1,86 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import main
+
+
+@pytest.fixture
+def image_store(monkeypatch):
+    monkeypatch.setattr(main, "image_store", {})
+    return main.image_store
+
+
+def png_base64(size=(800, 600)):
+    output = io.BytesIO()
+    Image.new("RGB", size, (10, 120, 200)).save(output, format="PNG")
+    return base64.b64encode(output.getvalue()).decode("ascii")
+
+
+def image_turn(reference, number):
+    return [
+        {"role": "user", "content": [reference, {"type": "text", "text": f"look {number}"}]},
+        {"role": "assistant", "content": f"seen {number}"},
+    ]
+
+
+def later_turns(count):
+    return [message for number in range(count) for message in (
+        {"role": "user", "content": f"question {number}"},
+        {"role": "assistant", "content": f"answer {number}"},
+    )]
+
+
+def test_identical_images_are_stored_once_and_referenced_by_hash(image_store):
+    data = png_base64()
+    first, second = main.store_image("image/png", data), main.store_image("image/png", data)
+    assert first == second
+    assert len(image_store) == 1
+    assert "data" not in first["source"] and first["source"]["type"] == "stored"
+
+
+def test_recent_images_are_sent_in_full(image_store):
+    data = png_base64()
+    history = image_turn(main.store_image("image/png", data), 1) + later_turns(main.IMAGE_HISTORY_KEEP_TURNS - 1)
+    [block, _] = main.materialize_images(history)[0]["content"]
+    assert block["source"] == {"type": "base64", "media_type": "image/png", "data": data}
+
+
+def test_old_images_are_downgraded_by_policy(image_store):
+    data = png_base64()
+    history = image_turn(main.store_image("image/png", data), 1) + later_turns(main.IMAGE_HISTORY_KEEP_TURNS)
+    thumbnail = main.materialize_images(history, "thumbnail")[0]["content"][0]["source"]["data"]
+    with Image.open(io.BytesIO(base64.b64decode(thumbnail))) as img:
+        assert max(img.size) == max(main.IMAGE_THUMBNAIL_SIZE)
+    assert len(thumbnail) < len(data)
+    placeholder = main.materialize_images(history, "placeholder")[0]["content"][0]
+    assert placeholder["type"] == "text" and "removed to save context" in placeholder["text"]
+    assert main.materialize_images(history, "keep")[0]["content"][0]["source"]["data"] == data
+    # Materializing never changes the stored history
+    assert history[0]["content"][0]["source"]["type"] == "stored"
+
+
+def test_missing_store_entries_become_a_note(image_store):
+    reference = main.store_image("image/png", png_base64())
+    image_store.clear()
+    assert main.materialize_images(image_turn(reference, 1))[0]["content"][0] == {"type": "text", "text": "[Image no longer available]"}
+
+
+def test_requests_carry_the_image_until_it_ages_out(isolated_main, image_store, fake_api, monkeypatch):
+    bodies = []
+    serve = fake_api.serve_messages
+    monkeypatch.setattr(fake_api, "serve_messages", lambda handler, body: bodies.append(body) or serve(handler, body))
+    Image.new("RGB", (800, 600), (10, 120, 200)).save(isolated_main / "shot.png")
+    main.chat_with_claude("what is this?", image_path=str(isolated_main / "shot.png"))
+    for number in range(main.IMAGE_HISTORY_KEEP_TURNS):
+        main.chat_with_claude(f"question {number}")
+
+    def sent_image(body):
+        return body["messages"][0]["content"][0]["source"]["data"]
+
+    assert sent_image(bodies[0]) == sent_image(bodies[-2])
+    assert len(sent_image(bodies[-1])) < len(sent_image(bodies[0]))
+    # The history keeps only the reference, whatever was sent
+    assert main.conversation_history[0]["content"][0]["source"]["type"] == "stored"
@@ -0,0 +1,88 @@
+import base64
+import io
+import random
+from collections import OrderedDict
+
+import pytest
+from PIL import Image
+
+import main
+
+
+@pytest.fixture
+def image_cache(monkeypatch):
+    monkeypatch.setattr(main, "image_cache", OrderedDict())
+    yield main.image_cache
+    if main.image_process_pool is not None:
+        main.image_process_pool.shutdown(wait=True)
+        main.image_process_pool = None
+
+
+def screenshot(path, size=(2048, 1536), color=(30, 30, 200)):
+    # Flat colour areas, like a UI capture
+    img = Image.new("RGB", size, "white")
+    img.paste(color, (0, 0, size[0], 100))
+    img.save(path, format="PNG")
+    return str(path)
+
+
+def photo(path, size=(1600, 1200), seed=1):
+    rng = random.Random(seed)
+    img = Image.frombytes("RGB", size, rng.randbytes(size[0] * size[1] * 3))
+    img.save(path, format="JPEG", quality=95)
+    return str(path)
+
+
+def decoded(encoded):
+    return Image.open(io.BytesIO(base64.b64decode(encoded[1])))
+
+
+def test_screenshots_stay_png_and_photos_become_jpeg(isolated_main, image_cache):
+    [png] = main.encode_images([screenshot(isolated_main / "ui.png")])
+    [jpeg] = main.encode_images([photo(isolated_main / "photo.jpg")])
+    assert png[0] == "image/png" and jpeg[0] == "image/jpeg"
+    for encoded in (png, jpeg):
+        assert max(decoded(encoded).size) == max(main.IMAGE_MAX_SIZE)
+
+
+def test_identical_content_is_encoded_once(isolated_main, image_cache, monkeypatch):
+    first = screenshot(isolated_main / "a.png")
+    copy = isolated_main / "copy.png"
+    copy.write_bytes((isolated_main / "a.png").read_bytes())
+    calls = []
+    real_encode = main.encode_image_file
+    monkeypatch.setattr(main, "encode_image_file", lambda path, max_size: calls.append(path) or real_encode(path, max_size))
+    [encoded] = main.encode_images([first])
+    # A different path with the same bytes is a cache hit
+    assert main.encode_images([str(copy)]) == [encoded]
+    assert calls == [first]
+    # Changing the file changes its key
+    screenshot(isolated_main / "a.png", color=(200, 30, 30))
+    assert main.encode_images([first]) != [encoded]
+    assert len(calls) == 2
+
+
+def test_cache_keeps_the_most_recently_used_entries(isolated_main, image_cache, monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_CACHE_MAX_ENTRIES", 2)
+    paths = [screenshot(isolated_main / f"{n}.png", size=(64, 64), color=(n * 40, 0, 0)) for n in range(3)]
+    for path in paths[:2]:
+        main.encode_images([path])
+    main.encode_images([paths[0]])
+    main.encode_images([paths[2]])
+    assert len(image_cache) == 2
+    # paths[1] was the least recently used
+    kept = {main.encode_images([path])[0] for path in (paths[0], paths[2])}
+    assert set(image_cache.values()) == kept
+
+
+def test_several_images_are_encoded_in_the_pool_in_order(isolated_main, image_cache):
+    paths = [screenshot(isolated_main / f"{n}.png", size=(300 + n, 200), color=(0, n * 50, 0)) for n in range(3)]
+    missing = str(isolated_main / "missing.png")
+    (isolated_main / "broken.png").write_bytes(b"not an image")
+    results = main.encode_images([paths[0], paths[1], missing, paths[2], paths[0], str(isolated_main / "broken.png")])
+    assert main.image_process_pool is not None
+    assert [decoded(results[i]).size for i in (0, 1, 3)] == [(300, 200), (301, 200), (302, 200)]
+    assert results[4] == results[0]
+    assert results[2].startswith("Error encoding image") and results[5].startswith("Error encoding image")
+    # Failures are not cached
+    assert len(image_cache) == 3
@@ -0,0 +1,87 @@
+import json
+import os
+import re
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def metrics(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "metrics", main.Metrics())
+    monkeypatch.setattr(main, "METRICS_JSONL_PATH", str(tmp_path / "metrics.jsonl"))
+    return main.metrics
+
+
+def exported(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_spans_aggregate_and_export_their_attributes(metrics):
+    for size in (1, 2, 3):
+        with metrics.span("diff", path="a.py") as span:
+            span["lines"] = size
+    metrics.record_span("render", 0.5, export=False)
+    spans, _, _ = metrics.snapshot()
+    assert spans["diff"]["count"] == 3 and spans["render"]["count"] == 1
+    assert spans["diff"]["max"] <= spans["diff"]["seconds"] and spans["render"]["p95"] == 0.5
+    records = exported(main.METRICS_JSONL_PATH)
+    assert [(record["name"], record["path"], record["lines"]) for record in records] == [("diff", "a.py", size) for size in (1, 2, 3)]
+    assert all(record["session"] == "repl" for record in records)
+
+
+def test_spans_and_tokens_are_attributed_to_each_sessions_turn(metrics):
+    usage = main.anthropic_sdk().types.Usage(input_tokens=100, output_tokens=20, cache_read_input_tokens=50)
+    turns = {}
+    for name, seconds in (("first", 0.25), ("second", 0.5)):
+        token = main.current_session.set(main.Session(name=name, render=False))
+        try:
+            turn = metrics.begin_turn()
+            metrics.record_span("tool", seconds)
+            metrics.record_tokens("model-a", usage)
+            turns[name] = metrics.end_turn(turn)
+        finally:
+            main.current_session.reset(token)
+    assert turns["first"]["spans"] == {"tool": 0.25} and turns["second"]["spans"] == {"tool": 0.5}
+    assert turns["first"]["tokens"] == {"input_tokens": 100, "output_tokens": 20, "cache_read_input_tokens": 50, "cache_creation_input_tokens": 0}
+    _, tokens, recent = metrics.snapshot()
+    assert set(tokens) == {("first", "model-a"), ("second", "model-a")}
+    assert tokens[("first", "model-a")]["requests"] == 1
+    assert [turn["session"] for turn in recent] == ["first", "second"]
+    # Spans outside any open turn only count towards the process totals
+    metrics.record_span("tool", 1.0)
+    assert metrics.snapshot()[0]["tool"]["count"] == 3
+
+
+def test_prometheus_textfile(metrics, isolated_main):
+    usage = main.anthropic_sdk().types.Usage(input_tokens=7, output_tokens=3)
+    token = main.current_session.set(main.Session(name='odd "name"', render=False))
+    try:
+        metrics.record_span("api_call", 0.125)
+        metrics.record_tokens("model-a", usage)
+    finally:
+        main.current_session.reset(token)
+    path = isolated_main / "metrics.prom"
+    main.handle_stats_command(f"stats export {path}")
+    text = path.read_text()
+    assert 'claude_engineer_span_seconds_total{span="api_call"} 0.125000' in text
+    assert 'claude_engineer_spans_total{span="api_call"} 1' in text
+    assert 'claude_engineer_tokens_total{session="odd \\"name\\"",model="model-a",kind="input"} 7' in text
+    assert 'claude_engineer_api_requests_total{session="odd \\"name\\"",model="model-a"} 1' in text
+    # Every sample belongs to a declared counter, and nothing is left behind by the atomic write
+    declared = set(re.findall(r"^# TYPE (\S+) counter$", text, re.MULTILINE))
+    samples = [line for line in text.splitlines() if not line.startswith("#")]
+    assert samples and all(re.match(r"^(\w+)(\{.*\})? [0-9.]+$", line).group(1) in declared for line in samples)
+    assert os.listdir(isolated_main) == ["metrics.prom"]
+
+
+def test_a_turn_records_api_calls_and_tokens(metrics, fake_api):
+    fake_api.script([{"content": [{"type": "text", "text": "hello"}]}])
+    main.chat_with_claude("hi")
+    [turn] = metrics.snapshot()[2]
+    assert turn["counts"]["api_call"] == 1
+    assert turn["tokens"]["input_tokens"] > 0 and turn["tokens"]["output_tokens"] > 0
+    [api_call] = [record for record in exported(main.METRICS_JSONL_PATH) if record.get("name") == "api_call"]
+    assert api_call["model"] == main.MAINMODEL and api_call["input_tokens"] == turn["tokens"]["input_tokens"]
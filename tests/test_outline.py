@@ -0,0 +1,89 @@
+import os
+import time
+
+import pytest
+
+import main
+
+SOURCE = "import os\n\nclass Store:\n    def get(self, key):\n        return key\n\n    async def put(self, key, value=None):\n        pass\n\n\ndef helper(a, b):\n    return a + b\n"
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    monkeypatch.setattr(main, "outline_counters", dict.fromkeys(main.outline_counters, 0))
+    return main.outline_counters
+
+
+def wait_for_background_refresh():
+    main.outline_pool.shutdown(wait=True)
+    main.outline_pool = None
+
+
+def test_python_and_declaration_outlines(isolated_main, counters):
+    (isolated_main / "app.py").write_text(SOURCE)
+    (isolated_main / "ui.js").write_text("export function render(props) {\n  return props;\n}\n\nclass Widget {\n  draw() {\n  }\n}\n")
+    (isolated_main / "notes.txt").write_text("not code\n")
+    assert main.code_outline(".") == (
+        "app.py (12 lines)\n"
+        "  class Store  [3-8]\n"
+        "    def get(self, key)  [4-5]\n"
+        "    async def put(self, key, value=None)  [7-8]\n"
+        "  def helper(a, b)  [11-12]\n"
+        "ui.js (8 lines)\n"
+        "  export function render(props)  [1-3]\n"
+        "  class Widget  [5-8]\n"
+        "    draw()  [6-7]"
+    )
+    assert counters["parsed"] == 2
+
+
+def test_index_is_reused_until_the_file_changes(isolated_main, counters):
+    path = isolated_main / "app.py"
+    path.write_text(SOURCE)
+    first = main.code_outline("app.py")
+    assert main.code_outline("app.py") == first
+    assert (counters["parsed"], counters["hits"]) == (1, 1)
+    # A new mtime with the same contents only costs a hash
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert main.code_outline("app.py") == first
+    assert counters["rehashed"] == 1
+    # Changed contents are parsed again
+    path.write_text(SOURCE + "\ndef extra():\n    pass\n")
+    assert "def extra()  [14-15]" in main.code_outline("app.py")
+    assert counters["parsed"] == 2
+
+
+def test_index_persists_across_connections(isolated_main, counters):
+    (isolated_main / "app.py").write_text(SOURCE)
+    first = main.code_outline("app.py")
+    main.outline_cache_db.close()
+    main.outline_cache_db = None
+    assert main.code_outline("app.py") == first
+    assert (counters["parsed"], counters["hits"]) == (1, 1)
+    assert os.path.exists(main.OUTLINE_CACHE_PATH)
+
+
+def test_files_written_by_tools_are_reindexed_in_the_background(isolated_main, counters):
+    main.create_file("app.py", SOURCE)
+    wait_for_background_refresh()
+    assert counters["background"] == 1 and counters["parsed"] == 1
+    assert "def helper(a, b)" in main.code_outline("app.py")
+    assert counters["hits"] == 1
+    main.batch_edit([{"path": "app.py", "delete": True}])
+    wait_for_background_refresh()
+    rows = main.get_outline_cache_db().execute("SELECT COUNT(*) FROM outlines").fetchone()[0]
+    assert rows == 0
+
+
+def test_large_files_are_skipped_and_old_entries_evicted(isolated_main, counters, monkeypatch):
+    monkeypatch.setattr(main, "OUTLINE_MAX_FILE_BYTES", 100)
+    monkeypatch.setattr(main, "OUTLINE_CACHE_MAX_ENTRIES", 2)
+    (isolated_main / "big.py").write_text(SOURCE)
+    assert main.code_outline("big.py") == "big.py: not outlined (too large or unreadable)"
+    for name in ("a.py", "b.py", "c.py"):
+        (isolated_main / name).write_text(f"def {name[0]}():\n    pass\n")
+        main.code_outline(name)
+        time.sleep(0.01)
+    indexed = {row[0] for row in main.get_outline_cache_db().execute("SELECT path FROM outlines")}
+    assert indexed == {str(isolated_main / "b.py"), str(isolated_main / "c.py")}
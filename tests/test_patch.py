@@ -0,0 +1,67 @@
+import pytest
+
+import main
+
+
+def test_find_anchor_prefers_exact_then_whitespace_then_similar():
+    lines = ["def f():", "    return 1", "", "def g():", "    return  2"]
+    assert main.find_anchor(lines, ["def g():"]) == 3
+    assert main.find_anchor(lines, ["def g():", "return 2"]) == 3
+    assert main.find_anchor(lines, ["def g():", "    return 3"]) == 3
+    assert main.find_anchor(lines, ["class Missing:"]) is None
+
+
+def test_find_anchor_needs_a_hint_for_repeated_blocks():
+    lines = ["x = 1", "y = 2", "x = 1", "y = 2"]
+    assert main.find_anchor(lines, ["x = 1", "y = 2"]) is None
+    assert main.find_anchor(lines, ["x = 1", "y = 2"], hint=3) == 2
+
+
+def test_search_replace_edits():
+    content = "alpha\nbeta\ngamma\n"
+    assert main.apply_search_replace(content, [{"search": "beta", "replace": "BETA"}]) == "alpha\nBETA\ngamma\n"
+    # Whitespace differences fall back to the line anchor
+    assert main.apply_search_replace(content, [{"search": "  gamma", "replace": "delta"}]) == "alpha\nbeta\ndelta\n"
+    with pytest.raises(ValueError, match="matches 2 places"):
+        main.apply_search_replace("a\na\n", [{"search": "a", "replace": "b"}])
+    with pytest.raises(ValueError, match="could not be located"):
+        main.apply_search_replace(content, [{"search": "omega\npsi", "replace": "x"}])
+
+
+def test_hunks_apply_when_line_numbers_are_stale():
+    content = "".join(f"line {i}\n" for i in range(1, 21))
+    diff = "@@ -2,3 +2,3 @@\n line 9\n-line 10\n+line ten\n line 11\n"
+    assert main.apply_hunks(content, main.parse_unified_diff(diff)) == content.replace("line 10\n", "line ten\n")
+
+
+def test_patch_file_writes_and_reports(isolated_main):
+    (isolated_main / "f.txt").write_text("one\ntwo\nthree\n")
+    result = main.patch_file("f.txt", edits=[{"search": "two", "replace": "2"}])
+    assert result.startswith("Changes applied to f.txt")
+    assert (isolated_main / "f.txt").read_text() == "one\n2\nthree\n"
+    assert main.patch_file("f.txt", edits=[{"search": "missing", "replace": "x"}]).startswith("Error")
+
+
+def test_pure_insertion_hunks_go_after_the_named_line():
+    content = "".join(f"line {i}\n" for i in range(1, 11))
+    diff = "@@ -5,0 +6,2 @@\n+new a\n+new b\n"
+    expected = content.replace("line 5\n", "line 5\nnew a\nnew b\n")
+    assert main.apply_hunks(content, main.parse_unified_diff(diff)) == expected
+    assert main.apply_hunks(content, main.parse_unified_diff("@@ -0,0 +1 @@\n+first\n")) == "first\n" + content
+    # What file_diff itself produces for an insertion without context round-trips
+    diff_text, _, _ = main.file_diff(content, expected, "f.txt", context=0)
+    assert "@@ -5,0 +6,2 @@" in diff_text
+    assert main.apply_hunks(content, main.parse_unified_diff(diff_text)) == expected
+
+
+def test_removed_and_added_lines_that_look_like_file_headers():
+    content = "SELECT 1;\n-- comment\nSELECT 2;\n"
+    diff = "--- a/q.sql\n+++ b/q.sql\n@@ -1,3 +1,3 @@\n SELECT 1;\n--- comment\n+++ note\n SELECT 2;\n"
+    assert main.apply_hunks(content, main.parse_unified_diff(diff)) == "SELECT 1;\n++ note\nSELECT 2;\n"
+    # A second file section still starts a fresh header, not hunk lines
+    two_files = diff + "diff --git a/r.sql b/r.sql\nindex 1..2 100644\n--- a/r.sql\n+++ b/r.sql\n@@ -1 +1 @@\n-x\n+y\n"
+    hunks = main.parse_unified_diff(two_files)
+    assert [(hunk["old"], hunk["new"]) for hunk in hunks] == [
+        (["SELECT 1;", "-- comment", "SELECT 2;"], ["SELECT 1;", "++ note", "SELECT 2;"]),
+        (["x"], ["y"]),
+    ]
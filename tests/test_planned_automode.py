@@ -0,0 +1,71 @@
+import asyncio
+
+import main
+
+
+def test_parse_goals_keeps_only_earlier_known_prerequisites():
+    response = ("Here is the plan.\nGoal 1: Add the model\nGoal 2: Add the API (depends on: 1)\n"
+                "Goal 3: Write docs (after: 2, 3, 9)\nGoal 4: Add tests (depends on 1 and 2)\n")
+    assert main.parse_goals(response) == [
+        {"id": 1, "goal": "Add the model", "depends_on": []},
+        {"id": 2, "goal": "Add the API", "depends_on": [1]},
+        {"id": 3, "goal": "Write docs", "depends_on": [2]},
+        {"id": 4, "goal": "Add tests", "depends_on": [1, 2]},
+    ]
+
+
+def test_goals_start_when_their_prerequisites_finish_within_the_parallel_limit(monkeypatch):
+    monkeypatch.setattr(main, "PLAN_MAX_PARALLEL_GOALS", 2)
+    durations = {1: 0.1, 2: 0.2, 3: 0.05, 4: 0.05}
+    events, running = [], []
+
+    async def worker(parent, request, goals, goal, prerequisites, max_iterations):
+        running.append(goal["id"])
+        events.append(("start", goal["id"], len(running), [result["id"] for result in prerequisites]))
+        await asyncio.sleep(durations[goal["id"]])
+        running.remove(goal["id"])
+        events.append(("end", goal["id"]))
+        return {"id": goal["id"], "status": "completed"}
+
+    monkeypatch.setattr(main, "run_goal_worker", worker)
+    goals = main.parse_goals("Goal 1: a\nGoal 2: b\nGoal 3: c (depends on: 1, 2)\nGoal 4: d\n")
+    results = asyncio.run(main.execute_goals(main.Session(render=False), "request", goals, 3))
+    assert [result["id"] for result in results] == [1, 2, 3, 4]
+    starts = {event[1]: event for event in events if event[0] == "start"}
+    assert max(event[2] for event in starts.values()) == 2
+    # Goal 4 has no prerequisites and takes the slot goal 1 frees; goal 3 waits for both 1 and 2
+    assert events.index(starts[4]) == events.index(("end", 1)) + 1
+    assert events.index(starts[3]) > events.index(("end", 2))
+    assert starts[3][3] == [1, 2]
+
+
+def test_merged_results_flag_files_changed_by_several_goals():
+    merged = main.merge_goal_results([
+        {"id": 1, "goal": "a", "status": "completed", "iterations": 1, "files": ["app.py", "a.py"], "summary": "did a"},
+        {"id": 2, "goal": "b", "status": "failed", "iterations": 2, "files": ["app.py"], "summary": ""},
+    ])
+    assert "Goal 1 (completed, 1 iteration(s)): a" in merged and "did a" in merged
+    assert "Goal 2 (failed, 2 iteration(s)): b" in merged
+    assert "Files changed by more than one goal: app.py (goals 1, 2)" in merged
+
+
+def test_planned_automode_runs_workers_and_a_review_turn(fake_api, monkeypatch):
+    bodies = []
+    serve = fake_api.serve_messages
+    monkeypatch.setattr(fake_api, "serve_messages", lambda handler, body: bodies.append(body) or serve(handler, body))
+    fake_api.script([
+        {"content": [{"type": "text", "text": "Goal 1: Create the module\nGoal 2: Document it (depends on: 1)"}]},
+        {"content": [{"type": "text", "text": "Module created. AUTOMODE_COMPLETE"}]},
+        {"content": [{"type": "text", "text": "Docs written. AUTOMODE_COMPLETE"}]},
+        {"content": [{"type": "text", "text": "All good. AUTOMODE_COMPLETE"}]},
+    ])
+    session = main.Session(render=False)
+    asyncio.run(main.run_planned_automode_async(session, "build a module", 3))
+    assert len(bodies) == 4
+    goal_two_prompt = bodies[2]["messages"][-1]["content"][0]["text"]
+    assert "Work only on Goal 2: Document it" in goal_two_prompt
+    assert "Goal 1 is finished: Module created." in goal_two_prompt
+    # Workers keep their own histories; the parent gets the plan and the merged results
+    assert len(session.history) == 4
+    assert session.history[2]["content"].startswith("[Planned automode results]")
+    assert not session.automode
@@ -0,0 +1,46 @@
+import pytest
+
+import main
+
+
+def tool_results(history):
+    return [block["content"] for message in history if isinstance(message["content"], list)
+            for block in message["content"] if block.get("type") == "tool_result"]
+
+
+def test_unchanged_reads_return_a_notice(isolated_main):
+    (isolated_main / "a.txt").write_text("hello\n")
+    assert main.read_file("a.txt") == "hello\n"
+    main.commit_file_reads()
+    assert main.read_file("a.txt").startswith(main.READ_UNCHANGED_MARKER)
+    (isolated_main / "a.txt").write_text("changed\n")
+    assert main.read_file("a.txt") == "changed\n"
+
+
+def test_reads_of_an_interrupted_turn_are_not_remembered(fake_api, isolated_main, monkeypatch):
+    (isolated_main / "a.txt").write_text("hello\n")
+    fake_api.script([{"content": [{"type": "tool_use", "name": "read_file", "input": {"path": "a.txt"}}]}])
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "get_tool_checker_response", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            main.chat_with_claude("read a.txt")
+    assert main.conversation_history == []
+
+    fake_api.script([
+        {"content": [{"type": "tool_use", "name": "read_file", "input": {"path": "a.txt"}}]},
+        {"content": [{"type": "text", "text": "It says hello."}]},
+    ])
+    main.chat_with_claude("read a.txt again")
+    assert tool_results(main.conversation_history) == ["hello\n"]
+
+    # Once committed, the next turn gets the notice
+    fake_api.script([
+        {"content": [{"type": "tool_use", "name": "read_file", "input": {"path": "a.txt"}}]},
+        {"content": [{"type": "text", "text": "Still hello."}]},
+    ])
+    main.chat_with_claude("and once more")
+    assert tool_results(main.conversation_history)[-1].startswith(main.READ_UNCHANGED_MARKER)
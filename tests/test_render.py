@@ -0,0 +1,97 @@
+import io
+import threading
+import time
+
+import pytest
+from rich.text import Text
+
+import main
+
+
+@pytest.fixture
+def output(monkeypatch):
+    buffer = io.StringIO()
+    monkeypatch.setattr(main, "console", main.InstrumentedConsole(file=buffer, width=120))
+    return buffer
+
+
+class Slow:
+    # A renderable that takes a while to render and records which thread rendered it
+    def __init__(self, text, seconds=0.0):
+        self.text, self.seconds, self.thread = text, seconds, None
+
+    def __rich__(self):
+        time.sleep(self.seconds)
+        self.thread = threading.current_thread().name
+        return Text(self.text)
+
+
+class Broken:
+    def __rich__(self):
+        raise ValueError("cannot render")
+
+
+def test_queue_renders_in_order_on_its_thread_and_flush_waits(output):
+    render_queue = main.RenderQueue()
+    items = [Slow(f"item {n}", 0.02) for n in range(5)]
+    started = time.perf_counter()
+    for item in items:
+        render_queue.put(item)
+    # put() only queues; the caller is not held up by rendering
+    assert time.perf_counter() - started < 0.05
+    render_queue.flush()
+    assert output.getvalue().split() == [word for n in range(5) for word in ("item", str(n))]
+    assert {item.thread for item in items} == {"render"}
+
+
+def test_rendering_errors_do_not_stop_the_queue(output, capsys):
+    render_queue = main.RenderQueue()
+    render_queue.put(Broken())
+    render_queue.put(Text("after"))
+    render_queue.flush()
+    assert "after" in output.getvalue()
+    assert "Error rendering output: cannot render" in capsys.readouterr().err
+
+
+def test_rendering_inline_when_off_thread_is_disabled(output, monkeypatch):
+    monkeypatch.setattr(main, "RENDER_OFF_THREAD", False)
+    render_queue = main.RenderQueue()
+    item = Slow("inline")
+    render_queue.put(item)
+    assert item.thread == threading.current_thread().name and render_queue.thread is None
+    assert "inline" in output.getvalue()
+
+
+def test_short_output_is_shown_whole(output):
+    main.console.print(main.preview_panel("one\ntwo", "Result"))
+    assert "expand" not in output.getvalue() and "two" in output.getvalue()
+
+
+def test_long_output_is_truncated_and_kept_for_expand(output, monkeypatch):
+    monkeypatch.setattr(main, "expandable", main.OrderedDict())
+    text = "\n".join(f"line {n}" for n in range(100))
+    main.console.print(main.preview_panel(text, "Result"))
+    [(output_id, stored)] = main.expandable.items()
+    assert stored == ("Result", text, None)
+    rendered = output.getvalue()
+    assert f"Result [{output_id}]" in rendered
+    assert f"line {main.RENDER_PREVIEW_LINES - 1}" in rendered and f"line {main.RENDER_PREVIEW_LINES}" not in rendered
+    assert f"... {100 - main.RENDER_PREVIEW_LINES} more lines. Type 'expand {output_id}' to view all." in rendered
+
+
+def test_long_lines_are_cut_at_the_character_limit(output, monkeypatch):
+    monkeypatch.setattr(main, "expandable", main.OrderedDict())
+    monkeypatch.setattr(main, "RENDER_PREVIEW_CHARS", 50)
+    main.console.print(main.preview_panel("z" * 500, "Result"))
+    assert output.getvalue().count("z") == 50
+    assert list(main.expandable.values()) == [("Result", "z" * 500, None)]
+
+
+def test_only_recent_truncated_outputs_can_be_expanded(output, monkeypatch):
+    monkeypatch.setattr(main, "expandable", main.OrderedDict())
+    monkeypatch.setattr(main, "RENDER_EXPAND_HISTORY", 3)
+    for n in range(5):
+        main.preview_panel(f"output {n}\n" * 100, f"Result {n}")
+    assert [title for title, _, _ in main.expandable.values()] == ["Result 2", "Result 3", "Result 4"]
+    main.expand_output("expand 999999")
+    assert "No output to expand for 'expand 999999'" in output.getvalue()
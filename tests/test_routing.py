@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import main
+
+
+def tool_use(name):
+    return SimpleNamespace(name=name, input={}, id=f"toolu_{name}")
+
+
+def test_acknowledgements_skip_the_follow_up_outside_automode():
+    decision = main.route_tool_followup([tool_use("create_file")], [("File created: a.txt", False)], False)
+    assert decision["route"] == "skip"
+    assert decision["acknowledgement"] == "File created: a.txt"
+
+
+def test_acknowledgements_go_to_the_small_model_in_automode():
+    decision = main.route_tool_followup([tool_use("create_file")], [("File created: a.txt", False)], True)
+    assert (decision["route"], decision["model"]) == ("small", main.SMALLMODEL)
+
+
+def test_errors_and_large_results_go_to_the_main_model():
+    assert main.route_tool_followup([tool_use("create_file")], [("boom", True)], False)["route"] == "main"
+    assert main.route_tool_followup([tool_use("read_file")], [("x" * 10, False)], False)["route"] == "main"
+    listing = main.route_tool_followup([tool_use("list_files")], [("a.txt\nb.txt", False)], False)
+    assert listing["route"] == "small"
+    big_listing = main.route_tool_followup([tool_use("list_files")], [("a" * 5000, False)], False)
+    assert big_listing["route"] == "main"
+
+
+def test_routing_disabled_always_uses_the_main_model(monkeypatch):
+    monkeypatch.setattr(main, "TOOL_ROUTING", False)
+    assert main.route_tool_followup([tool_use("create_file")], [("File created", False)], False)["route"] == "main"
+
+
+def test_acknowledged_tool_call_needs_one_request(fake_api, isolated_main):
+    fake_api.script([{"content": [
+        {"type": "text", "text": "Creating it."},
+        {"type": "tool_use", "name": "create_file", "input": {"path": "a.txt", "content": "hello\n"}},
+    ]}])
+    response, _ = main.chat_with_claude("make a.txt")
+    assert (isolated_main / "a.txt").read_text() == "hello\n"
+    assert fake_api.counters["requests"] == 1
+    assert "File created" in response
+
+
+def test_read_results_get_a_follow_up(fake_api, isolated_main):
+    (isolated_main / "a.txt").write_text("hello\n")
+    fake_api.script([
+        {"content": [{"type": "tool_use", "name": "read_file", "input": {"path": "a.txt"}}]},
+        {"content": [{"type": "text", "text": "It says hello."}]},
+    ])
+    response, _ = main.chat_with_claude("what is in a.txt?")
+    assert fake_api.counters["requests"] == 2
+    assert response.endswith("It says hello.")
+    tool_results = [block for message in main.conversation_history if isinstance(message["content"], list)
+                    for block in message["content"] if block.get("type") == "tool_result"]
+    assert tool_results[0]["content"] == "hello\n"
+
+
+def test_routing_goes_by_the_failure_flag_not_the_text():
+    flagged = main.route_tool_followup([tool_use("create_file")], [(main.ToolError("Could not create a.txt"), True)], False)
+    assert flagged["route"] == "main"
+    unflagged = main.route_tool_followup([tool_use("create_file")], [("Error.txt created", False)], False)
+    assert unflagged["route"] == "skip"
+
+
+def test_edit_and_apply_reports_a_failed_write(isolated_main, monkeypatch):
+    (isolated_main / "f.txt").write_text("old\n")
+    assert main.edit_and_apply("f.txt", "new\n") == "Changes applied to f.txt:\n  Lines added: 1\n  Lines removed: 1\n"
+
+    def disk_full(path, content):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(main, "atomic_write", disk_full)
+    result = main.execute_tool("edit_and_apply", {"path": "f.txt", "new_content": "newer\n"})
+    assert isinstance(result, main.ToolError)
+    assert result.startswith("Error applying changes: [Errno 28]")
+
+
+def test_failed_edit_gets_a_follow_up(fake_api, isolated_main, monkeypatch):
+    (isolated_main / "f.txt").write_text("old\n")
+
+    def disk_full(path, content):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(main, "atomic_write", disk_full)
+    fake_api.script([
+        {"content": [{"type": "tool_use", "name": "edit_and_apply", "input": {"path": "f.txt", "new_content": "new\n"}}]},
+        {"content": [{"type": "text", "text": "The disk is full; nothing was changed."}]},
+    ])
+    response, _ = main.chat_with_claude("update f.txt")
+    assert fake_api.counters["requests"] == 2
+    assert response.endswith("nothing was changed.")
+    tool_result = main.conversation_history[-2]["content"][0]
+    assert tool_result["is_error"] is True
+    assert (isolated_main / "f.txt").read_text() == "old\n"
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+
+import anthropic
+import httpx
+
+import main
+
+
+def rate_limited(headers):
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(429, headers=headers, request=request)
+    return anthropic.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_admission_waits_for_the_request_bucket_to_refill():
+    scheduler = main.RequestScheduler(60, 1_000_000, 1)
+    for _ in range(60):
+        assert scheduler.admission_delay(10) == 0
+    # The 61st request in the minute overdraws by one token, refilled at one per second
+    assert 0.9 < scheduler.admission_delay(10) <= 1.0
+    assert 0.9 < scheduler.stats["wait_seconds"] <= 1.0
+
+
+def test_admission_waits_for_the_token_bucket():
+    scheduler = main.RequestScheduler(1000, 6000, 1)
+    assert scheduler.admission_delay(6000) == 0
+    assert 9.9 < scheduler.admission_delay(1000) <= 10.0
+
+
+def test_retry_after_holds_back_every_caller():
+    scheduler = main.RequestScheduler(1000, 1_000_000, 1)
+    delay = scheduler.retry_delay(rate_limited({"retry-after": "3"}), 0)
+    assert 3 <= delay <= 3.5
+    assert delay - 0.1 < scheduler.admission_delay(10) <= delay
+    assert scheduler.stats["rate_limited"] == scheduler.stats["retries"] == 1
+    # retry-after-ms takes precedence and is in milliseconds
+    assert 0.25 <= scheduler.retry_delay(rate_limited({"retry-after-ms": "250", "retry-after": "9"}), 1) <= 0.75
+    assert scheduler.retry_delay(rate_limited({}), main.RETRY_MAX_ATTEMPTS) is None
+
+
+def test_call_async_retries_after_the_server_delay():
+    scheduler = main.RequestScheduler(1000, 1_000_000, 1)
+    attempts = []
+
+    async def send():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise rate_limited({"retry-after-ms": "200"})
+        return "done"
+
+    assert asyncio.run(scheduler.call_async(send, 10)) == "done"
+    assert attempts[1] - attempts[0] >= 0.2
+    assert scheduler.stats["requests"] == 1
+
+
+def test_call_async_waits_for_a_slot_released_by_a_thread():
+    scheduler = main.RequestScheduler(1000, 1_000_000, 1)
+    started = threading.Event()
+
+    def blocking_send():
+        started.set()
+        time.sleep(0.3)
+        return "sync"
+
+    holder = threading.Thread(target=scheduler.call, args=(blocking_send, 10))
+    holder.start()
+    started.wait(5)
+
+    async def send():
+        return time.monotonic()
+
+    async def run():
+        waiting = asyncio.create_task(scheduler.call_async(send, 10))
+        # The loop stays free while the task waits for the slot
+        ticks = 0
+        while not waiting.done():
+            await asyncio.sleep(0.01)
+            ticks += 1
+        return await waiting, ticks
+
+    before = time.monotonic()
+    finished, ticks = asyncio.run(run())
+    holder.join(5)
+    assert finished - before >= 0.2
+    assert ticks >= 10
+    assert scheduler.slots.acquire(blocking=False)
@@ -0,0 +1,44 @@
+import os
+
+import main
+
+
+def search(pattern):
+    return main.search_file(".", pattern)
+
+
+def test_search_finds_matches_with_line_numbers(isolated_main):
+    (isolated_main / "src").mkdir()
+    (isolated_main / "src" / "a.py").write_text("def alpha():\n    return 'needle'\n")
+    result = search("needle")
+    assert result.startswith("Found 1 matches in 1 files")
+    assert os.path.join("src", "a.py") + ":2:    return 'needle'" in result
+    assert search("missing_word").startswith("No matches found")
+
+
+def test_files_created_outside_the_tools_are_found(isolated_main):
+    (isolated_main / "src").mkdir()
+    (isolated_main / "src" / "a.py").write_text("nothing here\n")
+    assert search("needle").startswith("No matches found")
+    (isolated_main / "src" / "b.py").write_text("needle\n")
+    assert "Found 1 matches in 1 files" in search("needle")
+
+
+def test_files_changed_outside_the_tools_are_reindexed(isolated_main):
+    target = isolated_main / "a.py"
+    target.write_text("first line\n")
+    assert search("needle").startswith("No matches found")
+    with open(target, "a") as f:
+        f.write("needle appended\n")
+    assert "a.py:2:needle appended" in search("needle")
+    target.write_text("rewritten\n")
+    assert search("needle").startswith("No matches found")
+
+
+def test_files_deleted_outside_the_tools_drop_out(isolated_main):
+    (isolated_main / "a.py").write_text("needle\n")
+    (isolated_main / "b.py").write_text("needle\n")
+    assert "Found 2 matches in 2 files" in search("needle")
+    os.unlink(isolated_main / "b.py")
+    assert "Found 1 matches in 1 files" in search("needle")
+    assert not any(path.endswith("b.py") for path in main.search_index["files"])
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class StubTavily:
+    # Stands in for TavilyClient; answers qna_search with a numbered response unless told to fail or wait
+    def __init__(self):
+        self.calls = []
+        self.release = None
+        self.fail = False
+
+    def qna_search(self, query, search_depth="advanced"):
+        self.calls.append((query, search_depth))
+        if self.release is not None:
+            self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("search failed")
+        return f"answer {len(self.calls)} for {query}"
+
+
+@pytest.fixture
+def stub_tavily(monkeypatch):
+    stub = StubTavily()
+    monkeypatch.setattr(main, "tavily", stub)
+    monkeypatch.setattr(main, "tavily_in_flight", {})
+    monkeypatch.setattr(main, "tavily_cache_counters", dict.fromkeys(main.tavily_cache_counters, 0))
+    return stub
+
+
+def test_repeated_and_normalized_queries_hit_the_cache(stub_tavily):
+    assert main.cached_tavily_search("Python 3.13 release date?") == "answer 1 for Python 3.13 release date?"
+    assert main.cached_tavily_search("  python 3.13   RELEASE date ") == "answer 1 for Python 3.13 release date?"
+    assert main.cached_tavily_search("python 3.13 release date", "basic") == "answer 2 for python 3.13 release date"
+    assert len(stub_tavily.calls) == 2
+    stats = main.tavily_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+
+
+def test_expired_entries_are_fetched_again(stub_tavily, monkeypatch):
+    main.cached_tavily_search("query")
+    monkeypatch.setattr(main, "TAVILY_CACHE_TTL", -1)
+    assert main.cached_tavily_search("query") == "answer 2 for query"
+    assert main.tavily_cache_stats()["expired"] == 1
+
+
+def test_least_recently_used_entries_are_evicted(stub_tavily, monkeypatch):
+    monkeypatch.setattr(main, "TAVILY_CACHE_MAX_ENTRIES", 2)
+    main.cached_tavily_search("first")
+    time.sleep(0.01)
+    main.cached_tavily_search("second")
+    time.sleep(0.01)
+    main.cached_tavily_search("first")
+    time.sleep(0.01)
+    main.cached_tavily_search("third")
+    assert main.tavily_cache_stats()["evictions"] == 1
+    main.cached_tavily_search("first")
+    main.cached_tavily_search("second")
+    assert [query for query, _ in stub_tavily.calls] == ["first", "second", "third", "second"]
+
+
+def test_identical_in_flight_searches_share_one_request(stub_tavily):
+    stub_tavily.release = threading.Event()
+    results = []
+    threads = [threading.Thread(target=lambda query=query: results.append(main.cached_tavily_search(query)))
+               for query in ("same query", "Same query?", "same  query", "SAME QUERY")]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while main.tavily_cache_counters["coalesced"] < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    stub_tavily.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(stub_tavily.calls) == 1
+    assert len(set(results)) == 1 and len(results) == 4
+
+
+def test_errors_are_not_cached(stub_tavily):
+    stub_tavily.fail = True
+    with pytest.raises(RuntimeError):
+        main.cached_tavily_search("flaky")
+    assert main.tavily_search("flaky").startswith("Error performing search")
+    stub_tavily.fail = False
+    assert main.cached_tavily_search("flaky") == "answer 3 for flaky"
+    assert main.tavily_cache_stats()["errors"] == 2
+
+
+def test_search_finishing_between_lookup_and_claim_is_not_repeated(stub_tavily, monkeypatch):
+    main.cached_tavily_search("query")
+    real_get = main.tavily_cache_get
+    lookups = []
+
+    def stale_first_lookup(key):
+        # The first lookup misses as if it ran just before the other search stored its answer
+        lookups.append(key)
+        return None if len(lookups) == 1 else real_get(key)
+
+    monkeypatch.setattr(main, "tavily_cache_get", stale_first_lookup)
+    assert main.cached_tavily_search("query") == "answer 1 for query"
+    assert len(stub_tavily.calls) == 1
+    assert main.tavily_cache_stats()["hits"] == 1
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import main
+
+
+def recording_tools(monkeypatch):
+    # execute_tool stand-in: the batch_edit is slow, so anything not ordered after it finishes first
+    finished = []
+    lock = threading.Lock()
+
+    def execute_tool(tool_name, tool_input):
+        if tool_name == "batch_edit":
+            time.sleep(0.3)
+        with lock:
+            finished.append(tool_input.get("path") or tool_name)
+        return "ok"
+
+    monkeypatch.setattr(main, "execute_tool", execute_tool)
+    return finished
+
+
+def calls():
+    batch_edit = {"changes": [{"path": "a.py", "edits": []}, {"path": "./b.py", "edits": []}]}
+    return [
+        SimpleNamespace(name="batch_edit", input=batch_edit),
+        SimpleNamespace(name="create_file", input={"path": "b.py", "content": ""}),
+        SimpleNamespace(name="create_file", input={"path": "c.py", "content": ""}),
+    ]
+
+
+def test_calls_sharing_a_batch_edit_path_wait_for_it(monkeypatch):
+    finished = recording_tools(monkeypatch)
+    batch = main.ToolCallBatch()
+    for tool_use in calls():
+        batch.submit(tool_use)
+    assert batch.results() == [("ok", False)] * 3
+    assert finished == ["c.py", "batch_edit", "b.py"]
+
+
+def test_async_calls_sharing_a_batch_edit_path_wait_for_it(monkeypatch):
+    finished = recording_tools(monkeypatch)
+
+    async def run():
+        batch = main.AsyncToolCallBatch()
+        for tool_use in calls():
+            batch.submit(tool_use)
+        return await batch.results()
+
+    assert asyncio.run(run()) == [("ok", False)] * 3
+    assert finished == ["c.py", "batch_edit", "b.py"]
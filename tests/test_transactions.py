@@ -0,0 +1,120 @@
+import os
+
+import main
+
+
+def test_batch_edit_applies_every_change(isolated_main):
+    (isolated_main / "a.txt").write_text("one\ntwo\n")
+    (isolated_main / "gone.txt").write_text("bye\n")
+    result = main.batch_edit([
+        {"path": "a.txt", "edits": [{"search": "two", "replace": "2"}]},
+        {"path": "new/b.txt", "content": "fresh\n"},
+        {"path": "gone.txt", "delete": True},
+    ], "test change")
+    assert "committed, 3 files changed" in result
+    assert (isolated_main / "a.txt").read_text() == "one\n2\n"
+    assert (isolated_main / "new" / "b.txt").read_text() == "fresh\n"
+    assert not (isolated_main / "gone.txt").exists()
+
+
+def test_batch_edit_writes_nothing_when_a_change_fails(isolated_main):
+    (isolated_main / "a.txt").write_text("one\n")
+    result = main.batch_edit([
+        {"path": "a.txt", "content": "changed\n"},
+        {"path": "b.txt", "edits": [{"search": "x", "replace": "y"}]},
+    ])
+    assert result.startswith("Error in batch edit, no files were changed")
+    assert (isolated_main / "a.txt").read_text() == "one\n"
+    assert not (isolated_main / "b.txt").exists()
+
+
+def test_rollback_restores_and_reports_conflicts(isolated_main):
+    (isolated_main / "a.txt").write_text("one\n")
+    main.batch_edit([{"path": "a.txt", "content": "two\n"}, {"path": "b.txt", "content": "new\n"}])
+    (isolated_main / "a.txt").write_text("edited elsewhere\n")
+    assert "files changed since transaction" in main.rollback_transaction()
+    result = main.rollback_transaction(force=True)
+    assert "rolled back, 2 files restored" in result
+    assert (isolated_main / "a.txt").read_text() == "one\n"
+    assert not (isolated_main / "b.txt").exists()
+    assert main.rollback_transaction().startswith("Error: no committed transaction")
+
+
+def test_recovery_rolls_a_prepared_transaction_forward(isolated_main):
+    (isolated_main / "a.txt").write_text("one\n")
+    transaction = main.FileTransaction(main.transaction_root(), description="crashed")
+    transaction.stage([("a.txt", "one\n", "two\n"), ("b.txt", None, "new\n")])
+    # While its owner is alive the transaction is left to it
+    assert main.recover_transactions() == []
+    # Crash after the commit point, before any file was replaced: the owner lock goes with the process
+    transaction.release()
+    assert (isolated_main / "a.txt").read_text() == "one\n"
+    assert main.recover_transactions() == [f"{transaction.id}: committed"]
+    assert (isolated_main / "a.txt").read_text() == "two\n"
+    assert (isolated_main / "b.txt").read_text() == "new\n"
+    assert main.recover_transactions() == []
+
+
+def test_recovery_discards_staging_that_never_reached_the_commit_point(isolated_main):
+    (isolated_main / "a.txt").write_text("one\n")
+    staging = os.path.join(main.transaction_root(), "unfinished")
+    os.makedirs(os.path.join(staging, "staged"))
+    main.recover_transactions()
+    assert not os.path.exists(staging)
+    assert (isolated_main / "a.txt").read_text() == "one\n"
+
+
+def test_recovery_spares_staging_owned_by_a_live_process(isolated_main):
+    import subprocess
+    import sys
+
+    # Another process starts a transaction and is still staging it
+    child = subprocess.Popen(
+        [sys.executable, "-c", "import sys, time, main\n"
+         "transaction = main.FileTransaction(main.transaction_root())\n"
+         "transaction.create()\n"
+         "print(transaction.dir, flush=True)\n"
+         "time.sleep(60)\n"],
+        cwd=isolated_main, env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))),
+        stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        staging = os.path.join(isolated_main, child.stdout.readline().strip())
+        with open(os.path.join(staging, main.TRANSACTION_OWNER_FILE)) as f:
+            assert int(f.read()) == child.pid
+        main.recover_transactions()
+        assert os.path.isdir(staging)
+    finally:
+        child.kill()
+        child.wait()
+    main.recover_transactions()
+    assert not os.path.exists(staging)
+
+
+def test_batch_edit_leaves_other_staging_transactions_alone(isolated_main):
+    # Another writer (a parallel tool call or goal worker) is still staging its transaction
+    in_flight = main.FileTransaction(main.transaction_root())
+    in_flight.create()
+    os.makedirs(os.path.join(in_flight.dir, "staged"))
+    (isolated_main / "a.txt").write_text("one\n")
+    assert "committed" in main.batch_edit([{"path": "a.txt", "content": "two\n"}])
+    assert "rolled back" in main.rollback_transaction()
+    main.recover_transactions()
+    assert os.path.isdir(os.path.join(in_flight.dir, "staged"))
+    in_flight.release()
+
+
+def test_concurrent_batch_edits_all_commit(isolated_main):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def edit(number):
+        return main.execute_tool("batch_edit", {"changes": [{"path": f"f{number}.txt", "content": f"{number}\n"}, {"path": f"g{number}.txt", "content": "x\n"}]})
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(edit, range(40)))
+    assert all("committed" in result for result in results)
+    for number in range(40):
+        assert (isolated_main / f"f{number}.txt").read_text() == f"{number}\n"
+    finished = main.list_transactions(main.transaction_root())
+    assert len(finished) == main.TRANSACTION_KEEP
+    assert all(transaction.status == "committed" for transaction in finished)